@@ -1,9 +1,179 @@
 import argparse
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
+from PIL import Image
 from torchvision import utils
+from tqdm import tqdm
 
-from model import Generator
+from checkpoint import load_checkpoint, build_generator
+from generate import parse_seeds
+from model import seeded_randn
+
+try:
+    import imageio
+
+except ImportError:
+    imageio = None
+
+# frames queued for the writer thread before rendering waits for it
+MAX_PENDING = 16
+
+
+def sample_latents(g, n_sample, seed, truncation, truncation_mean, device):
+    # truncated W latents and per sample noises, computed once per run. The
+    # directions are scaled by truncation, which matches truncating the moved
+    # latents
+    seeds = list(range(seed, seed + n_sample))
+    z = seeded_randn(seeds, (g.style_dim,), device=device)
+
+    torch.manual_seed(seed)
+    mean_latent = g.mean_latent(truncation_mean)
+    latent = mean_latent + truncation * (g.get_latent(z) - mean_latent)
+
+    return latent, g.make_noise(seeds=seeds)
+
+
+def load_factor(path, group, n_latent, device):
+    # eigenvectors of a layer group of closed_form_factorization.py and the
+    # (n_latent,) mask of the W+ latents they move, None moves all of them
+    factor = torch.load(path)
+
+    if group is None:
+        return factor["eigvec"].to(device), None
+
+    if factor.get("n_latent", n_latent) != n_latent:
+        raise ValueError(
+            f"{path} is a factorization of a generator with {factor['n_latent']} "
+            f"latents, expected {n_latent}"
+        )
+
+    entry = factor["factors"][group]
+    layers = torch.zeros(n_latent, device=device)
+    layers[entry["layers"]] = 1
+
+    return entry["eigvec"].to(device), layers
+
+
+def render(g, latent, noises, directions, batch, layers=None):
+    # images of every latent moved by every direction, (direction, sample)
+    # major, in forward passes of batch images
+    n_sample = latent.shape[0]
+    total = directions.shape[0] * n_sample
+
+    for start in range(0, total, batch):
+        ids = torch.arange(start, min(start + batch, total), device=latent.device)
+        samples = ids % n_sample
+        moves = directions[ids // n_sample]
+
+        if layers is None:
+            latents = latent[samples] + moves
+
+        else:
+            # W+ latents, only the layers of the group are moved
+            moves = moves.unsqueeze(1) * layers.view(1, -1, 1)
+            latents = latent[samples].unsqueeze(1) + moves
+
+        img, _, _ = g(
+            [latents],
+            input_is_latent=True,
+            noise=[noise[samples] for noise in noises],
+        )
+
+        yield img
+
+
+def to_uint8(images, nrow):
+    grid = utils.make_grid(images, nrow=nrow, pad_value=-1)
+
+    return grid.clamp(-1, 1).add(1).mul(127.5).round().to(torch.uint8)
+
+
+def frames(images, n_sample):
+    # regroups a stream of image batches into grids of n_sample images
+    pending = []
+
+    for img in images:
+        pending.extend(img)
+
+        while len(pending) >= n_sample:
+            yield to_uint8(torch.stack(pending[:n_sample]), n_sample)
+
+            pending = pending[n_sample:]
+
+
+def output_name(args, index):
+    group = f"_{args.group}" if args.group is not None else ""
+
+    return f"{args.out_prefix}{group}_index-{index}"
+
+
+def to_array(frame):
+    return frame.permute(1, 2, 0).cpu().numpy()
+
+
+def apply(args, g, eigvec, layers, latent, noises):
+    # +degree, 0 and -degree rows of a single eigenvector in one grid
+    degrees = torch.tensor([args.degree, 0, -args.degree], device=args.device)
+    directions = args.truncation * degrees[:, None] * eigvec[:, args.index]
+
+    images = torch.cat(
+        list(render(g, latent, noises, directions, args.batch, layers)), 0
+    )
+    Image.fromarray(to_array(to_uint8(images, args.n_sample))).save(
+        f"{output_name(args, args.index)}_degree-{args.degree}.png"
+    )
+
+
+def sweep(args, g, eigvec, layers, latent, noises):
+    # every index from -degree to +degree in n_frames steps, frames are written
+    # by a background thread while the next batches render, with at most
+    # MAX_PENDING frames waiting
+    indices = parse_seeds(args.indices)
+    degrees = torch.linspace(
+        -args.degree, args.degree, args.n_frames, device=args.device
+    )
+    # (index, frame) major directions
+    directions = degrees[None, :, None] * eigvec[:, indices].T[:, None]
+    directions = args.truncation * directions.reshape(-1, eigvec.shape[0])
+
+    stream = frames(
+        render(g, latent, noises, directions, args.batch, layers), args.n_sample
+    )
+    writer = ThreadPoolExecutor(1)
+    pending = deque()
+
+    for index in tqdm(indices):
+        if args.video:
+            video = imageio.get_writer(f"{output_name(args, index)}.mp4", fps=args.fps)
+
+        else:
+            out = output_name(args, index)
+            os.makedirs(out, exist_ok=True)
+
+        for i in range(args.n_frames):
+            frame = to_array(next(stream))
+
+            if args.video:
+                pending.append(writer.submit(video.append_data, frame))
+
+            else:
+                path = os.path.join(out, f"frame{i:04d}.png")
+                image = Image.fromarray(frame)
+                pending.append(writer.submit(image.save, path))
+
+            while len(pending) > MAX_PENDING:
+                pending.popleft().result()
+
+        if args.video:
+            pending.append(writer.submit(video.close))
+
+    for future in pending:
+        future.result()
+
+    writer.shutdown()
 
 
 if __name__ == "__main__":
@@ -21,22 +191,78 @@ if __name__ == "__main__":
         default=5,
         help="scalar factors for moving latent vectors along eigenvector",
     )
+    parser.add_argument(
+        "--group",
+        type=str,
+        default=None,
+        help="layer group of the factorization (e.g. coarse, middle, fine), its "
+        "directions only move the W+ latents of the group",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="render --n_frames degrees from -degree to +degree for every "
+        "eigenvector of --indices",
+    )
+    parser.add_argument(
+        "--indices",
+        type=str,
+        default="0-9",
+        help="eigenvectors of the sweep, e.g. 0-9 or 1,5,7",
+    )
+    parser.add_argument(
+        "--n_frames", type=int, default=31, help="number of degrees of the sweep"
+    )
+    parser.add_argument(
+        "--video",
+        action="store_true",
+        help="write every sweep as an mp4 video (requires imageio) instead of png "
+        "frames",
+    )
+    parser.add_argument("--fps", type=int, default=15, help="frame rate of videos")
+    parser.add_argument(
+        "--batch", type=int, default=32, help="images per generator forward"
+    )
     parser.add_argument(
         "--channel_multiplier",
         type=int,
-        default=2,
-        help='channel multiplier factor. config-f = 2, else = 1',
+        default=None,
+        help="channel multiplier factor. config-f = 2, else = 1. read from the "
+        "checkpoint if not given",
     )
     parser.add_argument("--ckpt", type=str, required=True, help="stylegan2 checkpoints")
     parser.add_argument(
-        "--size", type=int, default=256, help="output image size of the generator"
+        "--size",
+        type=int,
+        default=None,
+        help="output image size of the generator, read from the checkpoint if not "
+        "given",
+    )
+    parser.add_argument(
+        "--arch",
+        type=str,
+        default=None,
+        help="model architecture (stylegan2 | swagan), read from the checkpoint if "
+        "not given",
     )
     parser.add_argument(
         "-n", "--n_sample", type=int, default=7, help="number of samples created"
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="samples use the latents and noises of seeds seed, seed + 1, ...",
+    )
     parser.add_argument(
         "--truncation", type=float, default=0.7, help="truncation factor"
     )
+    parser.add_argument(
+        "--truncation_mean",
+        type=int,
+        default=4096,
+        help="number of vectors to calculate mean for the truncation",
+    )
     parser.add_argument(
         "--device", type=str, default="cuda", help="device to run the model"
     )
@@ -54,41 +280,25 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    eigvec = torch.load(args.factor)["eigvec"].to(args.device)
-    ckpt = torch.load(args.ckpt)
-    g = Generator(args.size, 512, 8, channel_multiplier=args.channel_multiplier).to(args.device)
-    g.load_state_dict(ckpt["g_ema"], strict=False)
-
-    trunc = g.mean_latent(4096)
+    if args.video and imageio is None:
+        raise SystemExit("--video requires imageio (and imageio-ffmpeg)")
 
-    latent = torch.randn(args.n_sample, 512, device=args.device)
-    latent = g.get_latent(latent)
+    g = build_generator(
+        load_checkpoint(args.ckpt),
+        strict=False,
+        arch=args.arch,
+        size=args.size,
+        channel_multiplier=args.channel_multiplier,
+    ).to(args.device)
+    g.eval()
+    eigvec, layers = load_factor(args.factor, args.group, g.n_latent, args.device)
 
-    direction = args.degree * eigvec[:, args.index].unsqueeze(0)
-
-    img, _ = g(
-        [latent],
-        truncation=args.truncation,
-        truncation_latent=trunc,
-        input_is_latent=True,
-    )
-    img1, _ = g(
-        [latent + direction],
-        truncation=args.truncation,
-        truncation_latent=trunc,
-        input_is_latent=True,
-    )
-    img2, _ = g(
-        [latent - direction],
-        truncation=args.truncation,
-        truncation_latent=trunc,
-        input_is_latent=True,
+    latent, noises = sample_latents(
+        g, args.n_sample, args.seed, args.truncation, args.truncation_mean, args.device
     )
 
-    grid = utils.save_image(
-        torch.cat([img1, img, img2], 0),
-        f"{args.out_prefix}_index-{args.index}_degree-{args.degree}.png",
-        normalize=True,
-        range=(-1, 1),
-        nrow=args.n_sample,
-    )
+    if args.sweep:
+        sweep(args, g, eigvec, layers, latent, noises)
+
+    else:
+        apply(args, g, eigvec, layers, latent, noises)
@@ -0,0 +1,460 @@
+import argparse
+import time
+
+import torch
+from torch import optim
+from torch.nn import functional as F
+from torch.utils._pytree import tree_flatten
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from model import to_channels_last
+from op import set_native_ops, upfirdn2d
+
+
+def build_models(arch, size, channel_multiplier, device):
+    if arch == "swagan":
+        from swagan import Generator, Discriminator
+
+    else:
+        from model import Generator, Discriminator
+
+    generator = Generator(size, 512, 8, channel_multiplier=channel_multiplier)
+    discriminator = Discriminator(size, channel_multiplier=channel_multiplier)
+
+    return generator.to(device), discriminator.to(device)
+
+
+def synchronize(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def measure(fn, device, n_iter, warmup):
+    # the first warmup call also includes the compilation of compiled modules
+    start = time.perf_counter()
+    fn()
+    synchronize(device)
+    first = time.perf_counter() - start
+
+    for _ in range(warmup - 1):
+        fn()
+
+    synchronize(device)
+    start = time.perf_counter()
+
+    for _ in range(n_iter):
+        fn()
+
+    synchronize(device)
+
+    return first, (time.perf_counter() - start) / n_iter
+
+
+def training_step(
+    generator,
+    discriminator,
+    g_optim,
+    d_optim,
+    batch,
+    size,
+    device,
+    memory_format=torch.contiguous_format,
+):
+    # non saturating G / D step of train.py without the lazy regularizers: R1
+    # and path length need double backward, which torch.compile does not trace
+    z = torch.randn(batch, 512, device=device)
+    real = torch.randn(batch, 3, size, size, device=device)
+    real = real.contiguous(memory_format=memory_format)
+
+    fake = generator([z])[0]
+    d_loss = (
+        F.softplus(discriminator(fake.detach())).mean()
+        + F.softplus(-discriminator(real)).mean()
+    )
+    d_optim.zero_grad(set_to_none=True)
+    d_loss.backward()
+    d_optim.step()
+
+    g_loss = F.softplus(-discriminator(fake)).mean()
+    g_optim.zero_grad(set_to_none=True)
+    g_loss.backward()
+    g_optim.step()
+
+
+def bench_compile(args):
+    if not hasattr(torch, "compile"):
+        raise SystemExit("torch.compile requires PyTorch 2.0 or later")
+
+    generator, discriminator = build_models(
+        args.arch, args.size, args.channel_multiplier, args.device
+    )
+    g_optim = optim.Adam(generator.parameters(), lr=0.002, betas=(0.0, 0.99))
+    d_optim = optim.Adam(discriminator.parameters(), lr=0.002, betas=(0.0, 0.99))
+
+    modes = [("eager", False, False), ("eager native ops", True, False)]
+
+    if not args.no_compile:
+        modes.append(("compiled native ops", True, True))
+
+    for name, native, compiled in modes:
+        set_native_ops(native)
+        g, d = generator, discriminator
+
+        if compiled:
+            g = torch.compile(generator, mode=args.mode)
+            d = torch.compile(discriminator, mode=args.mode)
+
+        first, step = measure(
+            lambda: training_step(
+                g, d, g_optim, d_optim, args.batch, args.size, args.device
+            ),
+            args.device,
+            args.n_iter,
+            args.warmup,
+        )
+        print(
+            f"{name}: {step * 1000:.1f}ms / step, first step {first:.1f}s"
+            f" ({args.batch / step:.1f} images/s)"
+        )
+
+    set_native_ops(False)
+
+
+def bench_channels_last(args):
+    generator, discriminator = build_models(
+        args.arch, args.size, args.channel_multiplier, args.device
+    )
+    g_optim = optim.Adam(generator.parameters(), lr=0.002, betas=(0.0, 0.99))
+    d_optim = optim.Adam(discriminator.parameters(), lr=0.002, betas=(0.0, 0.99))
+
+    for name, memory_format in (
+        ("NCHW", torch.contiguous_format),
+        ("channels_last", torch.channels_last),
+    ):
+        if memory_format == torch.channels_last:
+            to_channels_last(generator)
+            to_channels_last(discriminator)
+
+        _, step = measure(
+            lambda: training_step(
+                generator,
+                discriminator,
+                g_optim,
+                d_optim,
+                args.batch,
+                args.size,
+                args.device,
+                memory_format,
+            ),
+            args.device,
+            args.n_iter,
+            args.warmup,
+        )
+
+        z = torch.randn(args.batch, 512, device=args.device)
+
+        with torch.no_grad():
+            _, inference = measure(
+                lambda: generator([z]), args.device, args.n_iter, args.warmup
+            )
+
+        print(
+            f"{name}: training {args.batch / step:.1f} images/s,"
+            f" generator inference {args.batch / inference:.1f} images/s"
+        )
+
+
+class AllocationCounter(TorchDispatchMode):
+    # counts op outputs backed by a new storage, views and in place ops are free
+    def __init__(self):
+        super().__init__()
+
+        self.count = 0
+        self.bytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+
+        inputs = {
+            t.untyped_storage().data_ptr()
+            for t in tree_flatten((args, kwargs))[0]
+            if torch.is_tensor(t)
+        }
+
+        for t in tree_flatten(out)[0]:
+            if torch.is_tensor(t) and t.untyped_storage().data_ptr() not in inputs:
+                self.count += 1
+                self.bytes += t.untyped_storage().nbytes()
+
+        return out
+
+
+@torch.no_grad()
+def bench_alloc(args):
+    generator, _ = build_models(
+        args.arch, args.size, args.channel_multiplier, args.device
+    )
+    generator.eval()
+
+    for batch in [int(b) for b in args.batches.split(",")]:
+        z = torch.randn(batch, 512, device=args.device)
+        generator([z])
+
+        counter = AllocationCounter()
+
+        with counter:
+            generator([z])
+
+        peak = "n/a"
+
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            generator([z])
+            peak = (torch.cuda.max_memory_allocated() - base) / 2**20
+            peak = f"{peak:.1f}MB"
+
+        _, step = measure(lambda: generator([z]), args.device, args.n_iter, args.warmup)
+
+        print(
+            f"batch {batch}: {counter.count} allocations,"
+            f" {counter.bytes / 2 ** 20:.1f}MB allocated, peak {peak},"
+            f" {step * 1000:.1f}ms / forward"
+        )
+
+
+@torch.no_grad()
+def bench_preview(args):
+    generator, _ = build_models(
+        args.arch, args.size, args.channel_multiplier, args.device
+    )
+    generator.eval()
+
+    z = torch.randn(args.batch, 512, device=args.device)
+    # swagan synthesizes at half resolution, its smallest exit is 8px
+    preview_size = 8 if args.arch == "swagan" else 4
+
+    while preview_size <= args.size:
+        _, step = measure(
+            lambda: generator([z], preview_size=preview_size),
+            args.device,
+            args.n_iter,
+            args.warmup,
+        )
+        print(f"exit at {preview_size}px: {step * 1000:.1f}ms / batch")
+        preview_size *= 2
+
+
+def four_call_dwt(dwt, input):
+    # previous HaarTransform.forward, one upfirdn2d per band
+    bands = [upfirdn2d(input, k, down=2) for k in (dwt.ll, dwt.lh, dwt.hl, dwt.hh)]
+
+    return torch.cat(bands, 1)
+
+
+def four_call_iwt(iwt, input):
+    kernels = (iwt.ll, iwt.lh, iwt.hl, iwt.hh)
+    bands = [
+        upfirdn2d(band, k, up=2, pad=(1, 0, 1, 0))
+        for band, k in zip(input.chunk(4, 1), kernels)
+    ]
+
+    return sum(bands)
+
+
+def bench_haar(args):
+    from swagan import HaarTransform, InverseHaarTransform
+
+    dwt = HaarTransform(3).to(args.device)
+    iwt = InverseHaarTransform(3).to(args.device)
+
+    image = torch.randn(
+        args.batch, 3, args.size, args.size, device=args.device, requires_grad=True
+    )
+    bands = dwt(image).detach().requires_grad_()
+
+    cases = [
+        ("dwt", image, lambda x: four_call_dwt(dwt, x), dwt),
+        ("iwt", bands, lambda x: four_call_iwt(iwt, x), iwt),
+    ]
+
+    for name, input, four_call, fused in cases:
+        diff = (four_call(input) - fused(input)).abs().max().item()
+
+        for impl, fn in (("four calls", four_call), ("fused", fused)):
+            # forward and backward, as in R1 and the generator skips
+            _, step = measure(
+                lambda: torch.autograd.grad(fn(input).square().sum(), input),
+                args.device,
+                args.n_iter,
+                args.warmup,
+            )
+            print(f"{name} {impl}: {step * 1000:.2f}ms")
+
+        print(f"{name} max abs diff: {diff:.2e}")
+
+
+def loop_noise_regularize(noises):
+    # previous noise_regularize of projector.py, one pyramid per noise map
+    loss = 0
+
+    for noise in noises:
+        size = noise.shape[2]
+
+        while True:
+            loss = (
+                loss
+                + (noise * torch.roll(noise, shifts=1, dims=3)).mean([1, 2, 3]).pow(2)
+                + (noise * torch.roll(noise, shifts=1, dims=2)).mean([1, 2, 3]).pow(2)
+            )
+
+            if size <= 8:
+                break
+
+            noise = noise.reshape([-1, 1, size // 2, 2, size // 2, 2])
+            noise = noise.mean([3, 5])
+            size //= 2
+
+    return loss
+
+
+class OpCounter(TorchDispatchMode):
+    # number of dispatched aten ops, roughly the kernel launches
+    def __init__(self):
+        super().__init__()
+
+        self.count = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        self.count += 1
+
+        return func(*args, **(kwargs or {}))
+
+
+def bench_noise(args):
+    from projector import (
+        noise_normalize_,
+        noise_regularize,
+        pack_noises,
+        unpack_noises,
+    )
+
+    generator, _ = build_models(
+        args.arch, args.size, args.channel_multiplier, args.device
+    )
+    packed, layout = pack_noises(generator.make_noise(), args.batch)
+    noises = [noise.clone() for noise in unpack_noises(packed, layout)]
+
+    for noise in packed + noises:
+        noise.requires_grad_()
+
+    diff = (loop_noise_regularize(noises) - noise_regularize(packed)).abs().max()
+
+    def step(regularize, noises):
+        # regularization with its backward and the normalization of a step
+        grads = torch.autograd.grad(regularize(noises).sum(), noises)
+        noise_normalize_(noises)
+
+        return grads
+
+    for name, regularize, inputs in (
+        (f"{len(noises)} maps", loop_noise_regularize, noises),
+        (f"{len(packed)} packed", noise_regularize, packed),
+    ):
+        counter = OpCounter()
+
+        with counter:
+            step(regularize, inputs)
+
+        _, step_time = measure(
+            lambda: step(regularize, inputs), args.device, args.n_iter, args.warmup
+        )
+        print(f"{name}: {counter.count} ops, {step_time * 1000:.2f}ms / step")
+
+    print(f"max abs diff: {diff.item():.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Performance benchmarks of the generator and discriminator"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    compile_parser = subparsers.add_parser(
+        "compile", help="eager vs torch.compile training step time"
+    )
+    compile_parser.set_defaults(func=bench_compile)
+    compile_parser.add_argument(
+        "--mode",
+        type=str,
+        default="default",
+        help="torch.compile mode (default, reduce-overhead, max-autotune)",
+    )
+    compile_parser.add_argument(
+        "--no_compile",
+        action="store_true",
+        help="only time the eager modes, e.g. to compare the ops",
+    )
+
+    channels_last_parser = subparsers.add_parser(
+        "channels_last", help="NCHW vs channels_last training and inference throughput"
+    )
+    channels_last_parser.set_defaults(func=bench_channels_last)
+
+    alloc_parser = subparsers.add_parser(
+        "alloc", help="allocations and peak memory per generator forward"
+    )
+    alloc_parser.set_defaults(func=bench_alloc)
+    alloc_parser.add_argument(
+        "--batches",
+        type=str,
+        default="1,2,4,8,16,32,64",
+        help="comma separated batch sizes",
+    )
+
+    preview_parser = subparsers.add_parser(
+        "preview", help="generator latency per early exit resolution"
+    )
+    preview_parser.set_defaults(func=bench_preview)
+
+    haar_parser = subparsers.add_parser(
+        "haar", help="fused vs four upfirdn2d calls Haar DWT / IWT of swagan"
+    )
+    haar_parser.set_defaults(func=bench_haar)
+
+    noise_parser = subparsers.add_parser(
+        "noise", help="per map vs packed noise regularization of projector.py"
+    )
+    noise_parser.set_defaults(func=bench_noise)
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument(
+            "--arch",
+            type=str,
+            default="stylegan2",
+            help="model architectures (stylegan2 | swagan)",
+        )
+        subparser.add_argument(
+            "--size", type=int, default=256, help="image size of the models"
+        )
+        subparser.add_argument(
+            "--channel_multiplier",
+            type=int,
+            default=2,
+            help="channel multiplier of the models. config-f = 2, else = 1",
+        )
+        subparser.add_argument("--batch", type=int, default=8, help="batch size")
+        subparser.add_argument(
+            "--n_iter", type=int, default=20, help="number of timed iterations"
+        )
+        subparser.add_argument(
+            "--warmup", type=int, default=3, help="number of untimed iterations"
+        )
+        subparser.add_argument(
+            "--device", type=str, default="cuda", help="device to run the models"
+        )
+
+    args = parser.parse_args()
+    args.func(args)
@@ -97,6 +97,13 @@ if __name__ == "__main__":
     parser.add_argument(
         "--flip", action="store_true", help="apply random flipping to real images"
     )
+    parser.add_argument(
+        "--n_features",
+        type=int,
+        default=0,
+        help="number of features stored next to the mean and covariance, needed "
+        "for KID and precision / recall in metrics.py",
+    )
     parser.add_argument("path", metavar="PATH", help="path to datset lmdb file")
 
     args = parser.parse_args()
@@ -125,6 +132,10 @@ if __name__ == "__main__":
     cov = np.cov(features, rowvar=False)
 
     name = os.path.splitext(os.path.basename(args.path))[0]
+    embeds = {"mean": mean, "cov": cov, "size": args.size, "path": args.path}
+
+    if args.n_features > 0:
+        embeds["features"] = features[: args.n_features]
 
     with open(f"inception_{name}.pkl", "wb") as f:
-        pickle.dump({"mean": mean, "cov": cov, "size": args.size, "path": args.path}, f)
+        pickle.dump(embeds, f)
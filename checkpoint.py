@@ -0,0 +1,340 @@
+import argparse
+import io
+import json
+import mmap
+import os
+import pickle
+import re
+import struct
+
+import torch
+
+from model import generator_class
+from prune import match_state_dict
+
+# Tensor store checkpoints: raw tensor bytes, each aligned to ALIGNMENT, then a
+# json index with the generator config and the dtype / shape / offset of every
+# tensor, grouped by component (g, g_ema, d, ...). The file ends with the index
+# length and MAGIC, so readers memory-map the file, parse the footer and only
+# touch the pages of the tensors they use. Non tensor entries (args, optimizer
+# states) are stored as pickled blobs that are only unpickled on access.
+#
+# magic | tensor data ... | blobs ... | index json | index length (u64) | magic
+
+MAGIC = b"SG2STORE"
+ALIGNMENT = 64
+DEFAULT_CONFIG = {
+    "arch": "stylegan2",
+    "size": 256,
+    "style_dim": 512,
+    "n_mlp": 8,
+    "channel_multiplier": 2,
+}
+
+
+def is_tensor_dict(obj):
+    return (
+        isinstance(obj, dict)
+        and len(obj) > 0
+        and all(isinstance(k, str) and torch.is_tensor(v) for k, v in obj.items())
+    )
+
+
+def contains_tensor(obj):
+    if torch.is_tensor(obj):
+        return True
+
+    if isinstance(obj, dict):
+        return any(contains_tensor(v) for v in obj.values())
+
+    if isinstance(obj, (list, tuple)):
+        return any(contains_tensor(v) for v in obj)
+
+    return False
+
+
+def tensor_bytes(tensor):
+    # uint8 view of the tensor data, written without an intermediate bytes copy
+    tensor = tensor.detach().cpu().contiguous().reshape(-1)
+
+    return tensor.view(torch.uint8).numpy()
+
+
+class CheckpointWriter:
+    # streams tensors to disk one at a time, so the full checkpoint never has to
+    # be held in memory; written to a temporary file that replaces path on close
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(MAGIC)
+        self.components = {}
+        self.blobs = {}
+
+    def pad(self):
+        self.file.write(b"\0" * (-self.file.tell() % ALIGNMENT))
+
+    def add_tensor(self, component, key, tensor):
+        self.pad()
+        offset = self.file.tell()
+        self.file.write(tensor_bytes(tensor))
+        self.components.setdefault(component, {})[key] = {
+            "dtype": str(tensor.dtype).replace("torch.", ""),
+            "shape": list(tensor.shape),
+            "offset": offset,
+        }
+
+    def add_state_dict(self, component, state_dict):
+        for key, tensor in state_dict.items():
+            self.add_tensor(component, key, tensor)
+
+    def add_object(self, name, obj):
+        # objects holding tensors (optimizer states) go through torch.save,
+        # plain python objects through pickle
+        if contains_tensor(obj):
+            buffer = io.BytesIO()
+            torch.save(obj, buffer)
+            data, format = buffer.getvalue(), "torch"
+
+        else:
+            data, format = pickle.dumps(obj), "pickle"
+
+        self.pad()
+        self.blobs[name] = {
+            "format": format,
+            "offset": self.file.tell(),
+            "nbytes": len(data),
+        }
+        self.file.write(data)
+
+    def add(self, name, obj):
+        if is_tensor_dict(obj):
+            self.add_state_dict(name, obj)
+
+        else:
+            self.add_object(name, obj)
+
+    def close(self, config=None):
+        index = json.dumps(
+            {
+                "config": config or {},
+                "components": self.components,
+                "blobs": self.blobs,
+            }
+        ).encode()
+        self.file.write(index)
+        self.file.write(struct.pack("<Q", len(index)))
+        self.file.write(MAGIC)
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def save_checkpoint(path, state, config=None):
+    # drop in for torch.save(state, path) of train.py / compress.py style dicts
+    writer = CheckpointWriter(path)
+
+    for name, obj in state.items():
+        writer.add(name, obj)
+
+    writer.close(config)
+
+
+class CheckpointReader:
+    # dict like, read only view of a tensor store. State dicts are returned as
+    # zero copy tensors on the memory-mapped file (copy on write, so loading
+    # them into a module or modifying them never writes to the file)
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        footer = len(MAGIC) + 8
+
+        if len(self.mmap) < 2 * len(MAGIC) + 8 or self.mmap[-len(MAGIC) :] != MAGIC:
+            raise ValueError(f"{path} is not a tensor store checkpoint")
+
+        (index_size,) = struct.unpack("<Q", self.mmap[-footer : -len(MAGIC)])
+        index = json.loads(self.mmap[-footer - index_size : -footer])
+
+        self.config = index["config"]
+        self.components = index["components"]
+        self.blobs = index["blobs"]
+
+    def keys(self):
+        return list(self.components) + list(self.blobs)
+
+    def __contains__(self, name):
+        return name in self.components or name in self.blobs
+
+    def __getitem__(self, name):
+        if name in self.components:
+            return {
+                key: self.tensor(entry) for key, entry in self.components[name].items()
+            }
+
+        if name in self.blobs:
+            entry = self.blobs[name]
+            data = self.mmap[entry["offset"] : entry["offset"] + entry["nbytes"]]
+
+            if entry["format"] == "torch":
+                return torch.load(io.BytesIO(data), map_location="cpu")
+
+            return pickle.loads(data)
+
+        raise KeyError(name)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def tensor(self, entry):
+        dtype = getattr(torch, entry["dtype"])
+        shape = entry["shape"]
+        count = 1
+
+        for dim in shape:
+            count *= dim
+
+        if count == 0:
+            return torch.empty(shape, dtype=dtype)
+
+        tensor = torch.frombuffer(
+            self.mmap, dtype=dtype, count=count, offset=entry["offset"]
+        )
+
+        return tensor.reshape(shape)
+
+
+def is_tensor_store(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_checkpoint(path):
+    # tensor stores are opened lazily, other files are torch.load-ed checkpoints
+    if is_tensor_store(path):
+        return CheckpointReader(path)
+
+    return torch.load(path, map_location=lambda storage, loc: storage)
+
+
+def generator_config(generator):
+    return {
+        "arch": "swagan" if hasattr(generator, "iwt") else "stylegan2",
+        "size": generator.size,
+        "style_dim": generator.style_dim,
+        "n_mlp": len(generator.style) - 1,
+        "channel_multiplier": max(1, generator.channels[64] // 256),
+    }
+
+
+def infer_config(state_dict):
+    # generator config from the keys and shapes of a generator state_dict
+    n_mlp = sum(re.fullmatch(r"style\.\d+\.weight", k) is not None for k in state_dict)
+    n_to_rgbs = sum(
+        re.fullmatch(r"to_rgbs\.\d+\.conv\.weight", k) is not None for k in state_dict
+    )
+    arch = "swagan" if "iwt.ll" in state_dict else "stylegan2"
+    # swagan synthesizes at half resolution
+    log_size = n_to_rgbs + (3 if arch == "swagan" else 2)
+    config = {
+        "arch": arch,
+        "size": 2 ** log_size,
+        "style_dim": state_dict["style.1.weight"].shape[1],
+        "n_mlp": n_mlp,
+    }
+
+    if "to_rgbs.3.conv.weight" in state_dict:
+        # input of the 64px to_rgb is 256 * channel_multiplier wide, rounded
+        # up for pruned generators that match_state_dict narrows afterwards
+        width = state_dict["to_rgbs.3.conv.weight"].shape[2]
+        config["channel_multiplier"] = -(-width // 256)
+
+    return config
+
+
+def checkpoint_config(checkpoint, component="g_ema"):
+    # generator config of a checkpoint: stored in tensor stores, otherwise
+    # inferred from the generator state_dict
+    if isinstance(checkpoint, CheckpointReader) and checkpoint.config:
+        return dict(checkpoint.config)
+
+    return infer_config(checkpoint[component])
+
+
+def build_generator(checkpoint, component="g_ema", strict=True, **overrides):
+    # generator of a checkpoint with its config, overrides that are not None
+    # (e.g. command line arguments) take precedence
+    config = dict(DEFAULT_CONFIG)
+    config.update(checkpoint_config(checkpoint, component))
+    config.update({k: v for k, v in overrides.items() if v is not None})
+
+    Generator = generator_class(config["arch"])
+    generator = Generator(
+        config["size"],
+        config["style_dim"],
+        config["n_mlp"],
+        channel_multiplier=config["channel_multiplier"],
+    )
+    state_dict = checkpoint[component]
+    # a pruned student is narrower than the freshly built one
+    match_state_dict(generator, state_dict)
+    generator.load_state_dict(state_dict, strict=strict)
+
+    return generator
+
+
+def convert(args):
+    checkpoint = load_checkpoint(args.ckpt)
+    names = args.components.split(",") if args.components else checkpoint.keys()
+    config = checkpoint_config(checkpoint)
+    writer = CheckpointWriter(args.out)
+
+    for name in names:
+        writer.add(name, checkpoint[name])
+
+    writer.close(config)
+    print(f"{args.out}: {', '.join(names)}, {json.dumps(config)}")
+
+
+def info(args):
+    checkpoint = load_checkpoint(args.ckpt)
+    print(json.dumps(checkpoint_config(checkpoint)))
+
+    for name in checkpoint.keys():
+        obj = checkpoint[name]
+
+        if is_tensor_dict(obj):
+            n_params = sum(t.numel() for t in obj.values())
+            print(f"{name}: {len(obj)} tensors, {n_params} elements")
+
+        else:
+            print(f"{name}: {type(obj).__name__}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tensor store checkpoints")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    convert_parser = subparsers.add_parser(
+        "convert", help="convert a torch.save checkpoint to a tensor store"
+    )
+    convert_parser.set_defaults(func=convert)
+    convert_parser.add_argument("ckpt", type=str, help="path to the checkpoint")
+    convert_parser.add_argument("out", type=str, help="path to the tensor store")
+    convert_parser.add_argument(
+        "--components",
+        type=str,
+        default=None,
+        help="comma separated entries to keep, e.g. g_ema (default: all)",
+    )
+
+    info_parser = subparsers.add_parser(
+        "info", help="print the config and the entries of a checkpoint"
+    )
+    info_parser.set_defaults(func=info)
+    info_parser.add_argument("ckpt", type=str, help="path to the checkpoint")
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,7 +1,78 @@
 import argparse
+import re
+import time
+import warnings
 
 import torch
 
+from checkpoint import load_checkpoint
+from generate import parse_seeds
+
+
+def modulation_weights(state_dict):
+    # (W+ index, modulation weight) of the convs and to_rgb1, the to_rgbs are
+    # left out as before
+    weights = []
+
+    for k, v in state_dict.items():
+        if k == "conv1.conv.modulation.weight":
+            weights.append((0, v))
+
+        elif k == "to_rgb1.conv.modulation.weight":
+            weights.append((1, v))
+
+        else:
+            match = re.fullmatch(r"convs\.(\d+)\.conv\.modulation\.weight", k)
+
+            if match is not None:
+                # convs.i modulates with latent i + 1, see Generator.forward
+                weights.append((int(match.group(1)) + 1, v))
+
+    return weights
+
+
+def parse_groups(groups, n_latent):
+    # "coarse=0-3;middle=4-7;fine=8-", an open range ends at the last latent
+    # of a factorized layer. The last W+ latent is left out of every group,
+    # only the final to_rgb reads it and its weights are not factorized.
+    # Groups without latents (e.g. fine on a 32px model) are skipped
+    last = n_latent - 2
+    out = {}
+
+    for group in groups.split(";"):
+        name, layers = group.split("=")
+        layers = ",".join(
+            f"{part}{last}" if part.endswith("-") else part
+            for part in layers.split(",")
+        )
+        layers = [i for i in parse_seeds(layers) if i <= last]
+
+        if len(layers) == 0:
+            warnings.warn(
+                f"skipping group {name}, the generator has no W+ latents in it "
+                f"({n_latent} latents)"
+            )
+            continue
+
+        out[name] = layers
+
+    return out
+
+
+def factorize(weight, top_k=None, niter=2):
+    # right singular vectors (eigenvectors of W^T W) and eigenvalues, the top_k
+    # with randomized SVD
+    if top_k is None:
+        _, s, v = torch.svd(weight)
+
+    else:
+        _, s, v = torch.svd_lowrank(
+            weight, q=min(top_k + 10, *weight.shape), niter=niter
+        )
+        s, v = s[:top_k], v[:, :top_k]
+
+    return v, s ** 2
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -11,23 +82,56 @@ if __name__ == "__main__":
     parser.add_argument(
         "--out", type=str, default="factor.pt", help="name of the result factor file"
     )
+    parser.add_argument(
+        "--groups",
+        type=str,
+        default="coarse=0-3;middle=4-7;fine=8-",
+        help="W+ layer groups factorized separately, name=layers separated by ;",
+    )
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=None,
+        help="only compute the top k directions with randomized SVD",
+    )
+    parser.add_argument(
+        "--niter",
+        type=int,
+        default=2,
+        help="subspace iterations of the randomized SVD",
+    )
     parser.add_argument("ckpt", type=str, help="name of the model checkpoint")
 
     args = parser.parse_args()
 
-    ckpt = torch.load(args.ckpt)
-    modulate = {
-        k: v
-        for k, v in ckpt["g_ema"].items()
-        if "modulation" in k and "to_rgbs" not in k and "weight" in k
-    }
+    weights = modulation_weights(load_checkpoint(args.ckpt)["g_ema"])
+    # every conv has its own latent, plus the last to_rgb
+    n_latent = max(i for i, _ in weights) + 2
+    groups = {"global": list(range(n_latent - 1))}
+    groups.update(parse_groups(args.groups, n_latent))
 
-    weight_mat = []
-    for k, v in modulate.items():
-        weight_mat.append(v)
+    factors = {}
 
-    W = torch.cat(weight_mat, 0)
-    eigvec = torch.svd(W).V.to("cpu")
+    for name, layers in groups.items():
+        layer_weights = [v for i, v in weights if i in layers]
+        start = time.perf_counter()
+        eigvec, eigval = factorize(
+            torch.cat(layer_weights, 0).float(), args.top_k, args.niter
+        )
+        eigvec = eigvec.to("cpu")
+        factors[name] = {"eigvec": eigvec, "eigval": eigval.to("cpu"), "layers": layers}
 
-    torch.save({"ckpt": args.ckpt, "eigvec": eigvec}, args.out)
+        print(
+            f"{name}: layers {layers[0]}-{layers[-1]}, {eigvec.shape[1]} directions,"
+            f" {(time.perf_counter() - start) * 1000:.1f}ms"
+        )
 
+    torch.save(
+        {
+            "ckpt": args.ckpt,
+            "eigvec": factors["global"]["eigvec"],
+            "n_latent": n_latent,
+            "factors": factors,
+        },
+        args.out,
+    )
@@ -27,8 +27,17 @@ from distributed import (
     reduce_sum,
     get_world_size,
 )
+from checkpoint import checkpoint_config, generator_config, load_checkpoint, save_checkpoint
 from op import conv2d_gradfix
 from non_leaking import augment, AdaptiveAugment
+from prune import (
+    add_channel_gates,
+    gate_penalty,
+    select_channels,
+    prune_channels,
+    channel_widths,
+    match_state_dict,
+)
 
 
 def data_sampler(dataset, shuffle, distributed):
@@ -134,6 +143,23 @@ def KA(X, Y):
     ret = (X_vec * Y_vec).sum() / ((X_vec**2).sum() * (Y_vec**2).sum())**0.5
     return ret
 
+def tap_resolution(f_map, arch):
+    # image resolution of a feature tap, swagan taps are wavelet coefficients at
+    # half resolution
+    return f_map.shape[-1] * (2 if arch == 'swagan' else 1)
+
+def pair_f_maps(f_maps_s, f_maps_t, arch_s, arch_t):
+    # student and teacher taps of the same image resolution. The Haar transform
+    # is orthonormal, so the gram matrices of KA are the same for wavelet and
+    # RGB taps and mixed architectures can be aligned directly
+    taps_t = {tap_resolution(f_t, arch_t): f_t for f_t in f_maps_t}
+    pairs = []
+    for f_s in f_maps_s:
+        res = tap_resolution(f_s, arch_s)
+        if res in taps_t:
+            pairs.append((f_s, taps_t[res]))
+    return pairs
+
 # train student model
 def train(args, loader, generator, discriminator, student_generator, student_discriminator, g_optim, d_optim, g_ema, student_g_ema, device):
     # create directories
@@ -279,7 +305,7 @@ def train(args, loader, generator, discriminator, student_generator, student_dis
         # Kernel Alignment
         if args.kernel_alignment:
             dist_loss = 0 # for knowledge distillation
-            for f_s, f_t in zip(f_maps_s, f_maps_t):
+            for f_s, f_t in pair_f_maps(f_maps_s, f_maps_t, args.arch_s, args.arch):
                 dist_loss += KA(f_s, f_t)
             dist_loss = -dist_loss # we want to maximise it
             g_loss = g_loss + dist_loss
@@ -292,6 +318,12 @@ def train(args, loader, generator, discriminator, student_generator, student_dis
             perc_loss = loss_fn_vgg(fake_img_s, down_fake_img_t)
             g_loss = g_loss + perc_loss.mean()
 
+        # sparsity penalty on the channel gates closes unneeded student channels
+        if args.prune:
+            gate_loss = args.prune_reg * gate_penalty(g_module)
+            loss_dict["gate"] = gate_loss
+            g_loss = g_loss + gate_loss
+
         # adv + perc + ka
         loss_dict["g"] = g_loss
 
@@ -332,6 +364,17 @@ def train(args, loader, generator, discriminator, student_generator, student_dis
 
         accumulate(student_g_ema, g_module, accum)
 
+        # physically remove dead channels from the student and its ema copy
+        if args.prune and i > 0 and i % args.prune_every == 0:
+            keeps = select_channels(
+                g_module, args.prune_threshold, args.prune_min_channels
+            )
+            prune_channels(g_module, keeps, g_optim)
+            prune_channels(student_g_ema, keeps)
+
+            if get_rank() == 0:
+                print(f"pruned student widths: {channel_widths(g_module)}")
+
         loss_reduced = reduce_loss_dict(loss_dict)
 
         g_loss_val = loss_reduced["g"].mean().item()
@@ -380,7 +423,8 @@ def train(args, loader, generator, discriminator, student_generator, student_dis
                     )
 
             if i % 10000 == 0:
-                torch.save(
+                save_checkpoint(
+                    f"{save_dir}/checkpoints/{str(i).zfill(6)}.pt",
                     {
                         "g": g_module.state_dict(),
                         "d": d_module.state_dict(),
@@ -390,7 +434,7 @@ def train(args, loader, generator, discriminator, student_generator, student_dis
                         "args": args,
                         "ada_aug_p": ada_aug_p,
                     },
-                    f"{save_dir}/checkpoints/{str(i).zfill(6)}.pt",
+                    generator_config(student_g_ema),
                 )
                 
 
@@ -398,7 +442,8 @@ def train(args, loader, generator, discriminator, student_generator, student_dis
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="StyleGAN2 compression")
     parser.add_argument("--path", type=str, help="path to the lmdb dataset")
-    parser.add_argument('--arch', type=str, default='stylegan2', help='model architectures (stylegan2 | swagan)')
+    parser.add_argument('--arch', type=str, default=None, help='teacher architecture (stylegan2 | swagan), read from the teacher checkpoint if not given')
+    parser.add_argument('--arch_s', type=str, default=None, help='student architecture (stylegan2 | swagan), defaults to the teacher architecture')
     parser.add_argument("--iter", type=int, default=800000, help="total training iterations")
     parser.add_argument("--batch", type=int, default=16, help="batch sizes for each gpus")
     parser.add_argument("--n_sample",type=int,default=64,help="number of the samples generated during training",)
@@ -427,6 +472,11 @@ if __name__ == "__main__":
     parser.add_argument("--inherit_style", action="store_true", default=False, help="Inherit parent style weight.")
     parser.add_argument("--expr_dir", type=str, default='./expr', help="Define directory where checkpoints and samples will be stored.")
     parser.add_argument("--gpu",type=str,default="cuda",help="select gpu id",)
+    parser.add_argument("--prune", action="store_true", default=False, help="Learn channel gates and prune dead channels of the student.")
+    parser.add_argument("--prune_reg", type=float, default=1e-2, help="weight of the sparsity penalty on the channel gates")
+    parser.add_argument("--prune_every", type=int, default=5000, help="interval of removing dead channels from the student")
+    parser.add_argument("--prune_threshold", type=float, default=1e-2, help="channels whose gate norm falls below this fraction of the largest in the layer are removed")
+    parser.add_argument("--prune_min_channels", type=int, default=8, help="minimum number of channels kept in every layer")
 
     args = parser.parse_args()
 
@@ -435,6 +485,20 @@ if __name__ == "__main__":
     n_gpu = int(os.environ["WORLD_SIZE"]) if "WORLD_SIZE" in os.environ else 1
     args.distributed = n_gpu > 1
 
+    ckpt = {}
+    if args.ckpt is not None:
+        ckpt = load_checkpoint(args.ckpt)
+        if args.arch is None:
+            args.arch = checkpoint_config(ckpt)["arch"]
+
+    if args.arch is None:
+        args.arch = 'stylegan2'
+    if args.arch_s is None:
+        args.arch_s = args.arch
+
+    if args.prune and (args.distributed or args.arch_s != 'stylegan2'):
+        parser.error("--prune is only supported for single gpu stylegan2 students")
+
     if args.distributed:
         torch.cuda.set_device(args.local_rank)
         torch.distributed.init_process_group(backend="nccl", init_method="env://")
@@ -449,6 +513,11 @@ if __name__ == "__main__":
     elif args.arch == 'swagan':
         from swagan import Generator, Discriminator
 
+    if args.arch_s == 'stylegan2':
+        from model import Generator as StudentGenerator, Discriminator as StudentDiscriminator
+    elif args.arch_s == 'swagan':
+        from swagan import Generator as StudentGenerator, Discriminator as StudentDiscriminator
+
     # Teacher network
     generator = Generator(
         args.size, args.latent, args.n_mlp, channel_multiplier=args.channel_multiplier
@@ -468,17 +537,20 @@ if __name__ == "__main__":
     d_reg_ratio = args.d_reg_every / (args.d_reg_every + 1)
 
     # Student network
-    student_generator = Generator(
+    student_generator = StudentGenerator(
         args.size_s, args.latent, args.n_mlp, channel_multiplier=args.channel_multiplier_s
     ).to(device)
 
+    if args.prune:
+        add_channel_gates(student_generator)
+
     g_optim = optim.Adam(
         student_generator.parameters(),
         lr=args.lr * g_reg_ratio,
         betas=(0 ** g_reg_ratio, 0.99 ** g_reg_ratio),
     )
 
-    student_discriminator = Discriminator(
+    student_discriminator = StudentDiscriminator(
         args.size_s, channel_multiplier=args.channel_multiplier_s
     ).to(device)
 
@@ -488,18 +560,20 @@ if __name__ == "__main__":
         betas=(0 ** d_reg_ratio, 0.99 ** d_reg_ratio),
     )
 
-    student_g_ema = Generator(
+    student_g_ema = StudentGenerator(
         args.size_s, args.latent, args.n_mlp, channel_multiplier=args.channel_multiplier_s
     ).to(device)
     student_g_ema.eval()
+
+    if args.prune:
+        add_channel_gates(student_g_ema)
+
     accumulate(student_g_ema, student_generator, 0)
 
     # load teacher network
     if args.ckpt is not None:
         print("load model:", args.ckpt)
 
-        ckpt = torch.load(args.ckpt, map_location=lambda storage, loc: storage)
-
         try:
             ckpt_name = os.path.basename(args.ckpt)
             # args.start_iter = int(os.path.splitext(ckpt_name)[0])
@@ -522,14 +596,20 @@ if __name__ == "__main__":
     # continue training student network
     if args.ckpt_s is not None:
         print(f"load student model: { args.ckpt_s }")
-        ckpt_s = torch.load(args.ckpt_s, map_location=lambda storage, loc: storage)
+        ckpt_s = load_checkpoint(args.ckpt_s)
         try:
             ckpt_s_name = os.path.basename(args.ckpt_s)
             args.start_iter = int(os.path.splitext(ckpt_s_name)[0])
         except ValueError:
             pass
-        student_generator.load_state_dict(ckpt["g"])
-        student_g_ema.load_state_dict(ckpt["g_ema"])
+
+        # a pruned student is narrower than the freshly built one
+        if args.prune:
+            match_state_dict(student_generator, ckpt_s["g"], g_optim)
+            match_state_dict(student_g_ema, ckpt_s["g_ema"])
+
+        student_generator.load_state_dict(ckpt_s["g"])
+        student_g_ema.load_state_dict(ckpt_s["g_ema"])
 
         g_optim.load_state_dict(ckpt_s["g_optim"])
         d_optim.load_state_dict(ckpt_s["d_optim"])
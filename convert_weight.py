@@ -6,8 +6,10 @@ import math
 
 import torch
 import numpy as np
+from PIL import Image
 from torchvision import utils
 
+from checkpoint import CheckpointWriter, build_generator, load_checkpoint
 from model import Generator, Discriminator
 
 
@@ -92,114 +94,91 @@ def convert_dense(vars, source_name, target_name):
     return dic_torch
 
 
-def update(state_dict, new):
-    for k, v in new.items():
-        if k not in state_dict:
-            raise KeyError(k + " is not found")
-
-        if v.shape != state_dict[k].shape:
-            raise ValueError(f"Shape mismatch: {v.shape} vs {state_dict[k].shape}")
-
-        state_dict[k] = v
-
-
-def discriminator_fill_statedict(statedict, vars, size):
+def discriminator_tensors(vars, size):
+    # converted (key, tensor) pairs, one TF variable group at a time
     log_size = int(math.log(size, 2))
 
-    update(statedict, convert_conv(vars, f"{size}x{size}/FromRGB", "convs.0"))
+    yield from convert_conv(vars, f"{size}x{size}/FromRGB", "convs.0").items()
 
     conv_i = 1
 
     for i in range(log_size - 2, 0, -1):
         reso = 4 * 2 ** i
-        update(
-            statedict,
-            convert_conv(vars, f"{reso}x{reso}/Conv0", f"convs.{conv_i}.conv1"),
-        )
-        update(
-            statedict,
-            convert_conv(
-                vars, f"{reso}x{reso}/Conv1_down", f"convs.{conv_i}.conv2", start=1
-            ),
-        )
-        update(
-            statedict,
-            convert_conv(
-                vars, f"{reso}x{reso}/Skip", f"convs.{conv_i}.skip", start=1, bias=False
-            ),
-        )
+        yield from convert_conv(
+            vars, f"{reso}x{reso}/Conv0", f"convs.{conv_i}.conv1"
+        ).items()
+        yield from convert_conv(
+            vars, f"{reso}x{reso}/Conv1_down", f"convs.{conv_i}.conv2", start=1
+        ).items()
+        yield from convert_conv(
+            vars, f"{reso}x{reso}/Skip", f"convs.{conv_i}.skip", start=1, bias=False
+        ).items()
         conv_i += 1
 
-    update(statedict, convert_conv(vars, f"4x4/Conv", "final_conv"))
-    update(statedict, convert_dense(vars, f"4x4/Dense0", "final_linear.0"))
-    update(statedict, convert_dense(vars, f"Output", "final_linear.1"))
-
-    return statedict
+    yield from convert_conv(vars, f"4x4/Conv", "final_conv").items()
+    yield from convert_dense(vars, f"4x4/Dense0", "final_linear.0").items()
+    yield from convert_dense(vars, f"Output", "final_linear.1").items()
 
 
-def fill_statedict(state_dict, vars, size, n_mlp):
+def generator_tensors(vars, size, n_mlp):
     log_size = int(math.log(size, 2))
 
     for i in range(n_mlp):
-        update(state_dict, convert_dense(vars, f"G_mapping/Dense{i}", f"style.{i + 1}"))
+        yield from convert_dense(vars, f"G_mapping/Dense{i}", f"style.{i + 1}").items()
 
-    update(
-        state_dict,
-        {
-            "input.input": torch.from_numpy(
-                vars["G_synthesis/4x4/Const/const"].value().eval()
-            )
-        },
+    yield "input.input", torch.from_numpy(
+        vars["G_synthesis/4x4/Const/const"].value().eval()
     )
-
-    update(state_dict, convert_torgb(vars, "G_synthesis/4x4/ToRGB", "to_rgb1"))
+    yield from convert_torgb(vars, "G_synthesis/4x4/ToRGB", "to_rgb1").items()
 
     for i in range(log_size - 2):
         reso = 4 * 2 ** (i + 1)
-        update(
-            state_dict,
-            convert_torgb(vars, f"G_synthesis/{reso}x{reso}/ToRGB", f"to_rgbs.{i}"),
-        )
+        yield from convert_torgb(
+            vars, f"G_synthesis/{reso}x{reso}/ToRGB", f"to_rgbs.{i}"
+        ).items()
 
-    update(state_dict, convert_modconv(vars, "G_synthesis/4x4/Conv", "conv1"))
+    yield from convert_modconv(vars, "G_synthesis/4x4/Conv", "conv1").items()
 
     conv_i = 0
 
     for i in range(log_size - 2):
         reso = 4 * 2 ** (i + 1)
-        update(
-            state_dict,
-            convert_modconv(
-                vars,
-                f"G_synthesis/{reso}x{reso}/Conv0_up",
-                f"convs.{conv_i}",
-                flip=True,
-            ),
-        )
-        update(
-            state_dict,
-            convert_modconv(
-                vars, f"G_synthesis/{reso}x{reso}/Conv1", f"convs.{conv_i + 1}"
-            ),
-        )
+        yield from convert_modconv(
+            vars, f"G_synthesis/{reso}x{reso}/Conv0_up", f"convs.{conv_i}", flip=True
+        ).items()
+        yield from convert_modconv(
+            vars, f"G_synthesis/{reso}x{reso}/Conv1", f"convs.{conv_i + 1}"
+        ).items()
         conv_i += 2
 
     for i in range(0, (log_size - 2) * 2 + 1):
-        update(
-            state_dict,
-            {
-                f"noises.noise_{i}": torch.from_numpy(
-                    vars[f"G_synthesis/noise{i}"].value().eval()
-                )
-            },
+        yield f"noises.noise_{i}", torch.from_numpy(
+            vars[f"G_synthesis/noise{i}"].value().eval()
         )
 
-    return state_dict
 
+def write_component(writer, component, tensors, template):
+    # streams converted tensors into the store, checked against the state_dict
+    # of a freshly built model; entries without a TF counterpart (blur and
+    # upsample kernels) are taken from the template
+    written = set()
 
-if __name__ == "__main__":
-    device = "cuda"
+    for k, v in tensors:
+        if k not in template:
+            raise KeyError(k + " is not found")
 
+        if v.shape != template[k].shape:
+            raise ValueError(f"Shape mismatch: {v.shape} vs {template[k].shape}")
+
+        writer.add_tensor(component, k, v)
+        written.add(k)
+
+    for k, v in template.items():
+        if k not in written:
+            writer.add_tensor(component, k, v)
+
+
+if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Tensorflow to pytorch model checkpoint converter"
     )
@@ -221,6 +200,21 @@ if __name__ == "__main__":
         default=2,
         help="channel multiplier factor. config-f = 2, else = 1",
     )
+    parser.add_argument(
+        "--device", type=str, default="cpu", help="device of the parity check"
+    )
+    parser.add_argument(
+        "--n_sample",
+        type=int,
+        default=4,
+        help="number of samples of the parity check, 0 to skip it",
+    )
+    parser.add_argument(
+        "--out",
+        type=str,
+        default=None,
+        help="path of the converted checkpoint (default: name of the pickle.pt)",
+    )
     parser.add_argument("path", metavar="PATH", help="path to the tensorflow weights")
 
     args = parser.parse_args()
@@ -243,59 +237,78 @@ if __name__ == "__main__":
         if layer[0].startswith('Dense'):
             n_mlp += 1
 
-    g = Generator(size, 512, n_mlp, channel_multiplier=args.channel_multiplier)
-    state_dict = g.state_dict()
-    state_dict = fill_statedict(state_dict, g_ema.vars, size, n_mlp)
-
-    g.load_state_dict(state_dict)
-
-    latent_avg = torch.from_numpy(g_ema.vars["dlatent_avg"].value().eval())
+    name = os.path.splitext(os.path.basename(args.path))[0]
+    out = args.out or name + ".pt"
+    config = {
+        "arch": "stylegan2",
+        "size": size,
+        "style_dim": 512,
+        "n_mlp": n_mlp,
+        "channel_multiplier": args.channel_multiplier,
+    }
 
-    ckpt = {"g_ema": state_dict, "latent_avg": latent_avg}
+    # g_ema, g and d are converted one after another into a single tensor store,
+    # variables are read from the TF session and written one group at a time
+    components = [("g_ema", g_ema, "generator")]
 
     if args.gen:
-        g_train = Generator(size, 512, n_mlp, channel_multiplier=args.channel_multiplier)
-        g_train_state = g_train.state_dict()
-        g_train_state = fill_statedict(g_train_state, generator.vars, size, n_mlp)
-        ckpt["g"] = g_train_state
+        components.append(("g", generator, "generator"))
 
     if args.disc:
-        disc = Discriminator(size, channel_multiplier=args.channel_multiplier)
-        d_state = disc.state_dict()
-        d_state = discriminator_fill_statedict(d_state, discriminator.vars, size)
-        ckpt["d"] = d_state
+        components.append(("d", discriminator, "discriminator"))
 
-    name = os.path.splitext(os.path.basename(args.path))[0]
-    torch.save(ckpt, name + ".pt")
+    writer = CheckpointWriter(out)
 
-    batch_size = {256: 16, 512: 9, 1024: 4}
-    n_sample = batch_size.get(size, 25)
+    for component, network, kind in components:
+        if kind == "generator":
+            template = Generator(
+                size, 512, n_mlp, channel_multiplier=args.channel_multiplier
+            ).state_dict()
+            tensors = generator_tensors(network.vars, size, n_mlp)
 
-    g = g.to(device)
+        else:
+            template = Discriminator(
+                size, channel_multiplier=args.channel_multiplier
+            ).state_dict()
+            tensors = discriminator_tensors(network.vars, size)
 
-    z = np.random.RandomState(0).randn(n_sample, 512).astype("float32")
+        write_component(writer, component, tensors, template)
+        del template
 
-    with torch.no_grad():
-        img_pt, _ = g(
-            [torch.from_numpy(z).to(device)],
-            truncation=0.5,
-            truncation_latent=latent_avg.to(device),
-            randomize_noise=False,
-        )
+    latent_avg = torch.from_numpy(g_ema.vars["dlatent_avg"].value().eval())
+    writer.add_object("latent_avg", latent_avg)
+    writer.close(config)
+    print(f"{out}: {', '.join(c for c, _, _ in components)}")
+
+    if args.n_sample > 0:
+        # parity of the written checkpoint against the TF g_ema
+        device = args.device
+        g = build_generator(load_checkpoint(out)).to(device).eval()
+
+        z = np.random.RandomState(0).randn(args.n_sample, 512).astype("float32")
+
+        with torch.no_grad():
+            img_pt, _, _ = g(
+                [torch.from_numpy(z).to(device)],
+                truncation=0.5,
+                truncation_latent=latent_avg.to(device),
+                randomize_noise=False,
+            )
 
-    Gs_kwargs = dnnlib.EasyDict()
-    Gs_kwargs.randomize_noise = False
-    img_tf = g_ema.run(z, None, **Gs_kwargs)
-    img_tf = torch.from_numpy(img_tf).to(device)
+        Gs_kwargs = dnnlib.EasyDict()
+        Gs_kwargs.randomize_noise = False
+        img_tf = g_ema.run(z, None, **Gs_kwargs)
+        img_tf = torch.from_numpy(img_tf).to(device)
 
-    img_diff = ((img_pt + 1) / 2).clamp(0.0, 1.0) - ((img_tf.to(device) + 1) / 2).clamp(
-        0.0, 1.0
-    )
+        img_diff = ((img_pt + 1) / 2).clamp(0.0, 1.0) - ((img_tf + 1) / 2).clamp(
+            0.0, 1.0
+        )
 
-    img_concat = torch.cat((img_tf, img_pt, img_diff), dim=0)
+        img_concat = torch.cat((img_tf, img_pt, img_diff), dim=0)
 
-    print(img_diff.abs().max())
+        print(img_diff.abs().max())
 
-    utils.save_image(
-        img_concat, name + ".png", nrow=n_sample, normalize=True, range=(-1, 1)
-    )
+        # uint8 grid by hand, save_image(range=...) is gone in newer torchvision
+        grid = utils.make_grid(img_concat, nrow=args.n_sample)
+        grid = grid.clamp(-1, 1).add(1).mul(127.5).round().to(torch.uint8)
+        Image.fromarray(grid.permute(1, 2, 0).cpu().numpy()).save(name + ".png")
@@ -0,0 +1,389 @@
+import argparse
+import math
+import time
+
+import torch
+from PIL import Image
+from torch import nn, optim
+from torch.nn import functional as F
+from torchvision import transforms
+from tqdm import tqdm
+
+import lpips
+from checkpoint import build_generator, load_checkpoint, save_checkpoint
+from model import ConvLayer, EqualLinear, ResBlock
+from projector import (
+    ProjectionPool,
+    add_projection_args,
+    downsample,
+    latent_stats,
+    list_images,
+)
+
+
+class Encoder(nn.Module):
+    # discriminator style residual network that predicts the W (or W+) latent
+    # of an image, as an offset from the mean latent in units of the latent
+    # std per dimension
+    def __init__(
+        self,
+        size,
+        style_dim=512,
+        n_latent=14,
+        w_plus=True,
+        channel_multiplier=1,
+        blur_kernel=[1, 3, 3, 1],
+    ):
+        super().__init__()
+
+        self.size = size
+        self.style_dim = style_dim
+        self.n_latent = n_latent
+        self.w_plus = w_plus
+        self.channel_multiplier = channel_multiplier
+
+        channels = {
+            4: 512,
+            8: 512,
+            16: 512,
+            32: 512,
+            64: 256 * channel_multiplier,
+            128: 128 * channel_multiplier,
+            256: 64 * channel_multiplier,
+        }
+
+        convs = [ConvLayer(3, channels[size], 1)]
+
+        log_size = int(math.log(size, 2))
+
+        in_channel = channels[size]
+
+        for i in range(log_size, 2, -1):
+            out_channel = channels[2 ** (i - 1)]
+
+            convs.append(ResBlock(in_channel, out_channel, blur_kernel))
+
+            in_channel = out_channel
+
+        self.convs = nn.Sequential(*convs)
+
+        self.final_conv = ConvLayer(in_channel, channels[4], 3)
+        self.final_linear = nn.Sequential(
+            EqualLinear(channels[4] * 4 * 4, channels[4], activation="fused_lrelu"),
+            EqualLinear(channels[4], style_dim * (n_latent if w_plus else 1)),
+        )
+
+        # statistics of the generator latents, set before training
+        self.register_buffer("latent_mean", torch.zeros(style_dim))
+        self.register_buffer("latent_std", torch.ones(()))
+
+    def config(self):
+        return {
+            "size": self.size,
+            "style_dim": self.style_dim,
+            "n_latent": self.n_latent,
+            "w_plus": self.w_plus,
+            "channel_multiplier": self.channel_multiplier,
+        }
+
+    def latent_scale(self):
+        # latent_std is the norm of the deviations from the mean (projector.py)
+        return self.latent_std / self.style_dim**0.5
+
+    def forward(self, input):
+        if input.shape[2] != self.size:
+            input = F.interpolate(input, size=(self.size, self.size), mode="area")
+
+        batch = input.shape[0]
+
+        out = self.convs(input)
+        out = self.final_conv(out)
+        out = self.final_linear(out.reshape(batch, -1))
+
+        if self.w_plus:
+            out = out.view(batch, self.n_latent, self.style_dim)
+
+        return self.latent_mean + self.latent_scale() * out
+
+
+def load_encoder(path, device):
+    checkpoint = load_checkpoint(path)
+    encoder = Encoder(**checkpoint.config)
+    encoder.load_state_dict(checkpoint["encoder"])
+
+    return encoder.to(device).eval()
+
+
+@torch.no_grad()
+def sample_pairs(g_ema, batch, size, w_plus, mixing, device):
+    # synthesized images with the latents that generated them; W+ latents
+    # switch to a second W at a random layer with probability mixing
+    z = torch.randn(2, batch, g_ema.style_dim, device=device)
+    w = g_ema.style(z.view(2 * batch, -1)).view(2, batch, -1)
+    latent = w[0]
+
+    if w_plus:
+        n_latent = g_ema.n_latent
+        index = torch.randint(1, n_latent, (batch, 1), device=device)
+        index[torch.rand(batch, device=device) >= mixing] = n_latent
+        mixed = torch.arange(n_latent, device=device).unsqueeze(0) >= index
+        latent = torch.where(mixed.unsqueeze(2), w[1].unsqueeze(1), w[0].unsqueeze(1))
+
+    img, _, _ = g_ema([latent], input_is_latent=True)
+
+    return downsample(img, size), latent
+
+
+def train(args):
+    device = args.device
+
+    g_ema = build_generator(
+        load_checkpoint(args.ckpt), strict=False, arch=args.arch, size=args.size
+    )
+    g_ema.eval().requires_grad_(False)
+    g_ema = g_ema.to(device)
+
+    encoder = Encoder(
+        min(g_ema.size, 256),
+        g_ema.style_dim,
+        g_ema.n_latent,
+        w_plus=args.w_plus,
+        channel_multiplier=args.channel_multiplier,
+    ).to(device)
+    latent_mean, latent_std = latent_stats(g_ema, 10000, device)
+    encoder.latent_mean.copy_(latent_mean)
+    encoder.latent_std.copy_(latent_std)
+
+    optimizer = optim.Adam(encoder.parameters(), lr=args.lr, betas=(0.9, 0.99))
+
+    percept = None
+
+    if args.lpips > 0:
+        percept = lpips.PerceptualLoss(
+            model="net-lin", net="vgg", use_gpu=device.startswith("cuda")
+        )
+
+    pbar = tqdm(range(args.iter), dynamic_ncols=True, smoothing=0.01)
+
+    for i in pbar:
+        img, latent = sample_pairs(
+            g_ema, args.batch, encoder.size, args.w_plus, args.mixing, device
+        )
+        pred = encoder(img)
+
+        latent_loss = ((pred - latent) / encoder.latent_scale()).pow(2).mean()
+        loss = latent_loss
+        p_loss = torch.zeros(())
+
+        if percept is not None:
+            img_rec, _, _ = g_ema([pred], input_is_latent=True)
+            p_loss = percept(downsample(img_rec, encoder.size), img).mean()
+            loss = loss + args.lpips * p_loss
+
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+
+        pbar.set_description(
+            f"latent: {latent_loss.item():.4f}; perceptual: {p_loss.item():.4f}"
+        )
+
+        if (i + 1) % args.save_every == 0 or i + 1 == args.iter:
+            save_checkpoint(
+                args.out,
+                {"encoder": encoder.state_dict(), "args": args},
+                encoder.config(),
+            )
+
+
+def bench(args):
+    # steps until every image reaches an LPIPS of --target, starting from the
+    # mean latent and from the encoder prediction
+    device = args.device
+
+    g_ema = build_generator(
+        load_checkpoint(args.ckpt), strict=False, arch=args.arch, size=args.size
+    )
+    g_ema.eval()
+    g_ema = g_ema.to(device)
+    encoder = load_encoder(args.encoder, device)
+
+    torch.manual_seed(args.seed)
+
+    if len(args.files) > 0:
+        transform = transforms.Compose(
+            [
+                transforms.Resize(encoder.size),
+                transforms.CenterCrop(encoder.size),
+                transforms.ToTensor(),
+                transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5]),
+            ]
+        )
+        targets = torch.stack(
+            [
+                transform(Image.open(path).convert("RGB"))
+                for path in list_images(args.files)[: args.n_images]
+            ]
+        ).to(device)
+
+    else:
+        targets, _ = sample_pairs(g_ema, args.n_images, encoder.size, True, 0.9, device)
+
+    percept = lpips.PerceptualLoss(
+        model="net-lin", net="vgg", use_gpu=device.startswith("cuda")
+    )
+    n_images = targets.shape[0]
+
+    with torch.no_grad():
+        predictions = encoder(targets)
+
+    for name, latents in (("mean latent", None), ("encoder", predictions)):
+        pool = ProjectionPool(
+            g_ema,
+            percept,
+            encoder.latent_mean,
+            encoder.latent_std,
+            n_images,
+            args,
+            device,
+        )
+
+        for slot in range(n_images):
+            pool.fill(
+                slot,
+                str(slot),
+                targets[slot],
+                None if latents is None else latents[slot],
+            )
+
+        # best_loss is the loss of the latents before each step
+        reached = torch.full((n_images,), -1, dtype=torch.long)
+        start = time.perf_counter()
+
+        for step in range(args.step):
+            pool.step()
+
+            if step == 0:
+                initial = pool.best_loss.mean().item()
+
+            hit = (pool.best_loss <= args.target).cpu() & (reached < 0)
+            reached[hit] = step
+
+            if (reached >= 0).all():
+                break
+
+        elapsed = time.perf_counter() - start
+        steps = reached[reached >= 0].float()
+        median = f"{steps.median().item():.0f}" if len(steps) > 0 else "n/a"
+
+        print(
+            f"{name}: LPIPS {initial:.4f} -> {pool.best_loss.mean().item():.4f},"
+            f" {len(steps)}/{n_images} images reached {args.target} in median"
+            f" {median} steps, {elapsed:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Encoder that predicts starting latents for projector.py"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    train_parser = subparsers.add_parser(
+        "train", help="train an encoder on images synthesized by the generator"
+    )
+    train_parser.set_defaults(func=train)
+    train_parser.add_argument(
+        "--out", type=str, default="encoder.pt", help="path to the encoder checkpoint"
+    )
+    train_parser.add_argument(
+        "--iter", type=int, default=50000, help="total training iterations"
+    )
+    train_parser.add_argument("--batch", type=int, default=16, help="batch size")
+    train_parser.add_argument("--lr", type=float, default=1e-4, help="learning rate")
+    train_parser.add_argument(
+        "--w_plus",
+        action="store_true",
+        help="predict distinct latent codes for each layer",
+    )
+    train_parser.add_argument(
+        "--mixing",
+        type=float,
+        default=0.9,
+        help="probability of mixed W+ training latents",
+    )
+    train_parser.add_argument(
+        "--lpips",
+        type=float,
+        default=0,
+        help="weight of the LPIPS loss between the target and the image of the "
+        "predicted latent",
+    )
+    train_parser.add_argument(
+        "--channel_multiplier",
+        type=int,
+        default=1,
+        help="channel multiplier of the encoder",
+    )
+    train_parser.add_argument(
+        "--save_every",
+        type=int,
+        default=1000,
+        help="iterations between encoder checkpoints",
+    )
+
+    bench_parser = subparsers.add_parser(
+        "bench", help="projection steps to a target LPIPS with and without encoder"
+    )
+    bench_parser.set_defaults(func=bench)
+    bench_parser.add_argument(
+        "--encoder", type=str, required=True, help="path to the encoder checkpoint"
+    )
+    bench_parser.add_argument(
+        "--target",
+        type=float,
+        default=0.3,
+        help="LPIPS to reach (the projection loss, so together with --mse)",
+    )
+    bench_parser.add_argument(
+        "--n_images",
+        type=int,
+        default=8,
+        help="number of images, projected in a single batch",
+    )
+    bench_parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the synthesized images"
+    )
+    bench_parser.add_argument(
+        "files",
+        metavar="FILES",
+        nargs="*",
+        help="images or directories to project, synthesized images if not given",
+    )
+    add_projection_args(bench_parser)
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument(
+            "--ckpt", type=str, required=True, help="path to the model checkpoint"
+        )
+        subparser.add_argument(
+            "--size",
+            type=int,
+            default=None,
+            help="output image size of the generator, read from the checkpoint if "
+            "not given",
+        )
+        subparser.add_argument(
+            "--arch",
+            type=str,
+            default=None,
+            help="model architecture (stylegan2 | swagan), read from the checkpoint "
+            "if not given",
+        )
+        subparser.add_argument(
+            "--device", type=str, default="cuda", help="device to run the models"
+        )
+
+    args = parser.parse_args()
+    args.func(args)
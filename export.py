@@ -0,0 +1,224 @@
+import argparse
+import time
+
+import torch
+from torch import nn
+
+from checkpoint import load_checkpoint, build_generator
+from op import native_ops
+
+try:
+    import onnxruntime
+
+except ImportError:
+    onnxruntime = None
+
+
+class MappingNetwork(nn.Module):
+    def __init__(self, generator):
+        super().__init__()
+
+        self.style = generator.style
+
+    def forward(self, input):
+        return self.style(input)
+
+
+class SynthesisNetwork(nn.Module):
+    # fixed resolution synthesis network taking a W+ latent and explicit noises,
+    # so that no python side state (style mixing, noise buffers) is involved
+    def __init__(self, generator):
+        super().__init__()
+
+        self.generator = generator
+
+    def forward(self, latent, *noises):
+        image, _, _ = self.generator([latent], input_is_latent=True, noise=noises)
+
+        return image
+
+
+def example_inputs(generator, batch, device):
+    latent = torch.randn(batch, generator.n_latent, generator.style_dim, device=device)
+    noises = [noise.repeat(batch, 1, 1, 1) for noise in generator.make_noise()]
+
+    return (latent, *noises)
+
+
+def input_names(generator):
+    return ["latent"] + [f"noise_{i}" for i in range(generator.num_layers)]
+
+
+@torch.no_grad()
+def export_torchscript(module, inputs, path):
+    with native_ops():
+        traced = torch.jit.trace(module.eval(), inputs, check_trace=False)
+
+    traced.save(path)
+
+    return traced
+
+
+@torch.no_grad()
+def export_onnx(module, inputs, path, names, opset=11):
+    with native_ops():
+        torch.onnx.export(
+            module.eval(),
+            inputs,
+            path,
+            input_names=names,
+            output_names=["output"],
+            opset_version=opset,
+        )
+
+
+@torch.no_grad()
+def measure_latency(fn, inputs, device, n_iter=20, warmup=3):
+    for _ in range(warmup):
+        fn(*inputs)
+
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+    start = time.perf_counter()
+
+    for _ in range(n_iter):
+        fn(*inputs)
+
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / n_iter
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the generator to TorchScript / ONNX with static shapes"
+    )
+
+    parser.add_argument(
+        "--ckpt", type=str, required=True, help="path to the model checkpoint"
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=None,
+        help="output image size of the generator, read from the checkpoint if not "
+        "given",
+    )
+    parser.add_argument(
+        "--channel_multiplier",
+        type=int,
+        default=None,
+        help="channel multiplier of the generator. config-f = 2, else = 1. read "
+        "from the checkpoint if not given",
+    )
+    parser.add_argument(
+        "--batch", type=int, default=1, help="static batch size of the exported graph"
+    )
+    parser.add_argument(
+        "--device", type=str, default="cpu", help="device used for the export"
+    )
+    parser.add_argument(
+        "--out", type=str, default="generator", help="filename prefix of the artifacts"
+    )
+    parser.add_argument("--onnx", action="store_true", help="also export to ONNX")
+    parser.add_argument("--opset", type=int, default=11, help="ONNX opset version")
+    parser.add_argument(
+        "--atol", type=float, default=1e-3, help="tolerance of the parity check"
+    )
+    parser.add_argument(
+        "--n_iter", type=int, default=20, help="iterations of the latency benchmark"
+    )
+
+    args = parser.parse_args()
+
+    device = args.device
+
+    g_ema = build_generator(
+        load_checkpoint(args.ckpt),
+        arch="stylegan2",
+        size=args.size,
+        channel_multiplier=args.channel_multiplier,
+    )
+    g_ema = g_ema.to(device).eval()
+    args.latent = g_ema.style_dim
+
+    mapping = MappingNetwork(g_ema)
+    synthesis = SynthesisNetwork(g_ema)
+
+    z = torch.randn(args.batch, args.latent, device=device)
+    synthesis_inputs = example_inputs(g_ema, args.batch, device)
+
+    traced_mapping = export_torchscript(mapping, (z,), f"{args.out}_mapping.pt")
+    traced_synthesis = export_torchscript(
+        synthesis, synthesis_inputs, f"{args.out}_synthesis.pt"
+    )
+
+    if args.onnx:
+        export_onnx(mapping, (z,), f"{args.out}_mapping.onnx", ["z"], args.opset)
+        export_onnx(
+            synthesis,
+            synthesis_inputs,
+            f"{args.out}_synthesis.onnx",
+            input_names(g_ema),
+            args.opset,
+        )
+
+    # parity of the reloaded artifacts against the eager model on fresh inputs
+    z = torch.randn(args.batch, args.latent, device=device)
+    synthesis_inputs = example_inputs(g_ema, args.batch, device)
+
+    loaded_mapping = torch.jit.load(f"{args.out}_mapping.pt", map_location=device)
+    loaded_synthesis = torch.jit.load(f"{args.out}_synthesis.pt", map_location=device)
+
+    with torch.no_grad():
+        w_eager = mapping(z)
+        image_eager = synthesis(*synthesis_inputs)
+        diffs = {
+            "torchscript mapping": (loaded_mapping(z) - w_eager).abs().max().item(),
+            "torchscript synthesis": (loaded_synthesis(*synthesis_inputs) - image_eager)
+            .abs()
+            .max()
+            .item(),
+        }
+
+    latencies = {
+        "eager": measure_latency(synthesis, synthesis_inputs, device, args.n_iter),
+        "torchscript": measure_latency(
+            loaded_synthesis, synthesis_inputs, device, args.n_iter
+        ),
+    }
+
+    if args.onnx and onnxruntime is not None:
+        sessions = {
+            name: onnxruntime.InferenceSession(f"{args.out}_{name}.onnx")
+            for name in ("mapping", "synthesis")
+        }
+        feed = {
+            name: tensor.cpu().numpy()
+            for name, tensor in zip(input_names(g_ema), synthesis_inputs)
+        }
+
+        def run_onnx(*inputs):
+            return sessions["synthesis"].run(None, feed)[0]
+
+        w_onnx = sessions["mapping"].run(None, {"z": z.cpu().numpy()})[0]
+        diffs["onnx mapping"] = (
+            (torch.from_numpy(w_onnx) - w_eager.cpu()).abs().max().item()
+        )
+        diffs["onnx synthesis"] = (
+            (torch.from_numpy(run_onnx()) - image_eager.cpu()).abs().max().item()
+        )
+        latencies["onnxruntime"] = measure_latency(run_onnx, (), "cpu", args.n_iter)
+
+    for name, diff in diffs.items():
+        print(f"{name}: max abs diff {diff:.6f}")
+
+    for name, latency in latencies.items():
+        print(f"{name}: {latency * 1000:.2f}ms / batch of {args.batch}")
+
+    failed = [name for name, diff in diffs.items() if diff > args.atol]
+
+    if failed:
+        raise SystemExit(f"parity check failed for: {', '.join(failed)}")
@@ -7,7 +7,7 @@ import numpy as np
 from scipy import linalg
 from tqdm import tqdm
 
-from model import Generator
+from checkpoint import load_checkpoint, build_generator
 from calc_inception import load_patched_inception_v3
 
 
@@ -66,17 +66,23 @@ if __name__ == "__main__":
     parser.add_argument("--truncation_mean",type=int,default=4096,help="number of samples to calculate mean for truncation",)
     parser.add_argument("--batch", type=int, default=64, help="batch size for the generator")
     parser.add_argument("--n_sample",type=int,default=50000,help="number of the samples for calculating FID",)
-    parser.add_argument("--size", type=int, default=256, help="image sizes for generator")
+    parser.add_argument("--size", type=int, default=None, help="image sizes for generator, read from the checkpoint if not given")
     parser.add_argument("--inception",type=str,default=None,required=True,help="path to precomputed inception embedding",)
     parser.add_argument("--ckpt", metavar="CHECKPOINT", help="path to generator checkpoint")
-    parser.add_argument("--channel_multiplier", type=int, default=2, help="Channel multiplier. Use value that model was trained with")
+    parser.add_argument("--channel_multiplier", type=int, default=None, help="Channel multiplier, read from the checkpoint if not given")
+    parser.add_argument("--arch", type=str, default=None, help="model architecture (stylegan2 | swagan), read from the checkpoint if not given")
 
     args = parser.parse_args()
 
-    ckpt = torch.load(args.ckpt)
+    ckpt = load_checkpoint(args.ckpt)
 
-    g = Generator(args.size, 512, 8, channel_multiplier=args.channel_multiplier).to(device)
-    g.load_state_dict(ckpt["g_ema"], strict=False)
+    g = build_generator(
+        ckpt,
+        strict=False,
+        arch=args.arch,
+        size=args.size,
+        channel_multiplier=args.channel_multiplier,
+    ).to(device)
     g = nn.DataParallel(g)
     g.eval()
 
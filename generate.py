@@ -1,49 +1,363 @@
 import argparse
+import io
+import os
+import queue
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import torch
-from torchvision import utils
-from model import Generator
+from torch import multiprocessing as mp
+from PIL import Image
 from tqdm import tqdm
 
+from checkpoint import load_checkpoint, build_generator
+from model import (
+    seeded_randn,
+    truncation_schedule,
+    broadcast_styles,
+    truncate,
+)
 
-def generate(args, g_ema, device, mean_latent):
+IMAGE_FORMATS = {"png": "PNG", "jpg": "JPEG", "webp": "WEBP"}
+SHARD_FORMATS = ("npz", "tar")
 
-    with torch.no_grad():
-        g_ema.eval()
-        for i in tqdm(range(args.pics)):
-            sample_z = torch.randn(args.sample, args.latent, device=device)
 
-            sample, _ = g_ema(
-                [sample_z], truncation=args.truncation, truncation_latent=mean_latent
+def parse_seeds(seeds):
+    # "0-999", "1,5,7" or "0-9,20-29", ranges are inclusive
+    out = []
+
+    for part in seeds.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            out.extend(range(int(start), int(end) + 1))
+
+        else:
+            out.append(int(part))
+
+    return out
+
+
+def image_path(out, seed, fmt):
+    return os.path.join(out, f"seed{seed:08d}.{fmt}")
+
+
+def shard_path(out, index, fmt):
+    return os.path.join(out, f"shard{index:06d}.{fmt}")
+
+
+def make_units(args, seeds):
+    # (path, seeds) work units, units that are already written are skipped.
+    # shards are indexed by position, so resume with the same seeds and
+    # --shard_size
+    if args.format in SHARD_FORMATS:
+        units = [
+            (
+                shard_path(args.out, i // args.shard_size, args.format),
+                seeds[i : i + args.shard_size],
             )
+            for i in range(0, len(seeds), args.shard_size)
+        ]
+
+        return [(path, seeds) for path, seeds in units if not os.path.exists(path)]
+
+    seeds = [
+        seed
+        for seed in seeds
+        if not os.path.exists(image_path(args.out, seed, args.format))
+    ]
+
+    return [(None, seeds[i : i + args.batch]) for i in range(0, len(seeds), args.batch)]
+
+
+def write_atomic(path, data):
+    # partially written files must not count as done when resuming
+    tmp = f"{path}.tmp{os.getpid()}"
+
+    with open(tmp, "wb") as f:
+        f.write(data)
+
+    os.replace(tmp, path)
 
-            utils.save_image(
-                sample,
-                f"./output/{str(i).zfill(6)}.png",
-                nrow=1,
-                normalize=True,
-                range=(-1, 1),
+
+def encode_image(image, fmt, quality):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format=IMAGE_FORMATS[fmt], quality=quality)
+
+    return buffer.getvalue()
+
+
+def save_unit(images, seeds, path, args):
+    if args.format == "npz":
+        buffer = io.BytesIO()
+        np.savez(buffer, images=images, seeds=np.array(seeds))
+        write_atomic(path, buffer.getvalue())
+
+    elif args.format == "tar":
+        buffer = io.BytesIO()
+
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            for image, seed in zip(images, seeds):
+                data = encode_image(image, "png", args.quality)
+                info = tarfile.TarInfo(f"seed{seed:08d}.png")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+        write_atomic(path, buffer.getvalue())
+
+    else:
+        for image, seed in zip(images, seeds):
+            write_atomic(
+                image_path(args.out, seed, args.format),
+                encode_image(image, args.format, args.quality),
             )
 
 
-if __name__ == "__main__":
-    device = "cuda"
+def load_generator(args, device):
+    # only g_ema is read, lazily for tensor store checkpoints
+    g_ema = build_generator(
+        load_checkpoint(args.ckpt),
+        arch=args.arch,
+        size=args.size,
+        channel_multiplier=args.channel_multiplier,
+    )
+
+    return g_ema.to(device).eval()
+
+
+def synthesis_res(generator, size):
+    # resolution of the synthesis feature maps for an output size, swagan
+    # synthesizes wavelet coefficients at half resolution
+    return size * 2 ** generator.log_size // generator.size
+
+
+def sample_memory(generator, tile_from=None, tile_size=64, halo=8):
+    # rough peak bytes per sample of a no_grad forward: the largest styled conv
+    # (input, batch sized modulated weights, outputs) next to the skip image.
+    # Layers above tile_from only hold one tile with its halo at a time
+    tile_res = None if tile_from is None else synthesis_res(generator, tile_from)
+    skip_channels = generator.to_rgb1.conv.out_channel
+    res = 4
+    peak = 0
+
+    for layer in [generator.conv1, *generator.convs]:
+        conv = layer.conv
+        res = res * 2 if conv.upsample else res
+        side = res
+
+        if tile_res is not None and res > tile_res:
+            side = (tile_size + 2 * halo) * res // tile_res
+
+        in_side = side // 2 if conv.upsample else side
+        weight = conv.in_channel * conv.out_channel * conv.kernel_size ** 2
+        layer_peak = (
+            conv.in_channel * in_side ** 2
+            + 2 * weight
+            + 3 * conv.out_channel * side ** 2
+            + 2 * skip_channels * side ** 2
+        )
+        peak = max(peak, layer_peak)
+
+    # the stitched output of tiled rendering
+    image = 3 * generator.size ** 2 if tile_from is not None else 0
+
+    return 4 * (peak + image)
+
+
+@torch.no_grad()
+def synthesize_tiled(generator, latent, noise, tile_from, tile_size=64, halo=8):
+    # synthesis up to tile_from as usual, the following layers run on spatial
+    # tiles of tile_size pixels (at tile_from) with halo pixels of context that
+    # cover the receptive field of the convs and up-sampling blurs; noise is
+    # the explicit full list, so tiles see the same noise as a full render
+    tile_res = synthesis_res(generator, tile_from)
+
+    out = generator.input(latent)
+    out = generator.conv1(out, latent[:, 0], noise=noise[0])
+    skip = generator.to_rgb1(out, latent[:, 1])
+
+    layers = list(
+        zip(
+            generator.convs[::2],
+            generator.convs[1::2],
+            noise[1::2],
+            noise[2::2],
+            generator.to_rgbs,
+        )
+    )
+    i = 1
+
+    while len(layers) > 0 and out.shape[-1] < tile_res:
+        conv1, conv2, noise1, noise2, to_rgb = layers.pop(0)
+        out = conv1(out, latent[:, i], noise=noise1)
+        out = conv2(out, latent[:, i + 1], noise=noise2)
+        skip = to_rgb(out, latent[:, i + 2], skip)
+        i += 2
+
+    res = out.shape[-1]
+    scale = 2 ** len(layers)
+    image = None
+
+    for y0 in range(0, res, tile_size):
+        for x0 in range(0, res, tile_size):
+            y1, x1 = min(y0 + tile_size, res), min(x0 + tile_size, res)
+            ya, yb = max(y0 - halo, 0), min(y1 + halo, res)
+            xa, xb = max(x0 - halo, 0), min(x1 + halo, res)
+
+            tile_out = out[:, :, ya:yb, xa:xb]
+            tile_skip = skip[:, :, ya:yb, xa:xb]
+            j = i
+            s = 1
+
+            for conv1, conv2, noise1, noise2, to_rgb in layers:
+                s *= 2
+                window = (
+                    slice(None),
+                    slice(None),
+                    slice(ya * s, yb * s),
+                    slice(xa * s, xb * s),
+                )
+                tile_out = conv1(tile_out, latent[:, j], noise=noise1[window])
+                tile_out = conv2(tile_out, latent[:, j + 1], noise=noise2[window])
+                tile_skip = to_rgb(tile_out, latent[:, j + 2], tile_skip)
+                j += 2
+
+            if image is None:
+                image = tile_skip.new_empty(
+                    tile_skip.shape[0], tile_skip.shape[1], res * scale, res * scale
+                )
+
+            image[:, :, y0 * scale : y1 * scale, x0 * scale : x1 * scale] = tile_skip[
+                :,
+                :,
+                (y0 - ya) * scale : (y1 - ya) * scale,
+                (x0 - xa) * scale : (x1 - xa) * scale,
+            ]
+
+    if hasattr(generator, "iwt"):
+        image = generator.iwt(image)
+
+    return image
+
+
+@torch.no_grad()
+def render(g_ema, seeds, args, device, mean_latent):
+    # latents and noises are keyed by seed, so images do not depend on how the
+    # seeds are split into batches, processes or devices
+    images = []
+    truncation = args.truncation
+
+    if args.truncation_cutoff is not None and args.truncation < 1:
+        # psi 1 leaves every layer untruncated, with or without a cutoff
+        truncation = truncation_schedule(
+            g_ema.n_latent, args.truncation, args.truncation_cutoff
+        )
+
+    batch_size = args.batch
+
+    if args.memory_budget is not None:
+        # micro batches that fit into the budget
+        memory = sample_memory(g_ema, args.tile_from, args.tile_size, args.halo)
+        micro = int(args.memory_budget * 2 ** 20 // memory)
+        batch_size = max(1, min(batch_size, micro))
+
+    for i in range(0, len(seeds), batch_size):
+        batch = seeds[i : i + batch_size]
+        sample_z = seeded_randn(batch, (g_ema.style_dim,), device=device)
+        noise = g_ema.make_noise(seeds=batch)
+
+        if args.tile_from is not None:
+            latent = broadcast_styles([g_ema.style(sample_z)], g_ema.n_latent)
+            latent = truncate(latent, truncation, mean_latent)
+            sample = synthesize_tiled(
+                g_ema, latent, noise, args.tile_from, args.tile_size, args.halo
+            )
+
+        else:
+            sample = g_ema(
+                [sample_z],
+                truncation=truncation,
+                truncation_latent=mean_latent,
+                noise=noise,
+            )[0]
+
+        sample = sample.clamp(-1, 1).add(1).mul(127.5).round().to(torch.uint8)
+        images.append(sample.permute(0, 2, 3, 1).cpu().numpy())
+
+    return np.concatenate(images)
+
+
+def worker(rank, args, units, mean_latent, progress):
+    devices = args.devices.split(",")
+    device = devices[rank % len(devices)]
 
+    if device == "cpu":
+        # split the cores between the cpu workers
+        n_cpu = sum(devices[r % len(devices)] == "cpu" for r in range(args.workers))
+        torch.set_num_threads(max(1, os.cpu_count() // n_cpu))
+
+    g_ema = load_generator(args, device)
+
+    if mean_latent is not None:
+        mean_latent = mean_latent.to(device)
+
+    with ThreadPoolExecutor(args.encoders) as encoders:
+        pending = []
+
+        while True:
+            unit = units.get()
+
+            if unit is None:
+                break
+
+            path, seeds = unit
+            images = render(g_ema, seeds, args, device, mean_latent)
+
+            future = encoders.submit(save_unit, images, seeds, path, args)
+            future.add_done_callback(lambda f, n=len(seeds): progress.put(n))
+            pending.append(future)
+
+            # bound the rendered images waiting for the encoders
+            while len(pending) > 2 * args.encoders:
+                pending.pop(0).result()
+
+        for future in pending:
+            future.result()
+
+
+if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate samples from the generator")
 
     parser.add_argument(
-        "--size", type=int, default=1024, help="output image size of the generator"
+        "--size",
+        type=int,
+        default=None,
+        help="output image size of the generator, read from the checkpoint if not "
+        "given",
     )
     parser.add_argument(
         "--sample",
         type=int,
         default=1,
-        help="number of samples to be generated for each image",
+        help="number of samples per pic, --seeds defaults to pics * sample seeds",
     )
     parser.add_argument(
         "--pics", type=int, default=20, help="number of images to be generated"
     )
+    parser.add_argument(
+        "--seeds",
+        type=str,
+        default=None,
+        help="seeds to render, e.g. 0-9999 or 1,5,7 (inclusive ranges)",
+    )
     parser.add_argument("--truncation", type=float, default=1, help="truncation ratio")
+    parser.add_argument(
+        "--truncation_cutoff",
+        type=int,
+        default=None,
+        help="only truncate the W+ latents before this layer index",
+    )
     parser.add_argument(
         "--truncation_mean",
         type=int,
@@ -59,26 +373,141 @@ if __name__ == "__main__":
     parser.add_argument(
         "--channel_multiplier",
         type=int,
-        default=2,
-        help="channel multiplier of the generator. config-f = 2, else = 1",
+        default=None,
+        help="channel multiplier of the generator. config-f = 2, else = 1. read "
+        "from the checkpoint if not given",
+    )
+    parser.add_argument(
+        "--arch",
+        type=str,
+        default=None,
+        help="model architecture (stylegan2 | swagan), read from the checkpoint if "
+        "not given",
+    )
+    parser.add_argument("--batch", type=int, default=8, help="batch size per worker")
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        default=None,
+        help="memory budget per worker in MB, batches are split into micro batches "
+        "that fit into it",
+    )
+    parser.add_argument(
+        "--tile_from",
+        type=int,
+        default=None,
+        help="render the layers above this resolution in spatial tiles",
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=64,
+        help="tile size in pixels at the --tile_from resolution",
+    )
+    parser.add_argument(
+        "--halo",
+        type=int,
+        default=8,
+        help="overlap of the tiles in pixels at the --tile_from resolution",
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="comma separated devices, e.g. cuda:0,cuda:1 or cpu",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of worker processes, assigned round robin to the devices "
+        "(default: one per device)",
+    )
+    parser.add_argument(
+        "--encoders", type=int, default=4, help="encoder threads per worker"
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="png",
+        choices=list(IMAGE_FORMATS) + list(SHARD_FORMATS),
+        help="image files or packed shards (npz of uint8 arrays, tar of pngs)",
     )
+    parser.add_argument(
+        "--shard_size", type=int, default=256, help="images per npz / tar shard"
+    )
+    parser.add_argument("--quality", type=int, default=95, help="jpg / webp quality")
+    parser.add_argument("--out", type=str, default="output", help="output directory")
 
     args = parser.parse_args()
 
-    args.latent = 512
-    args.n_mlp = 8
+    if args.workers is None:
+        args.workers = len(args.devices.split(","))
+
+    seeds = (
+        parse_seeds(args.seeds)
+        if args.seeds is not None
+        else list(range(args.pics * args.sample))
+    )
+
+    os.makedirs(args.out, exist_ok=True)
+    units = make_units(args, seeds)
+    total = sum(len(unit_seeds) for _, unit_seeds in units)
 
-    g_ema = Generator(
-        args.size, args.latent, args.n_mlp, channel_multiplier=args.channel_multiplier
-    ).to(device)
-    checkpoint = torch.load(args.ckpt)
+    print(f"{len(seeds) - total} of {len(seeds)} seeds already done")
 
-    g_ema.load_state_dict(checkpoint["g_ema"])
+    mean_latent = None
 
     if args.truncation < 1:
+        # computed once so that all workers and devices share the same mean
+        torch.manual_seed(0)
+
         with torch.no_grad():
-            mean_latent = g_ema.mean_latent(args.truncation_mean)
-    else:
-        mean_latent = None
+            mean_latent = load_generator(args, "cpu").mean_latent(args.truncation_mean)
+
+    ctx = mp.get_context("spawn")
+    unit_queue = ctx.Queue()
+    progress = ctx.Queue()
+
+    for unit in units:
+        unit_queue.put(unit)
+
+    for _ in range(args.workers):
+        unit_queue.put(None)
+
+    workers = [
+        ctx.Process(target=worker, args=(rank, args, unit_queue, mean_latent, progress))
+        for rank in range(args.workers)
+    ]
+
+    for process in workers:
+        process.start()
+
+    start = time.perf_counter()
+    done = 0
+
+    with tqdm(total=total) as pbar:
+        while done < total:
+            try:
+                n = progress.get(timeout=1)
+
+            except queue.Empty:
+                if not any(process.is_alive() for process in workers):
+                    break
+
+                continue
+
+            done += n
+            pbar.update(n)
+            pbar.set_postfix(
+                images_per_sec=f"{done / (time.perf_counter() - start):.2f}"
+            )
+
+    for process in workers:
+        process.join()
+
+    elapsed = time.perf_counter() - start
+    print(f"{done} images in {elapsed:.1f}s ({done / max(elapsed, 1e-8):.2f} images/s)")
 
-    generate(args, g_ema, device, mean_latent)
+    if any(process.exitcode != 0 for process in workers):
+        raise SystemExit("some workers failed, rerun to resume the missing seeds")
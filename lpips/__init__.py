@@ -23,21 +23,35 @@ class PerceptualLoss(torch.nn.Module):
         print('...[%s] initialized'%self.model.name())
         print('...Done')
 
-    def forward(self, pred, target, normalize=False):
+    def forward(self, pred, target, normalize=False, target_features=None):
         """
         Pred and target are Variables.
         If normalize is True, assumes the images are between [0,1] and then scales them between [-1,+1]
         If normalize is False, assumes the images are already between [-1,+1]
+        If target_features (from target_features()) are given, target can be None
+        and only pred is run through the network
 
         Inputs pred and target are Nx3xHxW
         Output pytorch Variable N long
         """
 
         if normalize:
-            target = 2 * target  - 1
+            target = 2 * target  - 1 if target is not None else None
             pred = 2 * pred  - 1
 
-        return self.model.forward(target, pred)
+        return self.model.forward(target, pred, feats0=target_features)
+
+    def target_features(self, target, normalize=False):
+        """
+        Features of fixed targets, computed once so that repeated comparisons
+        against them only run the network on pred
+        """
+
+        if normalize:
+            target = 2 * target  - 1
+
+        with torch.no_grad():
+            return self.model.features(target)
 
 def normalize_tensor(in_feat,eps=1e-10):
     norm_factor = torch.sqrt(torch.sum(in_feat**2,dim=1,keepdim=True))
@@ -106,16 +106,27 @@ class DistModel(BaseModel):
             networks.print_network(self.net)
             print('-----------------------------------------------')
 
-    def forward(self, in0, in1, retPerLayer=False):
+    def forward(self, in0, in1, retPerLayer=False, feats0=None):
         ''' Function computes the distance between image patches in0 and in1
         INPUTS
             in0, in1 - torch.Tensor object of shape Nx3xXxY - image patch scaled to [-1,1]
+            feats0 - features(in0) computed beforehand, net-lin and net models only
         OUTPUT
             computed distances between in0 and in1
         '''
 
+        if(feats0 is not None):
+            return self.net.forward(in0, in1, retPerLayer=retPerLayer, feats0=feats0)
+
         return self.net.forward(in0, in1, retPerLayer=retPerLayer)
 
+    def features(self, in0):
+        ''' Normalized network features of in0 (net-lin and net models), can be passed
+        to forward as feats0 when in0 is compared many times '''
+        net = self.net.module if isinstance(self.net, torch.nn.DataParallel) else self.net
+
+        return net.features(in0)
+
     # ***** TRAINING FUNCTIONS *****
     def optimize_parameters(self):
         self.forward_train()
@@ -61,24 +61,32 @@ class PNetLin(nn.Module):
                 self.lin6 = NetLinLayer(self.chns[6], use_dropout=use_dropout)
                 self.lins+=[self.lin5,self.lin6]
 
-    def forward(self, in0, in1, retPerLayer=False):
+    def features(self, in0):
+        # normalized features of in0, e.g. to cache the features of fixed images
         # v0.0 - original release had a bug, where input was not scaled
-        in0_input, in1_input = (self.scaling_layer(in0), self.scaling_layer(in1)) if self.version=='0.1' else (in0, in1)
-        outs0, outs1 = self.net.forward(in0_input), self.net.forward(in1_input)
-        feats0, feats1, diffs = {}, {}, {}
+        in0_input = self.scaling_layer(in0) if self.version=='0.1' else in0
+        outs0 = self.net.forward(in0_input)
+
+        return [util.normalize_tensor(outs0[kk]) for kk in range(self.L)]
+
+    def forward(self, in0, in1, retPerLayer=False, feats0=None):
+        # feats0 are cached features(in0), which skips the in0 branch of the net
+        if(feats0 is None):
+            feats0 = self.features(in0)
+        feats1 = self.features(in1)
+        diffs = {}
 
         for kk in range(self.L):
-            feats0[kk], feats1[kk] = util.normalize_tensor(outs0[kk]), util.normalize_tensor(outs1[kk])
             diffs[kk] = (feats0[kk]-feats1[kk])**2
 
         if(self.lpips):
             if(self.spatial):
-                res = [upsample(self.lins[kk].model(diffs[kk]), out_H=in0.shape[2]) for kk in range(self.L)]
+                res = [upsample(self.lins[kk].model(diffs[kk]), out_H=in1.shape[2]) for kk in range(self.L)]
             else:
                 res = [spatial_average(self.lins[kk].model(diffs[kk]), keepdim=True) for kk in range(self.L)]
         else:
             if(self.spatial):
-                res = [upsample(diffs[kk].sum(dim=1,keepdim=True), out_H=in0.shape[2]) for kk in range(self.L)]
+                res = [upsample(diffs[kk].sum(dim=1,keepdim=True), out_H=in1.shape[2]) for kk in range(self.L)]
             else:
                 res = [spatial_average(diffs[kk].sum(dim=1,keepdim=True), keepdim=True) for kk in range(self.L)]
 
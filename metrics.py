@@ -0,0 +1,421 @@
+import argparse
+import json
+import pickle
+import time
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import lpips
+from calc_inception import load_patched_inception_v3
+from fid import calc_fid
+from generate import load_generator, sample_memory
+from model import truncate
+from ppl import (
+    add_ppl_args,
+    endpoint_latents,
+    filtered_mean,
+    pair_memory,
+    path_distance,
+)
+
+METRICS = ("fid", "kid", "pr", "ppl")
+
+
+class FeatureStats:
+    # running sums of the inception features and their outer products in
+    # float64, so the mean and covariance of any number of samples take
+    # constant memory. The first max_keep features are kept for KID and
+    # precision / recall
+    def __init__(self, max_keep=0):
+        self.max_keep = max_keep
+        self.n = 0
+        self.sum = None
+        self.sum_sq = None
+        self.kept = []
+        self.n_kept = 0
+
+    def update(self, features):
+        if self.n_kept < self.max_keep:
+            keep = features[: self.max_keep - self.n_kept].to("cpu")
+            self.kept.append(keep)
+            self.n_kept += keep.shape[0]
+
+        features = features.double()
+
+        if self.sum is None:
+            self.sum = features.new_zeros(features.shape[1])
+            self.sum_sq = features.new_zeros(features.shape[1], features.shape[1])
+
+        self.n += features.shape[0]
+        self.sum += features.sum(0)
+        self.sum_sq += features.T @ features
+
+    def mean_cov(self):
+        mean = self.sum / self.n
+        cov = (self.sum_sq - self.n * torch.outer(mean, mean)) / (self.n - 1)
+
+        return mean.cpu().numpy(), cov.cpu().numpy()
+
+    def features(self):
+        return torch.cat(self.kept, 0)
+
+
+def calc_kid(real, fake, n_subsets=100, subset_size=1000, seed=0):
+    # unbiased MMD^2 with the cubic polynomial kernel, averaged over random
+    # subsets (Binkowski et al., https://arxiv.org/abs/1801.01401)
+    rng = np.random.RandomState(seed)
+    real = real.astype(np.float64)
+    fake = fake.astype(np.float64)
+    dim = real.shape[1]
+    m = min(real.shape[0], fake.shape[0], subset_size)
+    mmds = np.zeros(n_subsets)
+
+    for i in range(n_subsets):
+        x = fake[rng.choice(fake.shape[0], m, replace=False)]
+        y = real[rng.choice(real.shape[0], m, replace=False)]
+        a = (x @ x.T / dim + 1) ** 3 + (y @ y.T / dim + 1) ** 3
+        b = (x @ y.T / dim + 1) ** 3
+        mmds[i] = ((a.sum() - np.diag(a).sum()) / (m - 1) - b.sum() * 2 / m) / m
+
+    return mmds.mean(), mmds.std()
+
+
+def knn_radii(features, k, block=1024):
+    # distance of every feature to its k-th nearest neighbour, in row blocks
+    radii = []
+
+    for start in range(0, features.shape[0], block):
+        dist = torch.cdist(features[start : start + block], features)
+        # the nearest one is the feature itself
+        radii.append(dist.kthvalue(k + 1, dim=1).values)
+
+    return torch.cat(radii, 0)
+
+
+def coverage(query, reference, radii, block=1024):
+    # fraction of query features within the k-NN ball of any reference feature
+    inside = 0
+
+    for start in range(0, query.shape[0], block):
+        dist = torch.cdist(query[start : start + block], reference)
+        inside += (dist <= radii.unsqueeze(0)).any(1).sum().item()
+
+    return inside / query.shape[0]
+
+
+def calc_precision_recall(real, fake, k=3, block=1024):
+    # improved precision and recall (Kynkaanniemi et al.,
+    # https://arxiv.org/abs/1904.06991) on the inception features
+    precision = coverage(fake, real, knn_radii(real, k, block), block)
+    recall = coverage(real, fake, knn_radii(fake, k, block), block)
+
+    return precision, recall
+
+
+def image_memory(g, ppl=False, crop=False):
+    # rough peak bytes per image: the generator forward, inception, whose
+    # first layers hold 64 channel maps of 147px, and LPIPS-VGG for paths
+    peak = max(sample_memory(g), 4 * 3 * 64 * 147 ** 2)
+
+    if ppl:
+        peak = max(peak, pair_memory(g, crop) // 2)
+
+    return peak
+
+
+@torch.no_grad()
+def evaluate(g, inception, percept, args, device, mean_latent=None):
+    # a single generation pass: every batch holds the endpoints of PPL paths
+    # and plain samples, and the images are fanned out to the inception
+    # statistics and the path distances. With endpoint sampling and no
+    # truncation the first endpoint of a path also is a sample
+    n_path = args.ppl_sample if percept is not None else 0
+    n_feature = args.n_sample if inception is not None else 0
+    share = args.sampling == "end" and args.truncation >= 1
+
+    batch = args.batch
+
+    if args.memory_budget is not None:
+        memory = image_memory(g, percept is not None, args.crop)
+        batch = min(batch, int(args.memory_budget * 2 ** 20 // memory))
+
+    batch = max(batch, 2)
+
+    stats = None
+
+    if inception is not None:
+        stats = FeatureStats(args.n_features if {"kid", "pr"} & args.metrics else 0)
+
+    distances = []
+    paths = features = images = 0
+    n_image = 2 * n_path + max(n_feature - (n_path if share else 0), 0)
+    start = time.perf_counter()
+
+    with tqdm(total=n_image) as pbar:
+        while paths < n_path or features < n_feature:
+            pairs = min(n_path - paths, batch // 2)
+            shared = min(pairs, n_feature - features) if share else 0
+            extra = min(n_feature - features - shared, batch - 2 * pairs)
+            latents = []
+
+            if pairs > 0:
+                latents.append(
+                    endpoint_latents(
+                        g, pairs, args.space, args.eps, args.sampling, device
+                    )
+                )
+
+            if extra > 0:
+                z = torch.randn(extra, g.style_dim, device=device)
+                latents.append(truncate(g.get_latent(z), args.truncation, mean_latent))
+
+            # per sample noises, the endpoints of a path share theirs
+            noise = [
+                torch.cat([n[:pairs], n])
+                for n in g.noise_pool(pairs + extra, torch.device(device))
+            ]
+            image, _, _ = g([torch.cat(latents, 0)], input_is_latent=True, noise=noise)
+
+            if pairs > 0:
+                dist = path_distance(percept, image[: 2 * pairs], args.eps, args.crop)
+                distances.append(dist.to("cpu").numpy())
+
+            if shared + extra > 0:
+                samples = torch.cat([image[:shared], image[2 * pairs :]], 0)
+                stats.update(inception(samples)[0].view(samples.shape[0], -1))
+
+            paths += pairs
+            features += shared + extra
+            images += image.shape[0]
+            pbar.update(image.shape[0])
+
+    elapsed = time.perf_counter() - start
+
+    report = {"images": images, "seconds": elapsed, "images_per_sec": images / elapsed}
+
+    if percept is not None:
+        distances = np.concatenate(distances, 0)
+
+    return stats, distances, report
+
+
+def fid_metric(stats, embeds, args):
+    sample_mean, sample_cov = stats.mean_cov()
+    fid = calc_fid(sample_mean, sample_cov, embeds["mean"], embeds["cov"])
+
+    return {"fid": float(fid)}
+
+
+def kid_metric(stats, embeds, args):
+    kid, kid_std = calc_kid(
+        embeds["features"],
+        stats.features().numpy(),
+        args.kid_subsets,
+        args.kid_subset_size,
+        args.seed,
+    )
+
+    return {"kid": float(kid), "kid_std": float(kid_std)}
+
+
+def pr_metric(stats, embeds, args):
+    precision, recall = calc_precision_recall(
+        torch.from_numpy(embeds["features"]).float().to(args.device),
+        stats.features().float().to(args.device),
+        args.pr_k,
+    )
+
+    return {"precision": precision, "recall": recall}
+
+
+def summarize(stats, distances, embeds, args):
+    # every metric of the pass on its own, a failing metric is reported in
+    # errors and does not lose the others
+    report = {}
+    errors = {}
+    metrics = {
+        "fid": lambda: fid_metric(stats, embeds, args),
+        "kid": lambda: kid_metric(stats, embeds, args),
+        "pr": lambda: pr_metric(stats, embeds, args),
+        "ppl": lambda: {"ppl": float(filtered_mean(distances))},
+    }
+
+    for name in METRICS:
+        if name not in args.metrics:
+            continue
+
+        try:
+            report.update(metrics[name]())
+
+        except Exception as e:
+            errors[name] = f"{type(e).__name__}: {e}"
+            print(f"{name} failed: {errors[name]}")
+
+    if errors:
+        report["errors"] = errors
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Calculate FID, KID, precision / recall and PPL in one "
+        "generation pass"
+    )
+
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default="fid,kid,pr,ppl",
+        help="comma separated metrics (fid | kid | pr | ppl)",
+    )
+    parser.add_argument(
+        "--inception",
+        type=str,
+        default=None,
+        help="path to precomputed inception embedding (calc_inception.py), KID "
+        "and precision / recall need one with --n_features",
+    )
+    parser.add_argument(
+        "--n_sample",
+        type=int,
+        default=50000,
+        help="number of samples for FID",
+    )
+    parser.add_argument(
+        "--n_features",
+        type=int,
+        default=10000,
+        help="number of sample features kept for KID and precision / recall",
+    )
+    parser.add_argument(
+        "--ppl_sample", type=int, default=5000, help="number of paths for PPL"
+    )
+    parser.add_argument(
+        "--kid_subsets", type=int, default=100, help="number of KID subsets"
+    )
+    parser.add_argument(
+        "--kid_subset_size", type=int, default=1000, help="size of KID subsets"
+    )
+    parser.add_argument(
+        "--pr_k",
+        type=int,
+        default=3,
+        help="nearest neighbour of the manifold radii of precision / recall",
+    )
+    parser.add_argument(
+        "--batch", type=int, default=64, help="images per generator forward"
+    )
+    parser.add_argument(
+        "--truncation",
+        type=float,
+        default=1,
+        help="truncation factor of the samples, PPL paths are never truncated",
+    )
+    parser.add_argument(
+        "--truncation_mean",
+        type=int,
+        default=4096,
+        help="number of vectors to calculate mean for the truncation",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--out", type=str, default="metrics.json", help="path to the json report"
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=None,
+        help="output image sizes of the generator, read from the checkpoint if not "
+        "given",
+    )
+    parser.add_argument(
+        "--channel_multiplier",
+        type=int,
+        default=None,
+        help="channel multiplier of the generator. config-f = 2, else = 1. read "
+        "from the checkpoint if not given",
+    )
+    parser.add_argument(
+        "--arch",
+        type=str,
+        default=None,
+        help="model architecture (stylegan2 | swagan), read from the checkpoint if "
+        "not given",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="device to run the models",
+    )
+    add_ppl_args(parser)
+    parser.add_argument(
+        "--ckpt", type=str, required=True, help="path to the checkpoint"
+    )
+
+    args = parser.parse_args()
+
+    args.metrics = set(args.metrics.split(","))
+
+    unknown = args.metrics - set(METRICS)
+
+    if unknown:
+        parser.error(f"unknown metrics {', '.join(sorted(unknown))}")
+
+    embeds = None
+
+    if args.metrics & {"fid", "kid", "pr"}:
+        if args.inception is None:
+            parser.error("fid, kid and pr need --inception")
+
+        with open(args.inception, "rb") as f:
+            embeds = pickle.load(f)
+
+        if args.metrics & {"kid", "pr"} and "features" not in embeds:
+            parser.error(
+                f"{args.inception} has no features for kid and pr, rerun "
+                "calc_inception.py with --n_features"
+            )
+
+    device = args.device
+    torch.manual_seed(args.seed)
+
+    g = load_generator(args, device)
+
+    mean_latent = None
+
+    if args.truncation < 1:
+        with torch.no_grad():
+            mean_latent = g.mean_latent(args.truncation_mean)
+
+    inception = None
+
+    if embeds is not None:
+        inception = load_patched_inception_v3().to(device).eval()
+
+    percept = None
+
+    if "ppl" in args.metrics:
+        percept = lpips.PerceptualLoss(
+            model="net-lin", net="vgg", use_gpu=device.startswith("cuda")
+        )
+
+    stats, distances, report = evaluate(
+        g, inception, percept, args, device, mean_latent
+    )
+    report.update(summarize(stats, distances, embeds, args))
+
+    args.metrics = sorted(args.metrics)
+    report = {"ckpt": args.ckpt, "args": vars(args), **report}
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name in ("fid", "kid", "precision", "recall", "ppl"):
+        if name in report:
+            print(f"{name}: {report[name]}")
+
+    print(f"{report['images']} images, {report['images_per_sec']:.2f} images/s")
@@ -8,7 +8,23 @@ from torch import nn
 from torch.nn import functional as F
 from torch.autograd import Function
 
-from op import FusedLeakyReLU, fused_leaky_relu, upfirdn2d, conv2d_gradfix
+from op import (
+    FusedLeakyReLU,
+    fused_leaky_relu,
+    upfirdn2d,
+    conv2d_gradfix,
+    is_channels_last,
+)
+
+
+def to_channels_last(module):
+    # module.to(memory_format=torch.channels_last) fails on the 5D weights of
+    # ModulatedConv2d, so only the 4D parameters are converted, in place
+    for param in module.parameters():
+        if param.ndim == 4:
+            param.data = param.data.contiguous(memory_format=torch.channels_last)
+
+    return module
 
 
 class PixelNorm(nn.Module):
@@ -217,6 +233,9 @@ class ModulatedConv2d(nn.Module):
         self.demodulate = demodulate
         self.fused = fused
 
+        # per input channel gates used for structured pruning, see prune.py
+        self.register_parameter("gate", None)
+
     def __repr__(self):
         return (
             f"{self.__class__.__name__}({self.in_channel}, {self.out_channel}, {self.kernel_size}, "
@@ -226,14 +245,22 @@ class ModulatedConv2d(nn.Module):
     def forward(self, input, style):
         batch, in_channel, height, width = input.shape
 
-        if not self.fused:
-            weight = self.scale * self.weight.squeeze(0)
-            style = self.modulation(style)
+        style = self.modulation(style)
 
-            if self.demodulate:
-                w = weight.unsqueeze(0) * style.view(batch, 1, in_channel, 1, 1)
-                dcoefs = (w.square().sum((2, 3, 4)) + 1e-8).rsqrt()
+        if self.gate is not None:
+            style = style * self.gate
 
+        if self.demodulate:
+            # sum over (in, kh, kw) of the squared modulated weight, taken from
+            # the kernel summed squared weight instead of a batch sized tensor
+            weight_sq = self.weight.square().sum([3, 4]).squeeze(0)
+            demod = style.square() @ weight_sq.t() * self.scale ** 2
+            demod = torch.rsqrt(demod + 1e-8)
+
+        # the grouped conv of the fused path needs contiguous NCHW input, other
+        # layouts (e.g. channels_last) use the equivalent per sample scaling
+        if not self.fused or not input.is_contiguous():
+            weight = self.scale * self.weight.squeeze(0)
             input = input * style.reshape(batch, in_channel, 1, 1)
 
             if self.upsample:
@@ -251,15 +278,14 @@ class ModulatedConv2d(nn.Module):
                 out = conv2d_gradfix.conv2d(input, weight, padding=self.padding)
 
             if self.demodulate:
-                out = out * dcoefs.view(batch, -1, 1, 1)
+                out = out * demod.view(batch, -1, 1, 1)
 
             return out
 
-        style = self.modulation(style).view(batch, 1, in_channel, 1, 1)
-        weight = self.scale * self.weight * style
+        style = style.view(batch, 1, in_channel, 1, 1)
+        weight = self.weight * (self.scale * style)
 
         if self.demodulate:
-            demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + 1e-8)
             weight = weight * demod.view(batch, self.out_channel, 1, 1, 1)
 
         weight = weight.view(
@@ -323,10 +349,127 @@ class ConstantInput(nn.Module):
         self.input = nn.Parameter(torch.randn(1, channel, size, size))
 
     def forward(self, input):
-        batch = input.shape[0]
-        out = self.input.repeat(batch, 1, 1, 1)
+        # broadcast view, the first modulated conv materializes it anyway
+        return self.input.expand(input.shape[0], -1, -1, -1)
 
-        return out
+
+class NoisePool:
+    # per layer noises for randomize_noise, drawn with a single normal_() into
+    # one flat buffer. Without autograd the buffer is kept per device / dtype
+    # and reused for every batch size up to its size; with autograd a fresh
+    # one is needed, as NoiseInjection saves the noise for its weight gradient
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.buffers = {}
+
+    def __call__(self, batch, device, dtype=torch.float32, n_layers=None):
+        sizes = self.sizes[:n_layers]
+        numel = batch * sum(size * size for size in sizes)
+
+        if torch.is_grad_enabled():
+            flat = torch.randn(numel, device=device, dtype=dtype)
+
+        else:
+            flat = self.buffers.get((device, dtype))
+
+            if flat is None or flat.numel() < numel:
+                flat = torch.empty(numel, device=device, dtype=dtype)
+                self.buffers[(device, dtype)] = flat
+
+            flat = flat[:numel].normal_()
+
+        noises = []
+        offset = 0
+
+        for size in sizes:
+            n = batch * size * size
+            noises.append(flat[offset : offset + n].view(batch, 1, size, size))
+            offset += n
+
+        return noises
+
+
+# streams per seed of seeded_randn(): 0 for the latent code, 1 + layer index
+# for the noise of each layer (up to 31 layers, 2048px has 19)
+SEED_STREAMS = 32
+
+
+def seeded_randn(seeds, shape, stream=0, device="cpu", dtype=torch.float32):
+    # counter based sampling: every (seed, stream) pair keys its own generator,
+    # so a sample is reproducible in any batch composition and any layer can
+    # be drawn without replaying the others. Values are always drawn on CPU
+    # (CUDA generators use Philox), so a seed gives the same sample on every
+    # device
+    out = torch.empty(len(seeds), *shape, dtype=torch.float32)
+
+    for i, seed in enumerate(seeds):
+        rng = torch.Generator()
+        rng.manual_seed(int(seed) * SEED_STREAMS + stream)
+        out[i].normal_(generator=rng)
+
+    return out.to(device=device, dtype=dtype)
+
+
+def truncation_schedule(n_latent, psi, cutoff=None):
+    # per W+ index psi, indices from cutoff on are left untruncated
+    schedule = torch.full((n_latent,), float(psi))
+
+    if cutoff is not None:
+        schedule[cutoff:] = 1
+
+    return schedule
+
+
+def truncate(latent, truncation, truncation_latent):
+    # one broadcast lerp on the W+ latent. truncation is a float, a (n_latent,)
+    # per layer schedule, or (batch, 1) / (batch, n_latent) per sample values
+    if not torch.is_tensor(truncation):
+        if truncation >= 1:
+            return latent
+
+        return torch.lerp(truncation_latent.expand_as(latent), latent, truncation)
+
+    psi = truncation.to(latent)
+
+    if psi.ndim == 1:
+        psi = psi.view(1, -1, 1)
+
+    else:
+        psi = psi.unsqueeze(2)
+
+    return torch.lerp(truncation_latent.expand_as(latent), latent, psi)
+
+
+def preview_layers(num_layers, size, preview_size):
+    # synthesis layers up to the early exit at preview_size, every upsampling
+    # block doubles the resolution with two layers
+    sizes = [size >> i for i in range((num_layers - 1) // 2 + 1)]
+
+    if preview_size not in sizes:
+        raise ValueError(
+            f"preview_size must be a power of 2 between {sizes[-1]} and {size}, "
+            f"got {preview_size}"
+        )
+
+    return num_layers - 2 * sizes.index(preview_size)
+
+
+def broadcast_styles(styles, n_latent, inject_index=None):
+    # W+ latent as an expanded view of a single style, style mixing needs one
+    # torch.cat of two expanded views instead of two repeats and a cat
+    if len(styles) < 2:
+        if styles[0].ndim < 3:
+            return styles[0].unsqueeze(1).expand(-1, n_latent, -1)
+
+        return styles[0]
+
+    if inject_index is None:
+        inject_index = random.randint(1, n_latent - 1)
+
+    latent = styles[0].unsqueeze(1).expand(-1, inject_index, -1)
+    latent2 = styles[1].unsqueeze(1).expand(-1, n_latent - inject_index, -1)
+
+    return torch.cat([latent, latent2], 1)
 
 
 class StyledConv(nn.Module):
@@ -448,6 +591,10 @@ class Generator(nn.Module):
             shape = [1, 1, 2 ** res, 2 ** res]
             self.noises.register_buffer(f"noise_{layer_idx}", torch.randn(*shape))
 
+        self.noise_pool = NoisePool(
+            [2 ** ((layer_idx + 5) // 2) for layer_idx in range(self.num_layers)]
+        )
+
         for i in range(3, self.log_size + 1):
             out_channel = self.channels[2 ** i]
 
@@ -474,9 +621,16 @@ class Generator(nn.Module):
 
         self.n_latent = self.log_size * 2 - 2
 
-    def make_noise(self):
+    def make_noise(self, seeds=None):
         device = self.input.input.device
 
+        if seeds is not None:
+            # one (len(seeds), 1, size, size) noise per layer, see seeded_randn
+            return [
+                seeded_randn(seeds, (1, size, size), i + 1, device)
+                for i, size in enumerate(self.noise_pool.sizes)
+            ]
+
         noises = [torch.randn(1, 1, 2 ** 2, 2 ** 2, device=device)]
 
         for i in range(3, self.log_size + 1):
@@ -507,45 +661,31 @@ class Generator(nn.Module):
         input_is_latent=False,
         noise=None,
         randomize_noise=True,
+        preview_size=None,
     ):
         if not input_is_latent:
             styles = [self.style(s) for s in styles]
 
+        # early exit: synthesis stops after the layers of preview_size (a power
+        # of 2 up to size) and the RGB skip at that resolution is returned
+        n_layers = self.num_layers
+
+        if preview_size is not None:
+            n_layers = preview_layers(self.num_layers, self.size, preview_size)
+
         if noise is None:
             if randomize_noise:
-                noise = [None] * self.num_layers
+                noise = self.noise_pool(
+                    styles[0].shape[0], styles[0].device, styles[0].dtype, n_layers
+                )
             else:
                 noise = [
                     getattr(self.noises, f"noise_{i}") for i in range(self.num_layers)
                 ]
 
-        if truncation < 1:
-            style_t = []
-
-            for style in styles:
-                style_t.append(
-                    truncation_latent + truncation * (style - truncation_latent)
-                )
-
-            styles = style_t
-
-        if len(styles) < 2:
-            inject_index = self.n_latent
-
-            if styles[0].ndim < 3:
-                latent = styles[0].unsqueeze(1).repeat(1, inject_index, 1)
-
-            else:
-                latent = styles[0]
-
-        else:
-            if inject_index is None:
-                inject_index = random.randint(1, self.n_latent - 1)
-
-            latent = styles[0].unsqueeze(1).repeat(1, inject_index, 1)
-            latent2 = styles[1].unsqueeze(1).repeat(1, self.n_latent - inject_index, 1)
-
-            latent = torch.cat([latent, latent2], 1)
+        noise = noise[:n_layers]
+        latent = broadcast_styles(styles, self.n_latent, inject_index)
+        latent = truncate(latent, truncation, truncation_latent)
 
         out = self.input(latent)
         out = self.conv1(out, latent[:, 0], noise=noise[0])
@@ -690,12 +830,29 @@ class Discriminator(nn.Module):
         stddev = torch.sqrt(stddev.var(0, unbiased=False) + 1e-8)
         stddev = stddev.mean([2, 3, 4], keepdims=True).squeeze(2)
         stddev = stddev.repeat(group, 1, height, width)
+
+        if is_channels_last(out):
+            # torch.cat falls back to NCHW unless all inputs share the layout
+            stddev = stddev.contiguous(memory_format=torch.channels_last)
+
         out = torch.cat([out, stddev], 1)
 
         out = self.final_conv(out)
 
-        out = out.view(batch, -1)
+        # flattened in NCHW order as expected by final_linear
+        out = out.reshape(batch, -1)
         out = self.final_linear(out)
 
         return out
 
+
+def generator_class(arch):
+    if arch == "swagan":
+        from swagan import Generator as SWAGANGenerator
+
+        return SWAGANGenerator
+
+    if arch != "stylegan2":
+        raise ValueError(f"unknown architecture {arch}, expected stylegan2 or swagan")
+
+    return Generator
@@ -1,2 +1,3 @@
 from .fused_act import FusedLeakyReLU, fused_leaky_relu
 from .upfirdn2d import upfirdn2d
+from .native import native_ops, set_native_ops, is_channels_last
@@ -1,4 +1,5 @@
 import os
+import warnings
 
 import torch
 from torch import nn
@@ -6,15 +7,25 @@ from torch.nn import functional as F
 from torch.autograd import Function
 from torch.utils.cpp_extension import load
 
+from . import native
+
 
 module_path = os.path.dirname(__file__)
-fused = load(
-    "fused",
-    sources=[
-        os.path.join(module_path, "fused_bias_act.cpp"),
-        os.path.join(module_path, "fused_bias_act_kernel.cu"),
-    ],
-)
+
+try:
+    fused = load(
+        "fused",
+        sources=[
+            os.path.join(module_path, "fused_bias_act.cpp"),
+            os.path.join(module_path, "fused_bias_act_kernel.cu"),
+        ],
+    )
+
+except Exception as e:
+    warnings.warn(
+        f"fused_bias_act extension could not be built ({e}). Falling back to native ops."
+    )
+    fused = None
 
 
 class FusedLeakyReLUFunctionBackward(Function):
@@ -108,7 +119,14 @@ class FusedLeakyReLU(nn.Module):
 
 
 def fused_leaky_relu(input, bias=None, negative_slope=0.2, scale=2 ** 0.5):
-    if input.device.type == "cpu":
+    # the CUDA kernel only takes contiguous NCHW, the native path keeps the
+    # memory format of the input (e.g. channels_last)
+    if (
+        native.enabled
+        or fused is None
+        or input.device.type == "cpu"
+        or not input.is_contiguous()
+    ):
         if bias is not None:
             rest_dim = [1] * (input.ndim - bias.ndim - 1)
             return (
@@ -122,6 +140,4 @@ def fused_leaky_relu(input, bias=None, negative_slope=0.2, scale=2 ** 0.5):
             return F.leaky_relu(input, negative_slope=0.2) * scale
 
     else:
-        return FusedLeakyReLUFunction.apply(
-            input.contiguous(), bias, negative_slope, scale
-        )
+        return FusedLeakyReLUFunction.apply(input, bias, negative_slope, scale)
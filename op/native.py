@@ -0,0 +1,34 @@
+import contextlib
+
+from . import conv2d_gradfix
+
+enabled = False
+
+
+def set_native_ops(flag=True):
+    # route upfirdn2d, fused_leaky_relu and conv2d_gradfix through plain ATen
+    # ops, e.g. for tracing, scripting, ONNX export or torch.compile
+    global enabled
+
+    enabled = flag
+    conv2d_gradfix.enabled = not flag
+
+
+def is_channels_last(input):
+    # channel dim is innermost, also true for channel slices of channels_last
+    # tensors (e.g. chunk() in swagan), which is_contiguous() does not cover
+    return input.ndim == 4 and input.shape[1] > 1 and input.stride(1) < input.stride(3)
+
+
+@contextlib.contextmanager
+def native_ops():
+    old = enabled
+    old_gradfix = conv2d_gradfix.enabled
+    set_native_ops(True)
+
+    try:
+        yield
+
+    finally:
+        set_native_ops(old)
+        conv2d_gradfix.enabled = old_gradfix
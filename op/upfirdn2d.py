@@ -1,20 +1,31 @@
 from collections import abc
 import os
+import warnings
 
 import torch
 from torch.nn import functional as F
 from torch.autograd import Function
 from torch.utils.cpp_extension import load
 
+from . import native
+
 
 module_path = os.path.dirname(__file__)
-upfirdn2d_op = load(
-    "upfirdn2d",
-    sources=[
-        os.path.join(module_path, "upfirdn2d.cpp"),
-        os.path.join(module_path, "upfirdn2d_kernel.cu"),
-    ],
-)
+
+try:
+    upfirdn2d_op = load(
+        "upfirdn2d",
+        sources=[
+            os.path.join(module_path, "upfirdn2d.cpp"),
+            os.path.join(module_path, "upfirdn2d_kernel.cu"),
+        ],
+    )
+
+except Exception as e:
+    warnings.warn(
+        f"upfirdn2d extension could not be built ({e}). Falling back to native ops."
+    )
+    upfirdn2d_op = None
 
 
 class UpFirDn2dBackward(Function):
@@ -156,7 +167,14 @@ def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
     if len(pad) == 2:
         pad = (pad[0], pad[1], pad[0], pad[1])
 
-    if input.device.type == "cpu":
+    # as in fused_leaky_relu, non contiguous NCHW input (e.g. channels_last)
+    # takes the native path instead of being copied to NCHW
+    if (
+        native.enabled
+        or upfirdn2d_op is None
+        or input.device.type == "cpu"
+        or not input.is_contiguous()
+    ):
         out = upfirdn2d_native(input, kernel, *up, *down, *pad)
 
     else:
@@ -168,42 +186,38 @@ def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
 def upfirdn2d_native(
     input, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1
 ):
-    _, channel, in_h, in_w = input.shape
-    input = input.reshape(-1, in_h, in_w, 1)
-
-    _, in_h, in_w, minor = input.shape
+    # stays in NCHW: zero insertion, padding and a strided depthwise conv, so
+    # that the op is traceable by torch.jit / torch.compile without reshapes
+    # to (N * C, H, W, 1)
+    batch, channel, in_h, in_w = input.shape
     kernel_h, kernel_w = kernel.shape
 
-    out = input.view(-1, in_h, 1, in_w, 1, minor)
-    out = F.pad(out, [0, 0, 0, up_x - 1, 0, 0, 0, up_y - 1])
-    out = out.view(-1, in_h * up_y, in_w * up_x, minor)
+    out = input
+
+    if (up_x > 1 or up_y > 1) and native.is_channels_last(input):
+        # zero insertion on the NHWC view keeps channels_last without a copy
+        out = out.permute(0, 2, 3, 1).reshape(batch, in_h, 1, in_w, 1, channel)
+        out = F.pad(out, [0, 0, 0, up_x - 1, 0, 0, 0, up_y - 1])
+        out = out.reshape(batch, in_h * up_y, in_w * up_x, channel)
+        out = out.permute(0, 3, 1, 2)
+
+    elif up_x > 1 or up_y > 1:
+        out = out.reshape(batch, channel, in_h, 1, in_w, 1)
+        out = F.pad(out, [0, up_x - 1, 0, 0, 0, up_y - 1])
+        out = out.reshape(batch, channel, in_h * up_y, in_w * up_x)
 
     out = F.pad(
-        out, [0, 0, max(pad_x0, 0), max(pad_x1, 0), max(pad_y0, 0), max(pad_y1, 0)]
+        out, [max(pad_x0, 0), max(pad_x1, 0), max(pad_y0, 0), max(pad_y1, 0)]
     )
     out = out[
         :,
-        max(-pad_y0, 0) : out.shape[1] - max(-pad_y1, 0),
-        max(-pad_x0, 0) : out.shape[2] - max(-pad_x1, 0),
         :,
+        max(-pad_y0, 0) : out.shape[2] - max(-pad_y1, 0),
+        max(-pad_x0, 0) : out.shape[3] - max(-pad_x1, 0),
     ]
 
-    out = out.permute(0, 3, 1, 2)
-    out = out.reshape(
-        [-1, 1, in_h * up_y + pad_y0 + pad_y1, in_w * up_x + pad_x0 + pad_x1]
-    )
     w = torch.flip(kernel, [0, 1]).view(1, 1, kernel_h, kernel_w)
-    out = F.conv2d(out, w)
-    out = out.reshape(
-        -1,
-        minor,
-        in_h * up_y + pad_y0 + pad_y1 - kernel_h + 1,
-        in_w * up_x + pad_x0 + pad_x1 - kernel_w + 1,
-    )
-    out = out.permute(0, 2, 3, 1)
-    out = out[:, ::down_y, ::down_x, :]
-
-    out_h = (in_h * up_y + pad_y0 + pad_y1 - kernel_h + down_y) // down_y
-    out_w = (in_w * up_x + pad_x0 + pad_x1 - kernel_w + down_x) // down_x
+    w = w.expand(channel, 1, kernel_h, kernel_w).to(out.dtype)
+    out = F.conv2d(out, w, stride=(down_y, down_x), groups=channel)
 
-    return out.view(-1, channel, out_h, out_w)
+    return out
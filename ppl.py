@@ -1,4 +1,5 @@
 import argparse
+import time
 
 import torch
 from torch.nn import functional as F
@@ -6,7 +7,8 @@ import numpy as np
 from tqdm import tqdm
 
 import lpips
-from model import Generator
+from checkpoint import load_checkpoint, build_generator
+from generate import sample_memory
 
 
 def normalize(x):
@@ -28,14 +30,141 @@ def lerp(a, b, t):
     return a + (b - a) * t
 
 
-if __name__ == "__main__":
-    device = "cuda"
+def endpoint_latents(g, batch, space, eps, sampling, device):
+    # W latents of both endpoints of batch paths: z paths are interpolated with
+    # slerp before the mapping, w paths with lerp after it. Both endpoints are
+    # mapped in a single call
+    inputs = torch.randn(2, batch, g.style_dim, device=device)
 
-    parser = argparse.ArgumentParser(description="Perceptual Path Length calculator")
+    if sampling == "full":
+        lerp_t = torch.rand(batch, 1, device=device)
+
+    else:
+        lerp_t = torch.zeros(batch, 1, device=device)
+
+    if space == "w":
+        latent = g.get_latent(inputs.view(2 * batch, -1)).view(2, batch, -1)
+
+        return torch.cat(
+            [
+                lerp(latent[0], latent[1], lerp_t),
+                lerp(latent[0], latent[1], lerp_t + eps),
+            ]
+        )
+
+    latent = torch.cat(
+        [
+            slerp(inputs[0], inputs[1], lerp_t),
+            slerp(inputs[0], inputs[1], lerp_t + eps),
+        ]
+    )
+
+    return g.get_latent(latent)
+
+
+def pair_memory(g, crop=False):
+    # rough peak bytes of a path: generator forward of both endpoints, then
+    # LPIPS-VGG, whose first layers hold 64 channel maps of the compared images
+    size = min(g.size // 2 if crop else g.size, 256)
+
+    return 2 * max(sample_memory(g), 4 * 4 * 64 * size ** 2)
+
+
+def path_distance(percept, image, eps, crop=False):
+    # scaled LPIPS distances of paths, image holds the first endpoints of all
+    # paths followed by the second endpoints
+    pairs = image.shape[0] // 2
+
+    if crop:
+        c = image.shape[2] // 8
+        image = image[:, :, c * 3 : c * 7, c * 2 : c * 6]
+
+    if image.shape[2] > 256:
+        image = F.interpolate(
+            image, size=(256, 256), mode="bilinear", align_corners=False
+        )
+
+    return percept(image[:pairs], image[pairs:]).view(pairs) / (eps ** 2)
+
+
+@torch.no_grad()
+def path_distances(g, percept, n_sample, batch, args, device, memory_budget=None):
+    # streams batches of paths and yields their scaled LPIPS distances. The
+    # endpoints of a path share their noises and run in the same forward,
+    # micro batches keep a forward within memory_budget MB
+    if memory_budget is not None:
+        micro = int(memory_budget * 2 ** 20 // pair_memory(g, args.crop))
+        batch = max(1, min(batch, micro))
+
+    for start in range(0, n_sample, batch):
+        pairs = min(batch, n_sample - start)
+        latent = endpoint_latents(g, pairs, args.space, args.eps, args.sampling, device)
+        noise = g.make_noise()
+        image, _, _ = g([latent], input_is_latent=True, noise=noise)
+        dist = path_distance(percept, image, args.eps, args.crop)
+
+        yield dist.to("cpu").numpy()
 
+
+def filtered_mean(distances):
+    # mean without the lowest and highest percentile
+    lo = np.percentile(distances, 1, method="lower")
+    hi = np.percentile(distances, 99, method="higher")
+    filtered_dist = np.extract(
+        np.logical_and(lo <= distances, distances <= hi), distances
+    )
+
+    return filtered_dist.mean()
+
+
+def compute_ppl(g, percept, args, device):
+    distances = []
+    start = time.perf_counter()
+
+    with tqdm(total=args.n_sample) as pbar:
+        for dist in path_distances(
+            g, percept, args.n_sample, args.batch, args, device, args.memory_budget
+        ):
+            distances.append(dist)
+            pbar.update(len(dist))
+
+    elapsed = time.perf_counter() - start
+    distances = np.concatenate(distances, 0)
+
+    return filtered_mean(distances), len(distances) / elapsed
+
+
+def add_ppl_args(parser):
+    parser.add_argument(
+        "--space",
+        choices=["z", "w"],
+        default="w",
+        help="space that PPL calculated with",
+    )
+    parser.add_argument(
+        "--eps", type=float, default=1e-4, help="epsilon for numerical stability"
+    )
     parser.add_argument(
-        "--space", choices=["z", "w"], help="space that PPL calculated with"
+        "--crop", action="store_true", help="apply center crop to the images"
+    )
+    parser.add_argument(
+        "--sampling",
+        default="end",
+        choices=["end", "full"],
+        help="set endpoint sampling method",
     )
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        default=None,
+        help="approximate memory in MB of a forward, larger batches are split "
+        "into micro batches",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Perceptual Path Length calculator")
+
     parser.add_argument(
         "--batch", type=int, default=64, help="batch size for the models"
     )
@@ -46,85 +175,54 @@ if __name__ == "__main__":
         help="number of the samples for calculating PPL",
     )
     parser.add_argument(
-        "--size", type=int, default=256, help="output image sizes of the generator"
+        "--size",
+        type=int,
+        default=None,
+        help="output image sizes of the generator, read from the checkpoint if not "
+        "given",
     )
     parser.add_argument(
-        "--eps", type=float, default=1e-4, help="epsilon for numerical stability"
+        "--channel_multiplier",
+        type=int,
+        default=None,
+        help="channel multiplier of the generator. config-f = 2, else = 1. read "
+        "from the checkpoint if not given",
     )
     parser.add_argument(
-        "--crop", action="store_true", help="apply center crop to the images"
+        "--arch",
+        type=str,
+        default=None,
+        help="model architecture (stylegan2 | swagan), read from the checkpoint if "
+        "not given",
     )
     parser.add_argument(
-        "--sampling",
-        default="end",
-        choices=["end", "full"],
-        help="set endpoint sampling method",
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="device to run the models",
     )
+    add_ppl_args(parser)
     parser.add_argument(
         "ckpt", metavar="CHECKPOINT", help="path to the model checkpoints"
     )
 
     args = parser.parse_args()
 
-    latent_dim = 512
-
-    ckpt = torch.load(args.ckpt)
+    device = args.device
+    ckpt = load_checkpoint(args.ckpt)
 
-    g = Generator(args.size, latent_dim, 8).to(device)
-    g.load_state_dict(ckpt["g_ema"])
+    g = build_generator(
+        ckpt,
+        arch=args.arch,
+        size=args.size,
+        channel_multiplier=args.channel_multiplier,
+    ).to(device)
     g.eval()
 
     percept = lpips.PerceptualLoss(
         model="net-lin", net="vgg", use_gpu=device.startswith("cuda")
     )
 
-    distances = []
-
-    n_batch = args.n_sample // args.batch
-    resid = args.n_sample - (n_batch * args.batch)
-    batch_sizes = [args.batch] * n_batch + [resid]
-
-    with torch.no_grad():
-        for batch in tqdm(batch_sizes):
-            noise = g.make_noise()
-
-            inputs = torch.randn([batch * 2, latent_dim], device=device)
-            if args.sampling == "full":
-                lerp_t = torch.rand(batch, device=device)
-            else:
-                lerp_t = torch.zeros(batch, device=device)
-
-            if args.space == "w":
-                latent = g.get_latent(inputs)
-                latent_t0, latent_t1 = latent[::2], latent[1::2]
-                latent_e0 = lerp(latent_t0, latent_t1, lerp_t[:, None])
-                latent_e1 = lerp(latent_t0, latent_t1, lerp_t[:, None] + args.eps)
-                latent_e = torch.stack([latent_e0, latent_e1], 1).view(*latent.shape)
-
-            image, _ = g([latent_e], input_is_latent=True, noise=noise)
-
-            if args.crop:
-                c = image.shape[2] // 8
-                image = image[:, :, c * 3 : c * 7, c * 2 : c * 6]
-
-            factor = image.shape[2] // 256
-
-            if factor > 1:
-                image = F.interpolate(
-                    image, size=(256, 256), mode="bilinear", align_corners=False
-                )
-
-            dist = percept(image[::2], image[1::2]).view(image.shape[0] // 2) / (
-                args.eps ** 2
-            )
-            distances.append(dist.to("cpu").numpy())
-
-    distances = np.concatenate(distances, 0)
-
-    lo = np.percentile(distances, 1, interpolation="lower")
-    hi = np.percentile(distances, 99, interpolation="higher")
-    filtered_dist = np.extract(
-        np.logical_and(lo <= distances, distances <= hi), distances
-    )
+    ppl, samples_per_sec = compute_ppl(g, percept, args, device)
 
-    print("ppl:", filtered_dist.mean())
+    print(f"ppl: {ppl} ({samples_per_sec:.2f} samples/s)")
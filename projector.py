@@ -3,61 +3,137 @@ import math
 import os
 
 import torch
-from torch import optim
-from torch.nn import functional as F
 from torchvision import transforms
 from PIL import Image
 from tqdm import tqdm
 
 import lpips
-from model import Generator
+from checkpoint import load_checkpoint, build_generator
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+
+def pack_noises(noises, batch):
+    # same sized noise maps of the generator are packed into one (batch, n_maps,
+    # size, size) tensor per size, layout is the (tensor, map) of every noise
+    sizes = sorted({noise.shape[-1] for noise in noises})
+    counts = [0] * len(sizes)
+    layout = []
+
+    for noise in noises:
+        i = sizes.index(noise.shape[-1])
+        layout.append((i, counts[i]))
+        counts[i] += 1
+
+    packed = [
+        noises[0].new_empty(batch, count, size, size).normal_()
+        for size, count in zip(sizes, counts)
+    ]
+
+    return packed, layout
+
+
+def unpack_noises(packed, layout):
+    # per layer (batch, 1, size, size) views in the order of the generator
+    return [packed[i][:, j : j + 1] for i, j in layout]
 
 
 def noise_regularize(noises):
-    loss = 0
+    # (batch,) regularization, every image only sees its own noises. Noise maps
+    # (batch, n_maps, size, size) are concatenated per size and the maps
+    # halved from the level above join them, so every pyramid level is a
+    # single autocorrelation over all of its maps
+    sizes = {}
 
     for noise in noises:
-        size = noise.shape[2]
+        sizes.setdefault(noise.shape[-1], []).append(noise)
 
-        while True:
+    loss = 0
+    level = None
+    size = max(sizes)
+
+    while size > 0:
+        maps = sizes.get(size, []) + ([level] if level is not None else [])
+        level = None
+
+        if len(maps) > 0:
+            level = torch.cat(maps, 1) if len(maps) > 1 else maps[0]
+            horizontal = level * torch.roll(level, shifts=1, dims=3)
+            vertical = level * torch.roll(level, shifts=1, dims=2)
             loss = (
                 loss
-                + (noise * torch.roll(noise, shifts=1, dims=3)).mean().pow(2)
-                + (noise * torch.roll(noise, shifts=1, dims=2)).mean().pow(2)
+                + horizontal.mean([2, 3]).pow(2).sum(1)
+                + vertical.mean([2, 3]).pow(2).sum(1)
             )
 
-            if size <= 8:
-                break
+            if size > 8:
+                batch, n_maps = level.shape[:2]
+                level = level.reshape(batch, n_maps, size // 2, 2, size // 2, 2)
+                level = level.mean([3, 5])
 
-            noise = noise.reshape([-1, 1, size // 2, 2, size // 2, 2])
-            noise = noise.mean([3, 5])
-            size //= 2
+            else:
+                level = None
+
+        size //= 2
 
     return loss
 
 
 def noise_normalize_(noises):
+    # every map of every image to zero mean and unit std
     for noise in noises:
-        mean = noise.mean()
-        std = noise.std()
+        mean = noise.mean([2, 3], keepdim=True)
+        std = noise.std([2, 3], keepdim=True)
 
         noise.data.add_(-mean).div_(std)
 
 
 def get_lr(t, initial_lr, rampdown=0.25, rampup=0.05):
-    lr_ramp = min(1, (1 - t) / rampdown)
-    lr_ramp = 0.5 - 0.5 * math.cos(lr_ramp * math.pi)
-    lr_ramp = lr_ramp * min(1, t / rampup)
+    # t is the (batch,) progress of every image
+    lr_ramp = torch.clamp((1 - t) / rampdown, max=1)
+    lr_ramp = 0.5 - 0.5 * torch.cos(lr_ramp * math.pi)
+    lr_ramp = lr_ramp * torch.clamp(t / rampup, max=1)
 
     return initial_lr * lr_ramp
 
 
 def latent_noise(latent, strength):
+    # strength is a float or a (batch,) tensor
+    if torch.is_tensor(strength):
+        strength = strength.view(-1, *[1] * (latent.ndim - 1))
+
     noise = torch.randn_like(latent) * strength
 
     return latent + noise
 
 
+def latent_stats(g_ema, n_mean_latent, device):
+    # mean W latent and the std of mapped samples around it
+    with torch.no_grad():
+        noise_sample = torch.randn(n_mean_latent, g_ema.style_dim, device=device)
+        latent_out = g_ema.style(noise_sample)
+
+        latent_mean = latent_out.mean(0)
+        latent_std = ((latent_out - latent_mean).pow(2).sum() / n_mean_latent) ** 0.5
+
+    return latent_mean, latent_std
+
+
+def downsample(image, size):
+    # box filter down to size, a no-op for images that are not larger
+    batch, channel, height, width = image.shape
+
+    if height <= size:
+        return image
+
+    factor = height // size
+    image = image.reshape(
+        batch, channel, height // factor, factor, width // factor, factor
+    )
+
+    return image.mean([3, 5])
+
+
 def make_image(tensor):
     return (
         tensor.detach()
@@ -72,18 +148,288 @@ def make_image(tensor):
     )
 
 
-if __name__ == "__main__":
-    device = "cuda"
+class SlotAdam:
+    # Adam over batched parameters whose rows (slots) hold different images:
+    # every slot has its own step count and learning rate and is reset when a
+    # new image is backfilled into it
+    def __init__(self, params, betas=(0.9, 0.999), eps=1e-8):
+        self.params = params
+        self.betas = betas
+        self.eps = eps
+        self.exp_avg = [torch.zeros_like(p) for p in params]
+        self.exp_avg_sq = [torch.zeros_like(p) for p in params]
+        self.steps = torch.zeros(params[0].shape[0], device=params[0].device)
+
+    def reset(self, slot):
+        for exp_avg, exp_avg_sq in zip(self.exp_avg, self.exp_avg_sq):
+            exp_avg[slot] = 0
+            exp_avg_sq[slot] = 0
+
+        self.steps[slot] = 0
+
+    @torch.no_grad()
+    def step(self, lr):
+        beta1, beta2 = self.betas
+        self.steps += 1
+        step_size = lr / (1 - beta1 ** self.steps)
+        bias_correction2 = (1 - beta2 ** self.steps).sqrt()
+
+        for param, exp_avg, exp_avg_sq in zip(
+            self.params, self.exp_avg, self.exp_avg_sq
+        ):
+            shape = (-1,) + (1,) * (param.ndim - 1)
+            exp_avg.mul_(beta1).add_(param.grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(param.grad, param.grad, value=1 - beta2)
+            denom = (exp_avg_sq.sqrt() / bias_correction2.view(shape)).add_(self.eps)
+            param.sub_(step_size.view(shape) * exp_avg / denom)
+            param.grad = None
+
+
+def list_images(paths):
+    # files as given, directories are expanded to their images
+    files = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                sorted(
+                    os.path.join(path, name)
+                    for name in os.listdir(path)
+                    if name.lower().endswith(IMAGE_EXTENSIONS)
+                )
+            )
 
-    parser = argparse.ArgumentParser(
-        description="Image projector to the generator latent spaces"
-    )
-    parser.add_argument(
-        "--ckpt", type=str, required=True, help="path to the model checkpoint"
-    )
-    parser.add_argument(
-        "--size", type=int, default=256, help="output image sizes of the generator"
-    )
+        else:
+            files.append(path)
+
+    return files
+
+
+def result_paths(out, path):
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    return os.path.join(out, name + ".pt"), os.path.join(out, name + "-project.png")
+
+
+class ProjectionPool:
+    # fixed size batch of projections. Each slot optimizes one image and is
+    # retired once it converged (or ran out of steps), its best latent and
+    # noises are written out and the next image is backfilled into the slot
+    def __init__(self, g_ema, percept, latent_mean, latent_std, batch, args, device):
+        self.g_ema = g_ema
+        self.percept = percept
+        self.latent_mean = latent_mean
+        self.latent_std = latent_std
+        self.args = args
+        self.device = device
+
+        latent = latent_mean.detach().clone().unsqueeze(0).repeat(batch, 1)
+
+        if args.w_plus:
+            latent = latent.unsqueeze(1).repeat(1, g_ema.n_latent, 1)
+
+        self.latent_in = latent.requires_grad_()
+        self.noises, self.noise_layout = pack_noises(g_ema.make_noise(), batch)
+
+        for noise in self.noises:
+            noise.requires_grad_()
+
+        self.optimizer = SlotAdam([self.latent_in] + self.noises)
+
+        self.files = [None] * batch
+        self.targets = None
+        # LPIPS features of the targets per stage, computed once per image
+        self.target_features = None
+        self.best_loss = torch.full((batch,), float("inf"), device=device)
+        self.best_latent = self.latent_in.detach().clone()
+        self.best_noises = [noise.detach().clone() for noise in self.noises]
+        self.since_best = torch.zeros(batch, dtype=torch.long, device=device)
+
+        # coarse to fine schedule: the first coarse_fraction of the steps of an
+        # image are split between early exits at coarse_sizes, the last stage
+        # synthesizes at full resolution
+        self.sizes = []
+
+        if args.coarse_sizes:
+            self.sizes = [int(size) for size in args.coarse_sizes.split(",")]
+
+        for size in self.sizes:
+            # the VGG of LPIPS pools 16px images down to 1px
+            if size < 16 or size >= g_ema.size or size & (size - 1) != 0:
+                raise ValueError(
+                    f"coarse size {size} is not a power of 2 in [16, {g_ema.size})"
+                )
+
+        self.stage = torch.zeros(batch, dtype=torch.long, device=device)
+
+    def active(self):
+        return torch.tensor([f is not None for f in self.files], device=self.device)
+
+    def schedule(self, t):
+        stage = (t / self.args.coarse_fraction * len(self.sizes)).long()
+
+        return torch.clamp(stage, max=len(self.sizes))
+
+    def stage_size(self, stage):
+        # resolution the images of a stage are compared at
+        size = self.sizes[stage] if stage < len(self.sizes) else self.g_ema.size
+
+        return min(size, self.targets.shape[-1])
+
+    @torch.no_grad()
+    def fill(self, slot, path, target, latent=None):
+        # latent is the starting point of the image, e.g. an encoder prediction,
+        # by default the mean latent
+        if latent is None:
+            latent = self.latent_mean
+
+        elif latent.ndim == self.latent_in.ndim:
+            # W+ prediction, projected in W
+            latent = latent.mean(0)
+
+        if self.targets is None:
+            self.targets = target.new_zeros(len(self.files), *target.shape)
+
+        self.files[slot] = path
+        self.targets[slot] = target
+
+        features = [
+            self.percept.target_features(
+                downsample(target.unsqueeze(0), self.stage_size(stage))
+            )
+            for stage in range(len(self.sizes) + 1)
+        ]
+
+        if self.target_features is None:
+            self.target_features = [
+                [f.new_zeros(len(self.files), *f.shape[1:]) for f in stage_features]
+                for stage_features in features
+            ]
+
+        for stage_features, new_features in zip(self.target_features, features):
+            for slot_features, f in zip(stage_features, new_features):
+                slot_features[slot] = f[0]
+
+        self.latent_in[slot] = latent
+
+        for noise in self.noises:
+            noise[slot].normal_()
+
+        self.optimizer.reset(slot)
+        self.best_loss[slot] = float("inf")
+        self.since_best[slot] = 0
+        self.stage[slot] = 0
+
+    def step(self):
+        args = self.args
+        slots = self.active().nonzero()[:, 0]
+        t = self.optimizer.steps / args.step
+        lr = get_lr(t, args.lr, args.lr_rampdown, args.lr_rampup)
+        noise_ramp = torch.clamp(1 - t / args.noise_ramp, min=0)
+        noise_strength = self.latent_std * args.noise * noise_ramp ** 2
+        latent_n = latent_noise(self.latent_in, noise_strength)
+
+        # losses are not comparable across resolutions, so the best latent is
+        # tracked from the start of the stage
+        stage = self.schedule(t)
+        changed = stage != self.stage
+        self.best_loss[changed] = float("inf")
+        self.since_best[changed] = 0
+        self.stage = stage
+
+        # only the occupied slots are synthesized, the rest get zero gradients.
+        # slots of the same stage share a forward that exits at its resolution
+        p_losses, mse_losses, groups = [], [], []
+
+        for s in stage[slots].unique().tolist():
+            group = slots[stage[slots] == s]
+            size = self.stage_size(s)
+            img_gen, _, _ = self.g_ema(
+                [latent_n[group]],
+                input_is_latent=True,
+                noise=unpack_noises(
+                    [noise[group] for noise in self.noises], self.noise_layout
+                ),
+                preview_size=self.sizes[s] if s < len(self.sizes) else None,
+            )
+            img_gen = downsample(img_gen, size)
+            targets = downsample(self.targets[group], size)
+
+            p_losses.append(
+                self.percept(
+                    img_gen,
+                    None,
+                    target_features=[f[group] for f in self.target_features[s]],
+                ).view(-1)
+            )
+            mse_losses.append((img_gen - targets).pow(2).mean([1, 2, 3]))
+            groups.append(group)
+
+        order = torch.cat(groups).argsort()
+        p_loss = torch.cat(p_losses)[order]
+        mse_loss = torch.cat(mse_losses)[order]
+        n_loss = noise_regularize([noise[slots] for noise in self.noises])
+
+        loss = p_loss + args.noise_regularize * n_loss + args.mse * mse_loss
+
+        with torch.no_grad():
+            # the losses belong to the latents before this step
+            score = p_loss + args.mse * mse_loss
+            improved = score < self.best_loss[slots] * (1 - args.tol)
+            best = slots[improved]
+            self.best_loss[best] = score[improved]
+            self.best_latent[best] = self.latent_in[best]
+
+            for best_noise, noise in zip(self.best_noises, self.noises):
+                best_noise[best] = noise[best]
+
+            self.since_best[slots] += 1
+            self.since_best[best] = 0
+
+        loss.sum().backward()
+        self.optimizer.step(lr)
+        noise_normalize_(self.noises)
+
+        return p_loss.mean().item(), n_loss.mean().item(), mse_loss.mean().item()
+
+    def finished(self):
+        done = self.optimizer.steps >= self.args.step
+
+        if self.args.patience > 0:
+            # images only converge at full resolution
+            converged = self.since_best >= self.args.patience
+            done = done | (converged & (self.stage == len(self.sizes)))
+
+        return (done & self.active()).nonzero()[:, 0].tolist()
+
+    @torch.no_grad()
+    def retire(self, slots, out):
+        latent = self.best_latent[slots]
+        noises = unpack_noises(
+            [noise[slots] for noise in self.best_noises], self.noise_layout
+        )
+        img_gen, _, _ = self.g_ema([latent], input_is_latent=True, noise=noises)
+        img_ar = make_image(img_gen)
+
+        for i, slot in enumerate(slots):
+            result_path, image_path = result_paths(out, self.files[slot])
+            # cloned, torch.save would write the storages of the whole batch
+            torch.save(
+                {
+                    "img": img_gen[i].cpu().clone(),
+                    "latent": latent[i].cpu().clone(),
+                    "noise": [noise[i : i + 1].cpu().clone() for noise in noises],
+                    "loss": self.best_loss[slot].item(),
+                    "steps": int(self.optimizer.steps[slot].item()),
+                },
+                result_path,
+            )
+            Image.fromarray(img_ar[i]).save(image_path)
+            self.files[slot] = None
+
+
+def add_projection_args(parser):
+    # optimization arguments, shared with the encoder benchmark
     parser.add_argument(
         "--lr_rampup",
         type=float,
@@ -106,7 +452,22 @@ if __name__ == "__main__":
         default=0.75,
         help="duration of the noise level decay",
     )
-    parser.add_argument("--step", type=int, default=1000, help="optimize iterations")
+    parser.add_argument(
+        "--step", type=int, default=1000, help="maximum optimize iterations per image"
+    )
+    parser.add_argument(
+        "--patience",
+        type=int,
+        default=100,
+        help="an image is retired once its loss did not improve for this many "
+        "iterations, 0 runs every image for --step iterations",
+    )
+    parser.add_argument(
+        "--tol",
+        type=float,
+        default=1e-3,
+        help="relative decrease of the loss that counts as an improvement",
+    )
     parser.add_argument(
         "--noise_regularize",
         type=float,
@@ -120,14 +481,78 @@ if __name__ == "__main__":
         help="allow to use distinct latent codes to each layers",
     )
     parser.add_argument(
-        "files", metavar="FILES", nargs="+", help="path to image files to be projected"
+        "--coarse_sizes",
+        type=str,
+        default=None,
+        help="comma separated early exit resolutions optimized before the full "
+        "resolution, e.g. 32,64,128 (coarse to fine)",
+    )
+    parser.add_argument(
+        "--coarse_fraction",
+        type=float,
+        default=0.5,
+        help="fraction of the steps of an image spent on the coarse resolutions",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Image projector to the generator latent spaces"
+    )
+    parser.add_argument(
+        "--ckpt", type=str, required=True, help="path to the model checkpoint"
+    )
+    parser.add_argument(
+        "--device", type=str, default="cuda", help="device to run the projection"
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=None,
+        help="output image sizes of the generator, read from the checkpoint if not "
+        "given",
+    )
+    parser.add_argument(
+        "--arch",
+        type=str,
+        default=None,
+        help="model architecture (stylegan2 | swagan), read from the checkpoint if "
+        "not given",
+    )
+    parser.add_argument(
+        "--batch", type=int, default=8, help="number of images optimized at once"
+    )
+    parser.add_argument(
+        "--out", type=str, default=".", help="directory of the projection results"
+    )
+    parser.add_argument(
+        "--encoder",
+        type=str,
+        default=None,
+        help="path to an encoder checkpoint (encoder.py) that predicts the starting "
+        "latent of every image",
     )
+    parser.add_argument(
+        "files",
+        metavar="FILES",
+        nargs="+",
+        help="path to image files or directories to be projected",
+    )
+
+    add_projection_args(parser)
 
     args = parser.parse_args()
 
+    device = args.device
     n_mean_latent = 10000
 
-    resize = min(args.size, 256)
+    g_ema = build_generator(
+        load_checkpoint(args.ckpt), strict=False, arch=args.arch, size=args.size
+    )
+    g_ema.eval()
+    g_ema = g_ema.to(device)
+
+    resize = min(g_ema.size, 256)
 
     transform = transforms.Compose(
         [
@@ -138,111 +563,73 @@ if __name__ == "__main__":
         ]
     )
 
-    imgs = []
+    os.makedirs(args.out, exist_ok=True)
 
-    for imgfile in args.files:
-        img = transform(Image.open(imgfile).convert("RGB"))
-        imgs.append(img)
+    # images whose result is already written are skipped, so runs resume
+    files = [
+        path
+        for path in list_images(args.files)
+        if not os.path.exists(result_paths(args.out, path)[0])
+    ]
+    stream = iter(files)
+    encoder = None
 
-    imgs = torch.stack(imgs, 0).to(device)
+    if args.encoder is not None:
+        from encoder import load_encoder
 
-    g_ema = Generator(args.size, 512, 8)
-    g_ema.load_state_dict(torch.load(args.ckpt)["g_ema"], strict=False)
-    g_ema.eval()
-    g_ema = g_ema.to(device)
+        # the encoder stores the latent statistics of its generator
+        encoder = load_encoder(args.encoder, device)
+        latent_mean, latent_std = encoder.latent_mean, encoder.latent_std
 
-    with torch.no_grad():
-        noise_sample = torch.randn(n_mean_latent, 512, device=device)
-        latent_out = g_ema.style(noise_sample)
-
-        latent_mean = latent_out.mean(0)
-        latent_std = ((latent_out - latent_mean).pow(2).sum() / n_mean_latent) ** 0.5
+    else:
+        latent_mean, latent_std = latent_stats(g_ema, n_mean_latent, device)
 
     percept = lpips.PerceptualLoss(
         model="net-lin", net="vgg", use_gpu=device.startswith("cuda")
     )
 
-    noises_single = g_ema.make_noise()
-    noises = []
-    for noise in noises_single:
-        noises.append(noise.repeat(imgs.shape[0], 1, 1, 1).normal_())
-
-    latent_in = latent_mean.detach().clone().unsqueeze(0).repeat(imgs.shape[0], 1)
-
-    if args.w_plus:
-        latent_in = latent_in.unsqueeze(1).repeat(1, g_ema.n_latent, 1)
-
-    latent_in.requires_grad = True
-
-    for noise in noises:
-        noise.requires_grad = True
-
-    optimizer = optim.Adam([latent_in] + noises, lr=args.lr)
-
-    pbar = tqdm(range(args.step))
-    latent_path = []
-
-    for i in pbar:
-        t = i / args.step
-        lr = get_lr(t, args.lr)
-        optimizer.param_groups[0]["lr"] = lr
-        noise_strength = latent_std * args.noise * max(0, 1 - t / args.noise_ramp) ** 2
-        latent_n = latent_noise(latent_in, noise_strength.item())
+    pool = ProjectionPool(
+        g_ema,
+        percept,
+        latent_mean,
+        latent_std,
+        min(args.batch, len(files)) or 1,
+        args,
+        device,
+    )
+    pbar = tqdm(total=len(files))
 
-        img_gen, _ = g_ema([latent_n], input_is_latent=True, noise=noises)
+    while True:
+        for slot, path in enumerate(pool.files):
+            if path is None:
+                path = next(stream, None)
 
-        batch, channel, height, width = img_gen.shape
+                if path is None:
+                    break
 
-        if height > 256:
-            factor = height // 256
+                img = transform(Image.open(path).convert("RGB")).to(device)
+                latent = None
 
-            img_gen = img_gen.reshape(
-                batch, channel, height // factor, factor, width // factor, factor
-            )
-            img_gen = img_gen.mean([3, 5])
+                if encoder is not None:
+                    with torch.no_grad():
+                        latent = encoder(img.unsqueeze(0))[0]
 
-        p_loss = percept(img_gen, imgs).sum()
-        n_loss = noise_regularize(noises)
-        mse_loss = F.mse_loss(img_gen, imgs)
+                pool.fill(slot, path, img, latent)
 
-        loss = p_loss + args.noise_regularize * n_loss + args.mse * mse_loss
+        if not pool.active().any():
+            break
 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        p_loss, n_loss, mse_loss = pool.step()
 
-        noise_normalize_(noises)
+        finished = pool.finished()
 
-        if (i + 1) % 100 == 0:
-            latent_path.append(latent_in.detach().clone())
+        if len(finished) > 0:
+            pool.retire(finished, args.out)
+            pbar.update(len(finished))
 
         pbar.set_description(
             (
-                f"perceptual: {p_loss.item():.4f}; noise regularize: {n_loss.item():.4f};"
-                f" mse: {mse_loss.item():.4f}; lr: {lr:.4f}"
+                f"perceptual: {p_loss:.4f}; noise regularize: {n_loss:.4f};"
+                f" mse: {mse_loss:.4f}"
             )
         )
-
-    img_gen, _ = g_ema([latent_path[-1]], input_is_latent=True, noise=noises)
-
-    filename = os.path.splitext(os.path.basename(args.files[0]))[0] + ".pt"
-
-    img_ar = make_image(img_gen)
-
-    result_file = {}
-    for i, input_name in enumerate(args.files):
-        noise_single = []
-        for noise in noises:
-            noise_single.append(noise[i : i + 1])
-
-        result_file[input_name] = {
-            "img": img_gen[i],
-            "latent": latent_in[i],
-            "noise": noise_single,
-        }
-
-        img_name = os.path.splitext(os.path.basename(input_name))[0] + "-project.png"
-        pil_img = Image.fromarray(img_ar[i])
-        pil_img.save(img_name)
-
-    torch.save(result_file, filename)
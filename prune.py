@@ -0,0 +1,157 @@
+import torch
+from torch import nn
+
+
+# Structured channel pruning for the StyleGAN2 generator in model.py.
+#
+# The output channels of every StyledConv are gated where they are read: each
+# consuming ModulatedConv2d multiplies its style by a learned per input channel
+# gate. Gating the style instead of the activation also removes a closed
+# channel from the weight demodulation of the consumer, so once all gates of a
+# channel are zero, prune_channels() can remove it exactly: the producing conv
+# weight and activation bias are narrowed together with the input weights,
+# modulation and gates of every consumer.
+
+
+def layer_consumers(generator):
+    # (StyledConv, [ModulatedConv2d reading its output]) in synthesis order
+    convs = generator.convs
+    consumers = [generator.to_rgb1.conv]
+
+    if len(convs) > 0:
+        consumers.append(convs[0].conv)
+
+    layers = [(generator.conv1, consumers)]
+
+    for i, conv in enumerate(convs):
+        if i % 2 == 0:
+            consumers = [convs[i + 1].conv]
+
+        else:
+            consumers = [generator.to_rgbs[i // 2].conv]
+
+            if i + 1 < len(convs):
+                consumers.append(convs[i + 1].conv)
+
+        layers.append((conv, consumers))
+
+    return layers
+
+
+def add_channel_gates(generator):
+    for _, consumers in layer_consumers(generator):
+        for conv in consumers:
+            if conv.gate is None:
+                conv.gate = nn.Parameter(
+                    torch.ones(conv.in_channel, device=conv.weight.device)
+                )
+
+
+def channel_norms(consumers):
+    # group norm of the gates of each channel over all of its consumers
+    gates = torch.stack([conv.gate for conv in consumers], 0)
+
+    return gates.pow(2).sum(0).sqrt()
+
+
+def gate_penalty(generator):
+    # demodulation makes the gates of a layer scale invariant, so plain L1 would
+    # only shrink them uniformly; the L1 / L2 ratio of the group norms favours
+    # sparsity instead and does not depend on the overall scale
+    penalty = 0
+
+    for _, consumers in layer_consumers(generator):
+        norms = channel_norms(consumers)
+        penalty = penalty + norms.mean() / (norms.pow(2).mean().sqrt() + 1e-8)
+
+    return penalty
+
+
+def channel_widths(generator):
+    return [layer.conv.out_channel for layer, _ in layer_consumers(generator)]
+
+
+def select_channels(generator, threshold, min_channels=1):
+    keeps = []
+
+    for _, consumers in layer_consumers(generator):
+        norms = channel_norms(consumers).detach()
+        keep = (norms > threshold * norms.max()).nonzero().squeeze(1)
+
+        if keep.numel() < min_channels:
+            keep = norms.topk(min(min_channels, norms.numel())).indices.sort().values
+
+        keeps.append(keep)
+
+    return keeps
+
+
+def replace_optim_param(optimizer, old, new, index, dim):
+    for group in optimizer.param_groups:
+        for i, param in enumerate(group["params"]):
+            if param is old:
+                group["params"][i] = new
+
+    state = optimizer.state.pop(old, None)
+
+    if state is None:
+        return
+
+    # slice moment estimates (exp_avg, exp_avg_sq, ...), keep scalars like step
+    optimizer.state[new] = {
+        k: v.index_select(dim, index.to(v.device))
+        if torch.is_tensor(v) and v.shape == old.shape
+        else v
+        for k, v in state.items()
+    }
+
+
+def narrow_param(module, name, index, dim, optimizer=None):
+    old = getattr(module, name)
+
+    if old is None:
+        return
+
+    new = nn.Parameter(
+        old.data.index_select(dim, index).clone(), requires_grad=old.requires_grad
+    )
+    setattr(module, name, new)
+
+    if optimizer is not None:
+        replace_optim_param(optimizer, old, new, index, dim)
+
+
+def prune_channels(generator, keeps, optimizer=None):
+    # scale of every ModulatedConv2d is left untouched on purpose: it was
+    # derived from the original fan-in and the trained weights depend on it
+    for (layer, consumers), keep in zip(layer_consumers(generator), keeps):
+        if keep.numel() == layer.conv.out_channel:
+            continue
+
+        keep = keep.to(layer.conv.weight.device)
+
+        narrow_param(layer.conv, "weight", keep, 1, optimizer)
+        narrow_param(layer.activate, "bias", keep, 0, optimizer)
+        layer.conv.out_channel = keep.numel()
+
+        for conv in consumers:
+            narrow_param(conv, "weight", keep, 2, optimizer)
+            narrow_param(conv, "gate", keep, 0, optimizer)
+            narrow_param(conv.modulation, "weight", keep, 0, optimizer)
+            narrow_param(conv.modulation, "bias", keep, 0, optimizer)
+            conv.in_channel = keep.numel()
+
+
+def match_state_dict(generator, state_dict, optimizer=None):
+    # narrow a freshly built generator so that a pruned state_dict fits into it
+    if any(k.endswith(".gate") for k in state_dict):
+        add_channel_gates(generator)
+
+    names = {module: name for name, module in generator.named_modules()}
+    keeps = []
+
+    for layer, _ in layer_consumers(generator):
+        width = state_dict[f"{names[layer]}.conv.weight"].shape[1]
+        keeps.append(torch.arange(width))
+
+    prune_channels(generator, keeps, optimizer)
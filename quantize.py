@@ -0,0 +1,422 @@
+import argparse
+import copy
+import functools
+import pickle
+import time
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+import numpy as np
+from tqdm import tqdm
+
+import lpips
+from checkpoint import load_checkpoint, build_generator, generator_config
+from model import EqualLinear, ModulatedConv2d, generator_class
+from op import fused_leaky_relu
+from calc_inception import load_patched_inception_v3
+from fid import calc_fid
+
+# Post-training int8 weight quantization of model.Generator.
+#
+# Weights of every EqualLinear (mapping network and modulations) and of every
+# ModulatedConv2d are stored as int8 with one scale per output channel. The
+# modulated conv weights are dequantized before modulation and demodulation
+# run, so the per-output-channel quantization scale is normalised away by the
+# demodulation just like the original weight norm. On CPU the linear layers
+# run on the dynamic int8 kernels of torch.backends.quantized.
+
+
+def quantize_per_channel(weight, dim, clip=1.0):
+    reduce_dim = [i for i in range(weight.ndim) if i != dim]
+    max_val = weight.abs().amax(reduce_dim) * clip
+    scale = (max_val / 127).clamp(min=1e-12)
+
+    shape = [1] * weight.ndim
+    shape[dim] = -1
+
+    qweight = (weight / scale.view(shape)).round().clamp(-127, 127).to(torch.int8)
+
+    return qweight, scale
+
+
+def use_int8_kernel(input):
+    return (
+        input.device.type == "cpu"
+        and torch.backends.quantized.engine
+        in torch.backends.quantized.supported_engines
+        and torch.backends.quantized.engine != "none"
+    )
+
+
+class QuantizedEqualLinear(nn.Module):
+    def __init__(self, linear, clip=1.0):
+        super().__init__()
+
+        weight = linear.weight.detach() * linear.scale
+        qweight, scale = quantize_per_channel(weight, 0, clip)
+
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("qscale", scale)
+
+        if linear.bias is not None:
+            self.register_buffer("bias", linear.bias.detach() * linear.lr_mul)
+
+        else:
+            self.bias = None
+
+        self.activation = linear.activation
+        self.packed = None
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.packed = None
+
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def dequantize(self):
+        return self.qweight.float() * self.qscale.view(-1, 1)
+
+    def pack(self):
+        if self.packed is None:
+            qweight = torch.quantize_per_channel(
+                self.dequantize().cpu(),
+                self.qscale.cpu().double(),
+                torch.zeros(self.qscale.shape[0], dtype=torch.long),
+                0,
+                torch.qint8,
+            )
+            self.packed = torch.ops.quantized.linear_prepack(qweight, None)
+
+        return self.packed
+
+    def forward(self, input):
+        if use_int8_kernel(input):
+            out = torch.ops.quantized.linear_dynamic(input.contiguous(), self.pack())
+
+        else:
+            out = F.linear(input, self.dequantize())
+
+        if self.activation:
+            out = fused_leaky_relu(out, self.bias)
+
+        elif self.bias is not None:
+            out = out + self.bias
+
+        return out
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.qweight.shape[1]}, {self.qweight.shape[0]})"
+
+
+class QuantizedModulatedConv2d(ModulatedConv2d):
+    def __init__(self, conv, clip=1.0):
+        super().__init__(
+            conv.in_channel,
+            conv.out_channel,
+            conv.kernel_size,
+            conv.modulation.weight.shape[1],
+            demodulate=conv.demodulate,
+            upsample=conv.upsample,
+            downsample=conv.downsample,
+            fused=conv.fused,
+        )
+
+        # weight is provided by the dequantizing property below
+        del self.weight
+
+        if hasattr(conv, "blur"):
+            self.blur = copy.deepcopy(conv.blur)
+
+        self.scale = conv.scale
+        self.modulation = copy.deepcopy(conv.modulation)
+        self.gate = copy.deepcopy(conv.gate)
+
+        qweight, scale = quantize_per_channel(conv.weight.detach(), 1, clip)
+
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("qscale", scale)
+
+    @property
+    def weight(self):
+        return self.qweight.float() * self.qscale.view(1, -1, 1, 1, 1)
+
+
+def quantizable_modules(generator):
+    return [
+        (name, module)
+        for name, module in generator.named_modules()
+        if isinstance(module, (EqualLinear, ModulatedConv2d))
+        and not isinstance(module, QuantizedModulatedConv2d)
+    ]
+
+
+def quantize_module(module, clip=1.0):
+    if isinstance(module, ModulatedConv2d):
+        qmodule = QuantizedModulatedConv2d(module, clip)
+        qmodule.modulation = QuantizedEqualLinear(module.modulation, clip)
+
+        return qmodule
+
+    return QuantizedEqualLinear(module, clip)
+
+
+def set_module(root, name, module):
+    parent_name, _, child = name.rpartition(".")
+    parent = (
+        functools.reduce(getattr, parent_name.split("."), root) if parent_name else root
+    )
+    setattr(parent, child, module)
+
+
+@torch.no_grad()
+def calibrate(generator, latents, clip_ratios, noise=None):
+    # pick the clip ratio of each layer that minimises its output error on the
+    # inputs it sees while rendering the calibration latents. These are z
+    # latents, so the mapping network layers are calibrated too
+    records = {}
+    hooks = []
+
+    for name, module in quantizable_modules(generator):
+        if name.endswith(".modulation"):
+            continue
+
+        def hook(module, input, output, name=name):
+            records.setdefault(name, []).append((input, output))
+
+        hooks.append(module.register_forward_hook(hook))
+
+    generator([latents], noise=noise, randomize_noise=False)
+
+    for hook in hooks:
+        hook.remove()
+
+    clips = {}
+
+    for name, module in quantizable_modules(generator):
+        if name not in records:
+            continue
+
+        errors = []
+
+        for clip in clip_ratios:
+            qmodule = quantize_module(module, clip)
+            error = 0
+
+            for input, output in records[name]:
+                error += F.mse_loss(qmodule(*input), output).item()
+
+            errors.append(error)
+
+        clips[name] = clip_ratios[int(np.argmin(errors))]
+
+    return clips
+
+
+def quantize_generator(generator, clips=None):
+    generator = copy.deepcopy(generator)
+    clips = {} if clips is None else clips
+
+    # the modulations are quantized as a part of their ModulatedConv2d
+    targets = [
+        (name, module)
+        for name, module in quantizable_modules(generator)
+        if not name.endswith(".modulation")
+    ]
+
+    for name, module in targets:
+        set_module(generator, name, quantize_module(module, clips.get(name, 1.0)))
+
+    return generator
+
+
+def load_quantized(path, device="cpu"):
+    # int8 generator written by this script: the modules of a freshly built
+    # generator are quantized with the stored clips, then the int8 weights and
+    # scales are loaded
+    checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+    config = checkpoint["config"]
+    generator = generator_class(config["arch"])(
+        config["size"],
+        config["style_dim"],
+        config["n_mlp"],
+        channel_multiplier=config["channel_multiplier"],
+    )
+    generator = quantize_generator(generator, checkpoint["clips"])
+    generator.load_state_dict(checkpoint["g_ema_int8"])
+
+    return generator.to(device).eval()
+
+
+def model_size(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+@torch.no_grad()
+def measure_latency(generator, batch, latent_dim, device, n_iter=10, warmup=2):
+    latent = torch.randn(batch, latent_dim, device=device)
+
+    for _ in range(warmup):
+        generator([latent])
+
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+    start = time.perf_counter()
+
+    for _ in range(n_iter):
+        generator([latent])
+
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / n_iter
+
+
+@torch.no_grad()
+def extract_features(generator, inception, n_sample, batch, latent_dim, device):
+    features = []
+
+    for i in tqdm(range(0, n_sample, batch)):
+        latent = torch.randn(min(batch, n_sample - i), latent_dim, device=device)
+        img, _, _ = generator([latent])
+        features.append(inception(img)[0].view(img.shape[0], -1).to("cpu"))
+
+    return torch.cat(features, 0).numpy()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Post-training int8 quantization of the generator"
+    )
+
+    parser.add_argument(
+        "--ckpt", type=str, required=True, help="path to the model checkpoint"
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=None,
+        help="output image size of the generator, read from the checkpoint if not "
+        "given",
+    )
+    parser.add_argument(
+        "--channel_multiplier",
+        type=int,
+        default=None,
+        help="channel multiplier of the generator. config-f = 2, else = 1. read "
+        "from the checkpoint if not given",
+    )
+    parser.add_argument(
+        "--out", type=str, default="g_ema_int8.pt", help="path of the quantized model"
+    )
+    parser.add_argument(
+        "--n_calib", type=int, default=8, help="number of calibration latents"
+    )
+    parser.add_argument(
+        "--clip_ratios",
+        type=str,
+        default="1.0,0.99,0.98,0.95,0.9",
+        help="comma separated candidate clip ratios for calibration",
+    )
+    parser.add_argument(
+        "--n_eval", type=int, default=64, help="number of samples for the LPIPS report"
+    )
+    parser.add_argument("--batch", type=int, default=8, help="batch size")
+    parser.add_argument(
+        "--inception",
+        type=str,
+        default=None,
+        help="path to precomputed inception embedding, enables the FID report",
+    )
+    parser.add_argument(
+        "--n_sample", type=int, default=5000, help="number of samples for FID"
+    )
+    parser.add_argument(
+        "--device", type=str, default="cpu", help="device to run the models"
+    )
+
+    args = parser.parse_args()
+
+    device = args.device
+
+    torch.manual_seed(0)
+
+    g_ema = build_generator(
+        load_checkpoint(args.ckpt),
+        arch="stylegan2",
+        size=args.size,
+        channel_multiplier=args.channel_multiplier,
+    )
+    g_ema = g_ema.to(device).eval()
+    args.latent = g_ema.style_dim
+
+    calib_latent = torch.randn(args.n_calib, args.latent, device=device)
+
+    clip_ratios = [float(c) for c in args.clip_ratios.split(",")]
+    clips = calibrate(g_ema, calib_latent, clip_ratios)
+    g_int8 = quantize_generator(g_ema, clips).eval()
+
+    torch.save(
+        {
+            "g_ema_int8": g_int8.state_dict(),
+            "clips": clips,
+            "config": generator_config(g_ema),
+            "args": vars(args),
+        },
+        args.out,
+    )
+
+    percept = lpips.PerceptualLoss(
+        model="net-lin", net="vgg", use_gpu=device.startswith("cuda")
+    )
+
+    distances = []
+
+    with torch.no_grad():
+        for i in range(0, args.n_eval, args.batch):
+            latent = torch.randn(
+                min(args.batch, args.n_eval - i), args.latent, device=device
+            )
+            img, _, _ = g_ema([latent], randomize_noise=False)
+            img_int8, _, _ = g_int8([latent], randomize_noise=False)
+            distances.append(percept(img, img_int8).view(-1).to("cpu"))
+
+    report = {
+        "size_fp32": model_size(g_ema),
+        "size_int8": model_size(g_int8),
+        "latency_fp32": measure_latency(g_ema, args.batch, args.latent, device),
+        "latency_int8": measure_latency(g_int8, args.batch, args.latent, device),
+        "lpips": torch.cat(distances).mean().item(),
+    }
+
+    if args.inception is not None:
+        inception = load_patched_inception_v3().to(device).eval()
+
+        with open(args.inception, "rb") as f:
+            embeds = pickle.load(f)
+
+        for name, generator in (("fp32", g_ema), ("int8", g_int8)):
+            features = extract_features(
+                generator, inception, args.n_sample, args.batch, args.latent, device
+            )
+            report[f"fid_{name}"] = calc_fid(
+                np.mean(features, 0),
+                np.cov(features, rowvar=False),
+                embeds["mean"],
+                embeds["cov"],
+            )
+
+    print(
+        f"model size: {report['size_fp32'] / 2 ** 20:.1f}MB (fp32) -> {report['size_int8'] / 2 ** 20:.1f}MB (int8)"
+    )
+    print(
+        f"latency (batch {args.batch}): {report['latency_fp32'] * 1000:.1f}ms (fp32) -> {report['latency_int8'] * 1000:.1f}ms (int8)"
+    )
+    print(f"lpips fp32 vs int8: {report['lpips']:.4f}")
+
+    if args.inception is not None:
+        print(
+            f"fid: {report['fid_fp32']:.2f} (fp32) -> {report['fid_int8']:.2f} (int8)"
+        )
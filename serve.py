@@ -0,0 +1,464 @@
+import argparse
+import io
+import json
+import queue
+import random
+import threading
+import time
+import urllib.request
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from PIL import Image
+
+from generate import load_generator
+from model import seeded_randn, truncation_schedule
+
+
+class Request:
+    def __init__(
+        self,
+        seed=None,
+        latent=None,
+        truncation=1.0,
+        noise_seed=None,
+        truncation_cutoff=None,
+    ):
+        self.seed = seed
+        self.latent = latent
+        self.truncation = truncation
+        self.truncation_cutoff = truncation_cutoff
+        # latent requests without a noise seed use the noise of seed 0
+        self.noise_seed = noise_seed if noise_seed is not None else (seed or 0)
+        self.future = Future()
+        self.start = time.perf_counter()
+
+
+def parse_int(body, key, low, high, required=False):
+    value = body.get(key)
+
+    if value is None:
+        if required:
+            raise ValueError(f"{key} must be an integer")
+
+        return None
+
+    # ints and integer strings, int() would truncate floats and accept bools
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{key} must be an integer")
+
+    value = int(value)
+
+    if not low <= value < high:
+        raise ValueError(f"{key} must be in [{low}, {high})")
+
+    return value
+
+
+def parse_body(body, style_dim, n_latent):
+    # Request arguments of a /generate body, raises ValueError on bad fields
+    if not isinstance(body, dict):
+        raise ValueError("body must be a json object")
+
+    if ("seed" in body) == ("latent" in body):
+        raise ValueError("exactly one of seed or latent is required")
+
+    latent = None
+
+    if "latent" in body:
+        if not isinstance(body["latent"], list):
+            raise ValueError(f"latent must be a list of {style_dim} values")
+
+        latent = [float(v) for v in body["latent"]]
+
+        if len(latent) != style_dim or not np.isfinite(latent).all():
+            raise ValueError(f"latent must have {style_dim} finite values")
+
+    truncation = float(body.get("truncation", 1.0))
+
+    if not np.isfinite(truncation):
+        raise ValueError("truncation must be finite")
+
+    return {
+        "seed": parse_int(body, "seed", 0, 2 ** 32, required="seed" in body),
+        "latent": latent,
+        "truncation": truncation,
+        "noise_seed": parse_int(body, "noise_seed", 0, 2 ** 32),
+        "truncation_cutoff": parse_int(body, "truncation_cutoff", 0, n_latent + 1),
+    }
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    if len(values) == 0:
+        return {}
+
+    return {f"p{p}": float(np.percentile(values, p)) * 1000 for p in ps}
+
+
+class BatchServer:
+    # collects requests into dynamic batches: a batch is run once it is full or
+    # once its oldest request waited max_wait seconds
+    def __init__(
+        self, generator, device, max_batch=16, max_wait=0.01, cache_size=10000
+    ):
+        self.generator = generator
+        self.style_dim = generator.style_dim
+        self.n_latent = generator.n_latent
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+
+        self.queue = queue.Queue()
+        # seed -> W latent, least recently used first
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = deque(maxlen=10000)
+        self.n_images = 0
+        self.started = time.perf_counter()
+
+        with torch.no_grad():
+            torch.manual_seed(0)
+            self.mean_latent = generator.mean_latent(4096)
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        # warm up the kernels and allocator at the largest batch size
+        self.run([Request(seed=i) for i in range(self.max_batch)])
+        self.cache.clear()
+        self.cache_misses = 0
+        self.thread.start()
+
+    def submit(
+        self,
+        seed=None,
+        latent=None,
+        truncation=1.0,
+        noise_seed=None,
+        truncation_cutoff=None,
+    ):
+        request = Request(seed, latent, truncation, noise_seed, truncation_cutoff)
+        self.queue.put(request)
+
+        return request.future
+
+    def next_batch(self):
+        requests = [self.queue.get()]
+        deadline = requests[0].start + self.max_wait
+
+        while len(requests) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+
+            if timeout <= 0:
+                break
+
+            try:
+                requests.append(self.queue.get(timeout=timeout))
+
+            except queue.Empty:
+                break
+
+        return requests
+
+    def loop(self):
+        while True:
+            requests = self.next_batch()
+
+            try:
+                requests, images = self.run(requests)
+
+            except Exception as e:
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+                continue
+
+            if len(requests) == 0:
+                continue
+
+            end = time.perf_counter()
+
+            for request, image in zip(requests, images):
+                self.latencies.append(end - request.start)
+                request.future.set_result(image)
+
+            self.batch_sizes.append(len(requests))
+            self.n_images += len(requests)
+
+    def latent(self, request):
+        # seeded latents are drawn on CPU like in generate.py, so a seed maps
+        # to the same z in the server and the CLI on any device
+        if request.latent is not None:
+            return torch.as_tensor(request.latent, dtype=torch.float32)
+
+        return seeded_randn([request.seed], (self.generator.style_dim,))[0]
+
+    def prepare(self, request):
+        # per request inputs, built before the batch is stacked so that a bad
+        # request only fails itself
+        request.z = self.latent(request)
+        request.psi = truncation_schedule(
+            self.generator.n_latent, request.truncation, request.truncation_cutoff
+        )
+        request.noise = self.generator.make_noise(seeds=[request.noise_seed])
+
+    def styles(self, requests):
+        styles = [None] * len(requests)
+        missing = []
+
+        for i, request in enumerate(requests):
+            if request.seed is not None and request.seed in self.cache:
+                self.cache.move_to_end(request.seed)
+                styles[i] = self.cache[request.seed]
+                self.cache_hits += 1
+
+            else:
+                missing.append(i)
+
+        if len(missing) > 0:
+            z = torch.stack([requests[i].z for i in missing])
+            w = self.generator.style(z.to(self.device))
+
+            for i, style in zip(missing, w):
+                styles[i] = style
+
+                if requests[i].seed is not None:
+                    self.cache[requests[i].seed] = style
+                    self.cache_misses += 1
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return torch.stack(styles)
+
+    @torch.no_grad()
+    def run(self, requests):
+        # images of the requests that could be prepared, the others fail alone
+        ready = []
+
+        for request in requests:
+            try:
+                self.prepare(request)
+
+            except Exception as e:
+                request.future.set_exception(e)
+                continue
+
+            ready.append(request)
+
+        if len(ready) == 0:
+            return ready, []
+
+        requests = ready
+        styles = self.styles(requests)
+
+        # (batch, n_latent) psi, requests with different truncation share a batch
+        truncation = torch.stack([request.psi for request in requests])
+        noise = [
+            torch.cat(layer, 0)
+            for layer in zip(*[request.noise for request in requests])
+        ]
+        images = self.generator(
+            [styles],
+            input_is_latent=True,
+            truncation=truncation,
+            truncation_latent=self.mean_latent,
+            noise=noise,
+        )[0]
+        images = images.clamp(-1, 1).add(1).mul(127.5).round().to(torch.uint8)
+
+        return requests, images.permute(0, 2, 3, 1).cpu().numpy()
+
+    def stats(self):
+        latencies = list(self.latencies)
+        lookups = self.cache_hits + self.cache_misses
+
+        return {
+            "images": self.n_images,
+            "images_per_sec": self.n_images / (time.perf_counter() - self.started),
+            "latency_ms": percentiles(latencies),
+            "mean_batch_size": (
+                float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else 0.0
+            ),
+            "cache_hit_rate": self.cache_hits / lookups if lookups > 0 else 0.0,
+            "queued": self.queue.qsize(),
+        }
+
+
+def make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def send(self, status, content_type, data):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                return self.send(404, "text/plain", b"not found")
+
+            self.send(200, "application/json", json.dumps(server.stats()).encode())
+
+        def do_POST(self):
+            # {"seed": int} or {"latent": [z...]}, optional "truncation",
+            # "truncation_cutoff" and "noise_seed"; responds with a png
+            if self.path != "/generate":
+                return self.send(404, "text/plain", b"not found")
+
+            try:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                future = server.submit(
+                    **parse_body(body, server.style_dim, server.n_latent)
+                )
+
+            except (ValueError, KeyError, TypeError) as e:
+                return self.send(400, "text/plain", str(e).encode())
+
+            try:
+                image = future.result()
+
+            except Exception as e:
+                return self.send(500, "text/plain", str(e).encode())
+
+            buffer = io.BytesIO()
+            Image.fromarray(image).save(buffer, format="PNG")
+            self.send(200, "image/png", buffer.getvalue())
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(args):
+    g_ema = load_generator(args, args.device)
+    server = BatchServer(
+        g_ema, args.device, args.max_batch, args.max_wait / 1000, args.cache_size
+    )
+    server.start()
+
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(server))
+    print(f"serving on http://{args.host}:{args.port}")
+
+    try:
+        httpd.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    print(json.dumps(server.stats(), indent=2))
+
+
+def load(args):
+    # synthetic load: concurrent clients posting random seeds from n_seeds, a
+    # small n_seeds exercises the W cache
+    def post(i):
+        body = {"seed": random.randrange(args.n_seeds), "truncation": args.truncation}
+        request = urllib.request.Request(
+            f"{args.url}/generate",
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        start = time.perf_counter()
+
+        with urllib.request.urlopen(request) as response:
+            response.read()
+
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies = list(pool.map(post, range(args.requests)))
+
+    elapsed = time.perf_counter() - start
+    latency = ", ".join(f"{k} {v:.1f}ms" for k, v in percentiles(latencies).items())
+
+    print(f"client: {args.requests / elapsed:.2f} images/s, latency {latency}")
+
+    with urllib.request.urlopen(f"{args.url}/stats") as response:
+        print(f"server: {response.read().decode()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generation server with dynamic batching"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser("serve", help="run the HTTP server")
+    serve_parser.set_defaults(func=serve)
+    serve_parser.add_argument(
+        "--ckpt", type=str, required=True, help="path to the model checkpoint"
+    )
+    serve_parser.add_argument(
+        "--size",
+        type=int,
+        default=None,
+        help="output image size of the generator, read from the checkpoint if not "
+        "given",
+    )
+    serve_parser.add_argument(
+        "--channel_multiplier",
+        type=int,
+        default=None,
+        help="channel multiplier of the generator. config-f = 2, else = 1. read "
+        "from the checkpoint if not given",
+    )
+    serve_parser.add_argument(
+        "--arch",
+        type=str,
+        default=None,
+        help="model architecture (stylegan2 | swagan), read from the checkpoint if "
+        "not given",
+    )
+    serve_parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="device to run the generator",
+    )
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument(
+        "--max_batch", type=int, default=16, help="largest dynamic batch"
+    )
+    serve_parser.add_argument(
+        "--max_wait",
+        type=float,
+        default=10,
+        help="longest time in ms a request waits for its batch to fill",
+    )
+    serve_parser.add_argument(
+        "--cache_size", type=int, default=10000, help="W latents cached by seed"
+    )
+
+    load_parser = subparsers.add_parser("load", help="synthetic load generator")
+    load_parser.set_defaults(func=load)
+    load_parser.add_argument("--url", type=str, default="http://127.0.0.1:8000")
+    load_parser.add_argument(
+        "--requests", type=int, default=200, help="number of requests"
+    )
+    load_parser.add_argument(
+        "--concurrency", type=int, default=16, help="number of concurrent clients"
+    )
+    load_parser.add_argument(
+        "--n_seeds", type=int, default=1000, help="seeds are drawn from [0, n_seeds)"
+    )
+    load_parser.add_argument(
+        "--truncation", type=float, default=1.0, help="truncation of the requests"
+    )
+
+    args = parser.parse_args()
+
+    args.func(args)
@@ -1,5 +1,4 @@
 import math
-import random
 import functools
 import operator
 
@@ -8,7 +7,7 @@ from torch import nn
 from torch.nn import functional as F
 from torch.autograd import Function
 
-from op import FusedLeakyReLU, fused_leaky_relu, upfirdn2d, conv2d_gradfix
+from op import conv2d_gradfix, is_channels_last
 from model import (
     ModulatedConv2d,
     StyledConv,
@@ -19,6 +18,11 @@ from model import (
     Blur,
     EqualLinear,
     ConvLayer,
+    NoisePool,
+    broadcast_styles,
+    preview_layers,
+    seeded_randn,
+    truncate,
 )
 
 
@@ -35,6 +39,17 @@ def get_haar_wavelet(in_channels):
     return haar_wav_ll, haar_wav_lh, haar_wav_hl, haar_wav_hh
 
 
+def haar_weight(bands, channels):
+    # (4 * channels, channels, 2, 2) weight applying every 2x2 band filter to
+    # every channel, outputs are band major as torch.cat((ll, lh, hl, hh), 1).
+    # the transforms only run on RGB, so a dense conv is cheaper than grouped
+    # conv plus reordering
+    eye = torch.eye(channels, dtype=bands.dtype, device=bands.device)
+    weight = torch.einsum("kij,cd->kcdij", bands, eye)
+
+    return weight.reshape(4 * channels, channels, 2, 2)
+
+
 def dwt_init(x):
     x01 = x[:, :, 0::2, :] / 2
     x02 = x[:, :, 1::2, :] / 2
@@ -65,7 +80,7 @@ def iwt_init(x):
     x3 = x[:, out_channel * 2 : out_channel * 3, :, :] / 2
     x4 = x[:, out_channel * 3 : out_channel * 4, :, :] / 2
 
-    h = torch.zeros([out_batch, out_channel, out_height, out_width]).float().cuda()
+    h = x.new_zeros([out_batch, out_channel, out_height, out_width])
 
     h[:, :, 0::2, 0::2] = x1 - x2 - x3 + x4
     h[:, :, 1::2, 0::2] = x1 - x2 + x3 - x4
@@ -87,12 +102,12 @@ class HaarTransform(nn.Module):
         self.register_buffer("hh", hh)
 
     def forward(self, input):
-        ll = upfirdn2d(input, self.ll, down=2)
-        lh = upfirdn2d(input, self.lh, down=2)
-        hl = upfirdn2d(input, self.hl, down=2)
-        hh = upfirdn2d(input, self.hh, down=2)
+        # upfirdn2d(input, band, down=2) for all bands as one strided conv,
+        # flipped as upfirdn2d convolves while conv2d correlates
+        bands = torch.stack((self.ll, self.lh, self.hl, self.hh)).flip([1, 2])
+        weight = haar_weight(bands.to(input.dtype), input.shape[1])
 
-        return torch.cat((ll, lh, hl, hh), 1)
+        return conv2d_gradfix.conv2d(input, weight, stride=2)
 
 
 class InverseHaarTransform(nn.Module):
@@ -107,13 +122,12 @@ class InverseHaarTransform(nn.Module):
         self.register_buffer("hh", hh)
 
     def forward(self, input):
-        ll, lh, hl, hh = input.chunk(4, 1)
-        ll = upfirdn2d(ll, self.ll, up=2, pad=(1, 0, 1, 0))
-        lh = upfirdn2d(lh, self.lh, up=2, pad=(1, 0, 1, 0))
-        hl = upfirdn2d(hl, self.hl, up=2, pad=(1, 0, 1, 0))
-        hh = upfirdn2d(hh, self.hh, up=2, pad=(1, 0, 1, 0))
+        # sum of upfirdn2d(band, kernel, up=2, pad=(1, 0, 1, 0)) over the bands:
+        # every input pixel scales its 2x2 kernel, i.e. a stride 2 transposed conv
+        bands = torch.stack((self.ll, self.lh, self.hl, self.hh))
+        weight = haar_weight(bands.to(input.dtype), input.shape[1] // 4)
 
-        return ll + lh + hl + hh
+        return conv2d_gradfix.conv_transpose2d(input, weight, stride=2)
 
 
 class ToRGB(nn.Module):
@@ -202,6 +216,10 @@ class Generator(nn.Module):
             shape = [1, 1, 2 ** res, 2 ** res]
             self.noises.register_buffer(f"noise_{layer_idx}", torch.randn(*shape))
 
+        self.noise_pool = NoisePool(
+            [2 ** ((layer_idx + 5) // 2) for layer_idx in range(self.num_layers)]
+        )
+
         for i in range(3, self.log_size + 1):
             out_channel = self.channels[2 ** i]
 
@@ -230,9 +248,16 @@ class Generator(nn.Module):
 
         self.n_latent = self.log_size * 2 - 2
 
-    def make_noise(self):
+    def make_noise(self, seeds=None):
         device = self.input.input.device
 
+        if seeds is not None:
+            # one (len(seeds), 1, size, size) noise per layer, see seeded_randn
+            return [
+                seeded_randn(seeds, (1, size, size), i + 1, device)
+                for i, size in enumerate(self.noise_pool.sizes)
+            ]
+
         noises = [torch.randn(1, 1, 2 ** 2, 2 ** 2, device=device)]
 
         for i in range(3, self.log_size + 1):
@@ -256,51 +281,38 @@ class Generator(nn.Module):
         self,
         styles,
         return_latents=False,
+        return_f_maps=False,
         inject_index=None,
         truncation=1,
         truncation_latent=None,
         input_is_latent=False,
         noise=None,
         randomize_noise=True,
+        preview_size=None,
     ):
         if not input_is_latent:
             styles = [self.style(s) for s in styles]
 
+        # early exit: synthesis stops after the layers of preview_size (a power
+        # of 2 up to size) and the RGB skip at that resolution is returned
+        n_layers = self.num_layers
+
+        if preview_size is not None:
+            n_layers = preview_layers(self.num_layers, self.size, preview_size)
+
         if noise is None:
             if randomize_noise:
-                noise = [None] * self.num_layers
+                noise = self.noise_pool(
+                    styles[0].shape[0], styles[0].device, styles[0].dtype, n_layers
+                )
             else:
                 noise = [
                     getattr(self.noises, f"noise_{i}") for i in range(self.num_layers)
                 ]
 
-        if truncation < 1:
-            style_t = []
-
-            for style in styles:
-                style_t.append(
-                    truncation_latent + truncation * (style - truncation_latent)
-                )
-
-            styles = style_t
-
-        if len(styles) < 2:
-            inject_index = self.n_latent
-
-            if styles[0].ndim < 3:
-                latent = styles[0].unsqueeze(1).repeat(1, inject_index, 1)
-
-            else:
-                latent = styles[0]
-
-        else:
-            if inject_index is None:
-                inject_index = random.randint(1, self.n_latent - 1)
-
-            latent = styles[0].unsqueeze(1).repeat(1, inject_index, 1)
-            latent2 = styles[1].unsqueeze(1).repeat(1, self.n_latent - inject_index, 1)
-
-            latent = torch.cat([latent, latent2], 1)
+        noise = noise[:n_layers]
+        latent = broadcast_styles(styles, self.n_latent, inject_index)
+        latent = truncate(latent, truncation, truncation_latent)
 
         out = self.input(latent)
         out = self.conv1(out, latent[:, 0], noise=noise[0])
@@ -308,22 +320,29 @@ class Generator(nn.Module):
         skip = self.to_rgb1(out, latent[:, 1])
 
         i = 1
+        # feature taps for distillation are the wavelet coefficients of the
+        # skips, at half the resolution of the image they represent
+        f_maps = []
         for conv1, conv2, noise1, noise2, to_rgb in zip(
             self.convs[::2], self.convs[1::2], noise[1::2], noise[2::2], self.to_rgbs
         ):
             out = conv1(out, latent[:, i], noise=noise1)
             out = conv2(out, latent[:, i + 1], noise=noise2)
             skip = to_rgb(out, latent[:, i + 2], skip)
+            f_maps.append(skip)
 
             i += 2
 
         image = self.iwt(skip)
 
-        if return_latents:
-            return image, latent
+        if return_f_maps:
+            return image, latent, f_maps
+
+        elif return_latents:
+            return image, latent, None
 
         else:
-            return image, None
+            return image, None, None
 
 
 class ConvBlock(nn.Module):
@@ -429,11 +448,17 @@ class Discriminator(nn.Module):
         stddev = torch.sqrt(stddev.var(0, unbiased=False) + 1e-8)
         stddev = stddev.mean([2, 3, 4], keepdims=True).squeeze(2)
         stddev = stddev.repeat(group, 1, height, width)
+
+        if is_channels_last(out):
+            # torch.cat falls back to NCHW unless all inputs share the layout
+            stddev = stddev.contiguous(memory_format=torch.channels_last)
+
         out = torch.cat([out, stddev], 1)
 
         out = self.final_conv(out)
 
-        out = out.view(batch, -1)
+        # flattened in NCHW order as expected by final_linear
+        out = out.reshape(batch, -1)
         out = self.final_linear(out)
 
         return out
@@ -0,0 +1,37 @@
+import torch
+
+from checkpoint import generator_config
+from model import Generator
+from quantize import calibrate, load_quantized, quantize_generator
+
+
+@torch.no_grad()
+def test_load_quantized_round_trip(tmp_path):
+    torch.manual_seed(0)
+    generator = Generator(32, 64, 2, channel_multiplier=1).eval()
+    clips = calibrate(generator, torch.randn(2, 64), [1.0, 0.9])
+    # the mapping network is calibrated too
+    assert "style.1" in clips
+
+    g_int8 = quantize_generator(generator, clips).eval()
+    path = tmp_path / "g_ema_int8.pt"
+    torch.save(
+        {
+            "g_ema_int8": g_int8.state_dict(),
+            "clips": clips,
+            "config": generator_config(generator),
+            "args": {"ckpt": "g_ema.pt", "n_calib": 2},
+        },
+        path,
+    )
+    loaded = load_quantized(path)
+
+    for key, value in g_int8.state_dict().items():
+        assert torch.equal(loaded.state_dict()[key], value)
+
+    z = torch.randn(2, 64)
+    noise = generator.make_noise()
+    expected, _, _ = g_int8([z], noise=noise)
+    image, _, _ = loaded([z], noise=noise)
+
+    assert torch.allclose(image, expected)
@@ -0,0 +1,38 @@
+import pytest
+
+from serve import parse_body
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"seed": None},
+        {"latent": None},
+        {"seed": 1.5},
+        {"seed": True},
+        {"seed": "a"},
+        {"seed": -1},
+        {"seed": 1, "noise_seed": "x"},
+        {"seed": 1, "truncation_cutoff": 15},
+        {"seed": 1, "latent": [0.0] * 8},
+        {"latent": [0.0] * 7},
+        {},
+    ],
+)
+def test_parse_body_rejects(body):
+    with pytest.raises(ValueError):
+        parse_body(body, 8, 14)
+
+
+def test_parse_body_accepts():
+    assert parse_body({"seed": "3", "truncation_cutoff": 8}, 8, 14) == {
+        "seed": 3,
+        "latent": None,
+        "truncation": 1.0,
+        "noise_seed": None,
+        "truncation_cutoff": 8,
+    }
+    request = parse_body({"latent": [0.5] * 8, "noise_seed": None}, 8, 14)
+
+    assert request["latent"] == [0.5] * 8
+    assert request["seed"] is None
@@ -27,6 +27,7 @@ from distributed import (
     reduce_sum,
     get_world_size,
 )
+from checkpoint import generator_config, load_checkpoint, save_checkpoint
 from op import conv2d_gradfix
 from non_leaking import augment, AdaptiveAugment
 
@@ -315,7 +316,8 @@ def train(args, loader, generator, discriminator, g_optim, d_optim, g_ema, devic
                     )
 
             if i % 10000 == 0:
-                torch.save(
+                save_checkpoint(
+                    f"checkpoint/{str(i).zfill(6)}.pt",
                     {
                         "g": g_module.state_dict(),
                         "d": d_module.state_dict(),
@@ -325,7 +327,7 @@ def train(args, loader, generator, discriminator, g_optim, d_optim, g_ema, devic
                         "args": args,
                         "ada_aug_p": ada_aug_p,
                     },
-                    f"checkpoint/{str(i).zfill(6)}.pt",
+                    generator_config(g_ema),
                 )
 
 
@@ -489,7 +491,7 @@ if __name__ == "__main__":
     if args.ckpt is not None:
         print("load model:", args.ckpt)
 
-        ckpt = torch.load(args.ckpt, map_location=lambda storage, loc: storage)
+        ckpt = load_checkpoint(args.ckpt)
 
         try:
             ckpt_name = os.path.basename(args.ckpt)